@@ -0,0 +1,285 @@
+"""Throughput and latency benchmarks of the Semaphore pipeline.
+
+A synthetic input puts messages with realistic body sizes as fast as the
+pipeline takes them, or at a fixed rate, and a handler records when every
+message is emitted. Every case runs in a fresh process, so its peak RSS is
+its own, and the results are printed as JSON lines:
+
+    python benchmarks/pipeline.py --messages 20000 --handlers null file
+    python benchmarks/pipeline.py --keywords 0 100 10000 --cost 0 50 500
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from semaphore import (Handler, InputProcess, Message, MiddlewareProcess,
+                       RateLimitedSlackHandler, RotatingFileHandler, Semaphore)
+from semaphore.process import SemaphoreTimeLimitInterrupt
+from semaphore.topic_filter import KeywordFilter, RegexFilter
+
+#: Words the bodies are made of
+_WORDS = ('the', 'a', 'market', 'election', 'python', 'release', 'today',
+          'breaking', 'update', 'thread', 'people', 'new', 'says', 'why',
+          'how', 'climate', 'game', 'season', 'report', 'data', 'court',
+          'vote', 'price', 'launch', 'week', 'city', 'open', 'source')
+
+
+class BenchmarkFinished(Exception):
+    """Raised to stop the Semaphore once every message was emitted."""
+
+
+class Recorder:
+    """Records the latency of every emitted message.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.latencies = []
+        self.first = None
+        self.last = None
+        self.done = threading.Event()
+
+    def record(self, messages):
+        now = time.perf_counter()
+        for message in messages:
+            self.latencies.append(now - message.additions['created'])
+        self.last = now
+        if len(self.latencies) >= self.count:
+            self.done.set()
+
+
+class SyntheticInputProcess(InputProcess):
+    """Puts messages with bodies of lognormally distributed length.
+    """
+    def __init__(self, name, queue, logger, recorder, rate=None,
+                 body_size=280, seed=0):
+        super().__init__(name, queue, logger)
+        self._recorder = recorder
+        self._rate = rate
+        self._body_size = body_size
+        self._random = random.Random(seed)
+
+    def _body(self):
+        length = int(self._random.lognormvariate(0, 0.75) * self._body_size)
+        words = []
+        size = 0
+        while size < length:
+            word = self._random.choice(_WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return ' '.join(words)
+
+    async def execution_loop(self):
+        timestamp = datetime.datetime.utcnow()
+        # Bodies are made up front, so only the pipeline is measured.
+        bodies = [self._body() for _ in range(min(self._recorder.count,
+                                                  1000))]
+        self._recorder.first = time.perf_counter()
+        for counter in range(self._recorder.count):
+            message = Message(f'author{counter % 500}',
+                              bodies[counter % len(bodies)], 'synthetic',
+                              f'https://example.com/{counter}', timestamp,
+                              created=time.perf_counter())
+            await self._put_message(message)
+            if self._rate is not None:
+                await asyncio.sleep(1 / self._rate)
+            elif counter % 64 == 0:
+                await asyncio.sleep(0)
+
+        while not self._recorder.done.is_set():
+            await asyncio.sleep(0.01)
+        raise BenchmarkFinished()
+
+
+class CostlyMiddleProcess(MiddlewareProcess):
+    """Spends a fixed CPU time on every message.
+    """
+    def __init__(self, *args, cost=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cost = cost
+
+    def process_message(self, message):
+        end = time.perf_counter() + self._cost
+        while time.perf_counter() < end:
+            pass
+        return message
+
+
+class NullHandler(Handler):
+    blocking = False
+    max_batch = 256
+
+    def __init__(self, name, recorder):
+        super().__init__(name)
+        self._recorder = recorder
+
+    def emit_batch(self, messages):
+        self._recorder.record(messages)
+
+
+class RecordingFileHandler(RotatingFileHandler):
+    def __init__(self, name, filename, recorder):
+        super().__init__(name, filename)
+        self._recorder = recorder
+
+    def emit_batch(self, messages):
+        super().emit_batch(messages)
+        self._recorder.record(messages)
+
+
+class RecordingSlackHandler(RateLimitedSlackHandler):
+    def __init__(self, name, base_url, recorder):
+        super().__init__(name, 'token', 'benchmark', 'semaphore', ':zap:',
+                         rate=1000, burst=10, base_url=base_url)
+        self._recorder = recorder
+
+    def emit_batch(self, messages):
+        super().emit_batch(messages)
+        self._recorder.record(messages)
+
+
+class FakeSlack(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Write every response at once, or delayed ACKs dominate the latency.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"ok": true}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _topic_filter(keywords, kind):
+    if not keywords:
+        return lambda message: True
+    words = [f'keyword{x}' for x in range(keywords - 1)] + ['market']
+    if kind == 'regex':
+        return RegexFilter([rf'{x}\w*' for x in words])
+    return KeywordFilter(words, whole_words=True)
+
+
+def _peak_rss():
+    """Peak resident set size of this process, in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_case(case):
+    """Run one benchmark case and return its results.
+    """
+    recorder = Recorder(case['messages'])
+    directory = tempfile.mkdtemp(prefix='semaphore-benchmark-')
+    server = None
+    if case['handler'] == 'null':
+        handler = NullHandler('null', recorder)
+    elif case['handler'] == 'file':
+        handler = RecordingFileHandler(
+            'file', os.path.join(directory, 'out.txt'), recorder)
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlack)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        handler = RecordingSlackHandler(
+            'slack', f'http://127.0.0.1:{server.server_port}/', recorder)
+
+    semaphore = Semaphore(time_limit=case['time_limit'])
+    input_process = SyntheticInputProcess(
+        'synthetic', semaphore._input_queue, semaphore._logger, recorder,
+        rate=case['rate'], body_size=case['body_size'])
+    topic_filter = _topic_filter(case['keywords'], case['filter'])
+    # Keep the messages the filter would drop, so every case emits all.
+    input_process.topic_filter = lambda message: \
+        topic_filter(message) or True
+    semaphore.add_input_process(input_process)
+    semaphore.replace_middleware_process(CostlyMiddleProcess,
+                                         cost=case['cost'] / 1e6)
+    semaphore.add_output_handler(handler)
+
+    try:
+        semaphore.run()
+    except (BenchmarkFinished, SemaphoreTimeLimitInterrupt):
+        pass
+    finally:
+        if server is not None:
+            server.shutdown()
+        shutil.rmtree(directory)
+
+    latencies = sorted(recorder.latencies)
+    seconds = (recorder.last or time.perf_counter()) - recorder.first
+    return {**case,
+            'emitted': len(latencies),
+            'seconds': round(seconds, 4),
+            'messages_per_second': round(len(latencies) / seconds, 1),
+            'p50_ms': round(statistics.median(latencies) * 1000, 3)
+            if latencies else None,
+            'p99_ms': round(latencies[int(0.99 * (len(latencies) - 1))]
+                            * 1000, 3) if latencies else None,
+            'peak_rss_mb': round(_peak_rss(), 1)}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=20000,
+                        help='messages per case')
+    parser.add_argument('--handlers', nargs='+', default=['null'],
+                        choices=['null', 'file', 'slack'])
+    parser.add_argument('--keywords', nargs='+', type=int, default=[0],
+                        help='keywords in the topic filter, 0 for none')
+    parser.add_argument('--filter', default='keyword',
+                        choices=['keyword', 'regex'])
+    parser.add_argument('--cost', nargs='+', type=float, default=[0],
+                        help='microseconds of middleware CPU per message')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='messages per second, as fast as possible '
+                             'if not set, in which case the latency is '
+                             'mostly queueing')
+    parser.add_argument('--body-size', type=int, default=280,
+                        help='median body length in characters')
+    parser.add_argument('--time-limit', type=float, default=300,
+                        help='seconds after which a case is stopped')
+    parser.add_argument('--output', help='file to write the results to')
+    arguments = parser.parse_args(arguments)
+
+    output = open(arguments.output, 'w') if arguments.output else sys.stdout
+    try:
+        for handler, keywords, cost in itertools.product(
+                arguments.handlers, arguments.keywords, arguments.cost):
+            case = {'handler': handler, 'keywords': keywords,
+                    'filter': arguments.filter, 'cost': cost,
+                    'messages': arguments.messages, 'rate': arguments.rate,
+                    'body_size': arguments.body_size,
+                    'time_limit': arguments.time_limit}
+            # A fresh process per case, so the peak RSS is its own.
+            with ProcessPoolExecutor(1) as pool:
+                result = pool.submit(run_case, case).result()
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
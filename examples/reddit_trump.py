@@ -1,8 +1,8 @@
 # TODO: read Trump posts from several subreddits, post them to a CSV for analysis with sentiment and timestamp, as well as a simple markdown dump with a silly separator.
 # TODO: ask credentials in CMD, then create credentials file in ignore.
 
+import asyncio
 import datetime
-import time
 import logging
 import os
 import sys
@@ -16,9 +16,9 @@ class DummyInputProcess(InputProcess):
         counter = 0
         while True:
             message = Message('me', f'test {counter}', 'dummy', 'https://www.foo.com', datetime.datetime.utcnow())
-            self._put_message(message)
+            await self._put_message(message)
             counter += 1
-            await time.sleep(1)
+            await asyncio.sleep(1)
 
 
 class DummyMiddleProcess(MiddlewareProcess):
@@ -5,38 +5,29 @@ Usage paragraph.
 
 import asyncio
 import logging
-import queue
+import os
+import signal
 import sys
+import threading
 
-from .handler import FileHandler, SlackHandler, StreamHandler
-from .process import InputProcess, MiddlewareProcess, OutputProcess, TimeLimitProcess
-
-
-class Message:
-    def __init__(self, author, body, platform, url, timestamp, **kwargs):
-        #: Author of the message
-        self.author = author
-        #: Body of the message
-        self.body = body
-        #: Platform the message was posted on
-        self.platform = platform
-        #: URL where the message was fetched from
-        self.url = url
-        #: Timestamp the message was posted
-        self.timestamp = timestamp
-
-        #: Additional fields can be set later by another process, or are supplied
-        self.additions = kwargs  # TODO: access in the DotDict way.
-
-    def __repr__(self):
-        description = {
-            'author': self._author,
-            'body': self._body,
-            'platform': self._platform,
-            'timestamp': self._timestamp,
-            'url': self._url
-        }
-        return {**self._additions, **description}
+from .handler import (AsyncHandler, CSVHandler, FileHandler, Handler, JSONLinesHandler,
+                      PartialEmitError, RateLimitedSlackHandler, RotatingFileHandler,
+                      SlackHandler, StreamHandler, TCPHandler)
+from . import profiling
+from .aggregation import AggregationProcess
+from .checkpoint import CheckpointStore
+from .deadletter import DeadLetterStore
+from .dedup import Deduplicator
+from .message import Message
+from .metrics import DROPPED, Metrics
+from .persistent import PersistentQueue
+from .profiling import Profiler
+from .process import (CheckpointProcess, InputProcess, MetricsProcess, MiddlewareProcess,
+                      OutputProcess, RedditInputProcess, SchedulerProcess, TCPInputProcess,
+                      TimeLimitProcess, build_chain)
+from .queues import BLOCK, FairQueue, MessageQueue
+from .runtime import ShardedRuntime
+from .scheduler import PollScheduler
 
 
 class SemaphoreConfigurationError(Exception):
@@ -50,30 +41,119 @@ async def run_process(processes):
     for process in processes:
         task = asyncio.ensure_future(process.execution_loop())
         tasks.append(task)
-    await asyncio.gather(*tasks, return_exceptions=True)
+    # The first process to raise stops the run, the remaining tasks are
+    # cancelled when the event loop is closed.
+    await asyncio.gather(*tasks)
 
 
 class Semaphore:
-    def __init__(self, time_limit=None):
+    def __init__(self, time_limit=None,
+                 input_queue_size=0, input_queue_policy=BLOCK,
+                 output_queue_size=0, output_queue_policy=BLOCK,
+                 deduplicator=None, persistence_directory=None,
+                 checkpoint_store=None, poll_scheduler=None, metrics=None,
+                 profiler=None, runtime=None, fair_queuing=False,
+                 source_weights=None, dead_letter_store=None):
+        """Initialize the Semaphore with its queues.
+
+        :param time_limit: seconds to run for, runs forever if None
+            (type=float)
+        :param input_queue_size: maximum size of the queue between the inputs
+            and the middleware, 0 is unbounded (type=int)
+        :param input_queue_policy: policy when the input queue is full, see
+            semaphore.queues (type=str)
+        :param output_queue_size: maximum size of the queue between the
+            middleware and the output, 0 is unbounded (type=int)
+        :param output_queue_policy: policy when the output queue is full
+            (type=str)
+        :param deduplicator: drops messages any input process has put
+            before, see semaphore.dedup (type=Deduplicator)
+        :param persistence_directory: keep the queues between the stages in
+            this directory, so messages that were not emitted yet are
+            replayed after a restart (type=str)
+        :param checkpoint_store: keeps the checkpoints of the input
+            processes, see semaphore.checkpoint (type=CheckpointStore)
+        :param poll_scheduler: polls the input processes that implement
+            poll, a default PollScheduler if None, see semaphore.scheduler
+            (type=PollScheduler)
+        :param metrics: collects metrics of every stage, see
+            semaphore.metrics (type=Metrics)
+        :param profiler: times the topic filters, middleware, formatters
+            and handlers while running, and toggles its sampling profiler on
+            SIGUSR2, see semaphore.profiling (type=Profiler)
+        :param runtime: runs the input processes and middleware in worker
+            processes, on one core if None, see semaphore.runtime
+            (type=ShardedRuntime)
+        :param fair_queuing: let the queues between the stages take
+            messages by priority, and in turns across the input processes,
+            see semaphore.queues.FairQueue (type=bool)
+        :param source_weights: messages an input process takes per turn
+            with fair queuing, by name, 1 for the others (type=dict)
+        :param dead_letter_store: keeps the messages handlers failed to emit
+            after their retries, see semaphore.deadletter
+            (type=DeadLetterStore)
+        """
+        if fair_queuing and persistence_directory is not None:
+            raise ValueError('Fair queuing does not support persistent '
+                             'queues')
+
         #:
         self.time_limit = time_limit
         #: Input processes
         self._input_processes = dict()
+        #: Directory of the durable queues, or None
+        self._persistence_directory = persistence_directory
+        #: Weights of the input processes if the queues are fair, or None
+        self._source_weights = dict(source_weights or {}) \
+            if fair_queuing else None
         #: Message queue
-        self._input_queue = queue.Queue()
+        self._input_queue = self._make_queue('input', input_queue_size,
+                                             input_queue_policy)
         self._logger = logging.getLogger()
-        self._output_queue = queue.Queue()
+        self._output_queue = self._make_queue('output', output_queue_size,
+                                              output_queue_policy)
         #: Processes to kick off
         self._processes = dict()
+        #: Deduplicator shared by the input processes
+        self._deduplicator = deduplicator
+        #: Checkpoints of the input processes
+        self._checkpoint_store = checkpoint_store
+        #: Scheduler of the polling input processes
+        self._poll_scheduler = poll_scheduler or PollScheduler()
+        #: Metrics of the stages, or None
+        self.metrics = metrics
+        #: Profiler of the hot path, or None
+        self.profiler = profiler
+        #: Runtime spreading the stages over processes, or None
+        self._runtime = runtime
+        #: Supervisor of the worker processes, while running sharded
+        self.supervisor = None
 
         # We always have an output process.
         self._output_process = OutputProcess(self._output_queue,
                                              self._logger)
+        self._output_process.dead_letters = dead_letter_store
 
-        # As a default we use a plain passing MiddlewareProcess.
-        self._middleware = MiddlewareProcess(self._input_queue,
-                                             self._output_queue,
-                                             self._logger)
+        #: Middleware stages as (class, keyword arguments), in order
+        self._middleware_stages = []
+        #: Middleware processes, built from the stages when running
+        self._middleware_processes = []
+
+    def _make_queue(self, name, maxsize, policy):
+        if self._source_weights is not None:
+            return FairQueue(maxsize, policy, self._source_weights)
+        if self._persistence_directory is None:
+            return MessageQueue(maxsize, policy)
+        return PersistentQueue(os.path.join(self._persistence_directory, name),
+                               maxsize, policy)
+
+    @property
+    def dropped(self):
+        """Number of messages dropped by each queue because it was full."""
+        return {'input': self._input_queue.dropped,
+                'output': self._output_queue.dropped,
+                **{f'handler {name}': dropped for name, dropped
+                   in self._output_process.dropped.items()}}
 
     def add_input_process(self, input_process):
         """
@@ -88,28 +168,90 @@ class Semaphore:
         else:
             self._input_processes[input_process.name] = input_process
 
-    def add_output_handler(self, handler):
-        # TODO: check if this is a subclass of the correct object.
+    def add_output_handler(self, handler, queue_size=0, queue_policy=BLOCK):
+        """Add a handler with its own queue of messages to emit.
+
+        A batch the handler fails to emit is retried as often as the retries
+        of the handler, then stored in the dead letter store, if any.
+
+        :param handler: handler to emit messages with (type=Handler)
+        :param queue_size: maximum number of messages waiting for the
+            handler, 0 is unbounded (type=int)
+        :param queue_policy: policy when the queue is full, a blocking queue
+            holds up all handlers (type=str)
+        """
+        if not isinstance(handler, Handler):
+            raise TypeError('Passed instance is not a Handler')
 
-        self._output_process.add_handler(handler)
+        self._output_process.add_handler(handler, queue_size, queue_policy)
 
     def delete_output_handler(self, handler):
         # TODO: check if this is a subclass of the correct object.
 
         self._output_process.delete_handler(handler)
 
-    def replace_middleware_process(self, middleware_process):
+    def add_middleware_process(self, middleware_process, workers=1,
+                               ordered=True, **kwargs):
+        """Append a stage to the middleware chain.
+
+        Stages run in the order they are added, the queues between them
+        take the size and policy of the input queue.
+
+        :param middleware_process: subclass of MiddlewareProcess
+            (type=type)
+        :param workers: number of messages the stage processes concurrently
+            (type=int)
+        :param ordered: whether the stage keeps the order of messages
+            (type=bool)
+        :param kwargs: further arguments for the middleware process
         """
-        CLASS OBJECT
+        if not (isinstance(middleware_process, type) and
+                issubclass(middleware_process, MiddlewareProcess)):
+            raise TypeError('Passed class is not a MiddlewareProcess')
 
-        :param middleware_process:
-        :return:
+        kwargs.update(workers=workers, ordered=ordered)
+        self._middleware_stages.append((middleware_process, kwargs))
+
+    def replace_middleware_process(self, middleware_process, **kwargs):
+        """Replace the middleware chain with a single stage.
+
+        :param middleware_process: subclass of MiddlewareProcess
+            (type=type)
+        :param kwargs: arguments for add_middleware_process
         """
-        # TODO: check if this is a subclass of the correct object.
+        self._middleware_stages = []
+        self.add_middleware_process(middleware_process, **kwargs)
+
+    def _build_middleware(self):
+        """Instantiate the middleware chain and the queues connecting it.
+
+        As a default we use a plain passing MiddlewareProcess.
+        """
+        self._middleware_processes = build_chain(
+            self._middleware_stages or [(MiddlewareProcess, dict())],
+            self._input_queue, self._output_queue, self._logger,
+            lambda name: self._make_queue(name, self._input_queue.maxsize,
+                                          self._input_queue.policy))
+
+    def _instrument(self):
+        """Let every stage report to the metrics.
+        """
+        metrics = self.metrics
+        for input_process in self._input_processes.values():
+            input_process.metrics = metrics
+        for middleware_process in self._middleware_processes:
+            middleware_process.metrics = metrics
+        self._output_process.metrics = metrics
 
-        self._middleware = middleware_process(self._input_queue,
-                                              self._output_queue,
-                                              self._logger)
+        queues = {'input': self._input_queue, 'output': self._output_queue}
+        for middleware_process in self._middleware_processes[:-1]:
+            queues[middleware_process.name] = middleware_process.output_queue
+        for handler, queue in self._output_process.queues.items():
+            queues[f'handler {handler.name}'] = queue
+        for stage, queue in queues.items():
+            metrics.gauge('queue_depth', stage, queue.qsize)
+            metrics.count(stage, DROPPED,
+                          lambda queue=queue: queue.dropped)
 
     def run(self):
         if not self._input_processes:
@@ -120,12 +262,63 @@ class Semaphore:
             raise SemaphoreConfigurationError('No output handlers '
                                               'have been defined')
 
-        all_processes = list(self._input_processes.values()) + \
-                        [self._middleware, self._output_process]
+        for input_process in self._input_processes.values():
+            if self._deduplicator is not None and \
+                    input_process.deduplicator is None:
+                input_process.deduplicator = self._deduplicator
+            if self._checkpoint_store is not None and \
+                    input_process.checkpoint_store is None:
+                input_process.checkpoint_store = self._checkpoint_store
+
+        if self._runtime is not None:
+            # The inputs and middleware run in worker processes, started by
+            # the supervisor.
+            self._middleware_processes = []
+            self.supervisor = self._runtime.supervisor(
+                self._input_processes.values(), self._middleware_stages,
+                self._output_queue, self._logger, self._poll_scheduler,
+                self._checkpoint_store)
+            all_processes = [self.supervisor, self._output_process]
+        else:
+            self._build_middleware()
+            # Polling input processes are run by the scheduler, the others
+            # run their own execution loop.
+            polling = [x for x in self._input_processes.values()
+                       if x.polling]
+            all_processes = [x for x in self._input_processes.values()
+                             if not x.polling] + \
+                self._middleware_processes + [self._output_process]
+            if polling:
+                all_processes.append(SchedulerProcess(self._poll_scheduler,
+                                                      polling, self._logger))
+            if self._checkpoint_store is not None:
+                all_processes.append(CheckpointProcess(
+                    self._checkpoint_store, self._logger))
+
+        if self.metrics is not None:
+            self._instrument()
+            all_processes.append(MetricsProcess(self.metrics, self._logger))
         if self.time_limit is not None:
             all_processes.append(TimeLimitProcess(self.time_limit, self._logger))
+        toggle_signal = None
+        if self.profiler is not None:
+            profiling.enable(self.profiler)
+            if hasattr(signal, 'SIGUSR2') and \
+                    threading.current_thread() is threading.main_thread():
+                toggle_signal = signal.signal(
+                    signal.SIGUSR2,
+                    lambda *_: self.profiler.toggle_sampling())
         try:
             # Kick off concurrent processes.
-            asyncio.get_event_loop().run_until_complete(run_process(all_processes))
+            asyncio.run(run_process(all_processes))
         except KeyboardInterrupt:
             sys.exit(0)
+        finally:
+            if self.profiler is not None:
+                profiling.disable()
+                self.profiler.sampling.stop()
+                if toggle_signal is not None:
+                    signal.signal(signal.SIGUSR2, toggle_signal)
+            self._input_queue.close()
+            for middleware_process in self._middleware_processes:
+                middleware_process.output_queue.close()
@@ -0,0 +1,238 @@
+"""Aggregation of messages into digests over time windows.
+
+An AggregationProcess is a middleware stage that groups the messages by a
+key, e.g. their platform or a field in their additions, and emits a single
+digest per key per window instead of every message. A digest counts the
+messages, lists the most frequent items, e.g. bodies, and holds a few
+representative messages. A key with fewer than min_count messages in a
+window emits its messages as they are, once, even when sliding windows
+overlap.
+
+Windows are tumbling, or sliding if slide is shorter than the window, and
+are based on the time the stage received the messages. The state of a
+window is bounded: the number of keys, the number of items counted per key
+and the number of representatives are all limited.
+"""
+
+import asyncio
+import collections
+import datetime
+import math
+import time
+
+from .message import Message
+from .process import MiddlewareProcess
+
+#: Key of the messages of keys beyond the maximum number of keys
+OTHER = 'other'
+
+#: Fields of a message itself, the other fields are taken from additions
+_MESSAGE_FIELDS = ('author', 'body', 'platform', 'url', 'timestamp')
+
+
+class TopItems:
+    """Counts of the most frequent items, in bounded space.
+
+    Uses the Space-Saving algorithm: when the counter is full, a new item
+    replaces the least frequent one and inherits its count, so the counts
+    of frequent items are overestimated by at most the smallest count.
+    """
+    def __init__(self, capacity=50):
+        """
+        :param capacity: maximum number of items counted (type=int)
+        """
+        self._capacity = capacity
+        self._counts = dict()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, item, count=1):
+        if item in self._counts:
+            self._counts[item] += count
+        elif len(self._counts) < self._capacity:
+            self._counts[item] = count
+        else:
+            smallest = min(self._counts, key=self._counts.get)
+            self._counts[item] = self._counts.pop(smallest) + count
+
+    def update(self, other):
+        for item, count in other._counts.items():
+            self.add(item, count)
+
+    def top(self, count):
+        """The most frequent items as (item, count) pairs.
+        """
+        return sorted(self._counts.items(), key=lambda x: -x[1])[:count]
+
+
+class _Aggregate:
+    """Count, top items and representatives of a key in a pane.
+    """
+    __slots__ = ('count', 'items', 'representatives', 'passed')
+
+    def __init__(self, capacity):
+        self.count = 0
+        self.items = TopItems(capacity)
+        self.representatives = []
+        #: Whether the messages were emitted as they are, so the later
+        #: windows covering the pane do not emit them again
+        self.passed = False
+
+
+def _getter(field):
+    if callable(field):
+        return field
+    if field in _MESSAGE_FIELDS:
+        return lambda message: getattr(message, field)
+    return lambda message: message.additions.get(field)
+
+
+class AggregationProcess(MiddlewareProcess):
+    """Middleware stage emitting digests of the messages per key and window.
+
+    Add it as the last middleware stage, so it sits right before the
+    output. Digests of windows that did not end yet are lost when the
+    Semaphore stops.
+    """
+    def __init__(self, input_queue, output_queue, logger, key='platform',
+                 item='body', window=60.0, slide=None, top=5,
+                 representatives=3, min_count=2, max_keys=1000,
+                 max_items=50, **kwargs):
+        """
+        :param key: field of the message to group by, or a function of the
+            message (type=str)
+        :param item: field of the message to count the most frequent values
+            of, or a function of the message (type=str)
+        :param window: seconds of a window (type=float)
+        :param slide: seconds between sliding windows, tumbling windows if
+            None (type=float)
+        :param top: number of most frequent items in a digest (type=int)
+        :param representatives: number of messages kept per key and window
+            (type=int)
+        :param min_count: keys with fewer messages in a window emit them
+            instead of a digest (type=int)
+        :param max_keys: maximum number of keys per window, the messages of
+            further keys are aggregated under OTHER (type=int)
+        :param max_items: maximum number of items counted per key and
+            window (type=int)
+        :param kwargs: further arguments for the MiddlewareProcess
+        """
+        if kwargs.get('processes') is not None:
+            raise ValueError('An aggregation keeps its state in the event '
+                             'loop, so it cannot run in a process pool')
+        super().__init__(input_queue, output_queue, logger, **kwargs)
+
+        slide = window if slide is None else slide
+        if not 0 < slide <= window:
+            raise ValueError('The slide must be positive and at most the '
+                             'window')
+        self._key = _getter(key)
+        self._item = _getter(item)
+        self._window = window
+        self._slide = slide
+        self._top = top
+        self._representatives = max(representatives, min_count - 1)
+        self._min_count = min_count
+        self._max_keys = max_keys
+        self._max_items = max_items
+        #: Aggregates of every key, per pane of slide seconds, as
+        #: (start, aggregates by key), oldest first
+        self._panes = collections.deque()
+
+    def add(self, message, now):
+        """Add a message to the pane of a time.
+        """
+        start = math.floor(now / self._slide) * self._slide
+        if not self._panes or self._panes[-1][0] < start:
+            self._panes.append((start, dict()))
+        aggregates = self._panes[-1][1]
+
+        key = self._key(message)
+        if key not in aggregates and len(aggregates) >= self._max_keys:
+            key = OTHER
+        aggregate = aggregates.get(key)
+        if aggregate is None:
+            aggregate = aggregates[key] = _Aggregate(self._max_items)
+
+        aggregate.count += 1
+        item = self._item(message)
+        if item is not None:
+            aggregate.items.add(item)
+        if len(aggregate.representatives) < self._representatives:
+            aggregate.representatives.append(message)
+
+    def digests(self, end):
+        """The messages of the window ending at a time, and forget the panes
+        no later window needs.
+        """
+        start = end - self._window
+        merged = dict()
+        # Aggregates of every key per pane, to pass their messages once.
+        parts = dict()
+        for pane_start, aggregates in self._panes:
+            if not start <= pane_start < end:
+                continue
+            for key, aggregate in aggregates.items():
+                parts.setdefault(key, []).append(aggregate)
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = _Aggregate(self._max_items)
+                total.count += aggregate.count
+                total.items.update(aggregate.items)
+                room = self._representatives - len(total.representatives)
+                total.representatives.extend(aggregate.representatives[:room])
+
+        while self._panes and \
+                self._panes[0][0] < end - self._window + self._slide:
+            self._panes.popleft()
+
+        messages = []
+        for key, aggregate in merged.items():
+            if aggregate.count < self._min_count:
+                for part in parts[key]:
+                    if not part.passed:
+                        messages.extend(part.representatives)
+                        part.passed = True
+            else:
+                messages.append(self.digest(key, aggregate, start, end))
+        return messages
+
+    def digest(self, key, aggregate, start, end):
+        """The digest message of a key in a window.
+
+        Override to change what a digest looks like.
+        """
+        top = aggregate.items.top(self._top)
+        representatives = aggregate.representatives
+        lines = [f'{aggregate.count} messages for {key} in the last '
+                 f'{self._window:g} seconds']
+        lines.extend(f'{count}x {_shorten(str(item))}' for item, count in top)
+        return Message(
+            'semaphore', '\n'.join(lines), 'digest',
+            representatives[0].url if representatives else None,
+            datetime.datetime.utcfromtimestamp(end),
+            key=key, count=aggregate.count, top=top,
+            window_start=datetime.datetime.utcfromtimestamp(start),
+            representatives=[x.to_dict() for x in representatives])
+
+    def process_message(self, message):
+        self.add(message, time.time())
+
+    async def _emit_loop(self):
+        while True:
+            now = time.time()
+            end = (math.floor(now / self._slide) + 1) * self._slide
+            await asyncio.sleep(end - now)
+            for message in self.digests(end):
+                await self._put_message(message)
+
+    async def execution_loop(self):
+        """Run the workers, and emit the digests whenever a window ends.
+        """
+        await asyncio.gather(super().execution_loop(), self._emit_loop())
+
+
+def _shorten(text, width=80):
+    text = ' '.join(text.split())
+    return text if len(text) <= width else text[:width - 1] + '…'
@@ -0,0 +1,66 @@
+"""Checkpoints of input processes, so they resume where they left off.
+
+A CheckpointStore keeps a small dictionary per input process, keyed by its
+name, e.g. the id, timestamp or ETag of the last message it fetched. The
+store is written to a JSON file periodically and atomically, so an input
+process restarted after a crash only fetches what it has not seen yet.
+"""
+
+import json
+import os
+
+
+class CheckpointStore:
+    """Checkpoints of input processes, kept in a JSON file.
+    """
+    def __init__(self, path, flush_interval=5.0):
+        """
+        :param path: path of the JSON file, read if it exists (type=str)
+        :param flush_interval: seconds between writes of the file while the
+            Semaphore runs (type=float)
+        """
+        #: Path of the JSON file
+        self.path = os.path.abspath(os.fspath(path))
+        #: Seconds between writes of the file
+        self.flush_interval = flush_interval
+        #: Checkpoint of every input process, by name
+        self._checkpoints = dict()
+        #: Whether a checkpoint changed since the file was written
+        self._changed = False
+
+        if os.path.exists(self.path):
+            with open(self.path) as stream:
+                self._checkpoints = json.load(stream)
+
+    def __repr__(self):
+        return f'CheckpointStore in file {self.path}'
+
+    def get(self, name):
+        """The checkpoint of an input process, empty if it has none.
+        """
+        return dict(self._checkpoints.get(name, {}))
+
+    def update(self, name, **values):
+        """Update the checkpoint of an input process.
+
+        The values have to be serializable to JSON.
+        """
+        self._checkpoints.setdefault(name, {}).update(values)
+        self._changed = True
+
+    def flush(self):
+        """Write the checkpoints if they changed.
+
+        The file is replaced atomically, so it always holds a complete set
+        of checkpoints.
+        """
+        if not self._changed:
+            return
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as stream:
+            json.dump(self._checkpoints, stream)
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(temporary_path, self.path)
+        self._changed = False
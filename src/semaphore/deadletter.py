@@ -0,0 +1,177 @@
+"""Dead letters: messages a handler failed to emit after every retry.
+
+A DeadLetterStore keeps the dead letters of every handler in a JSON lines
+file of its own in a directory, with the error and the number of attempts,
+so they are not lost when an outage outlasts the retries. Once the outage is
+over, replay emits them with a handler and removes the ones it emitted. The
+store can be inspected and replayed from the command line:
+
+    python -m semaphore.deadletter DIRECTORY list
+    python -m semaphore.deadletter DIRECTORY replay slack mymodule:make_handler
+
+where make_handler is a function without arguments returning the handler to
+replay the dead letters of the handler named slack with.
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import importlib
+import json
+import os
+
+from .handler import PartialEmitError
+from .message import Message
+
+#: Extension of the file of every handler
+_EXTENSION = '.jsonl'
+
+
+class DeadLetterStore:
+    """Dead letters of every handler, kept in a directory.
+    """
+    def __init__(self, directory):
+        """
+        :param directory: directory of the files, created if it does not
+            exist (type=str)
+        """
+        #: Directory of the files
+        self.directory = os.path.abspath(os.fspath(directory))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return f'DeadLetterStore in directory {self.directory}'
+
+    def _path(self, handler_name):
+        return os.path.join(self.directory, handler_name + _EXTENSION)
+
+    @property
+    def handlers(self):
+        """Names of the handlers with dead letters."""
+        return sorted(x[:-len(_EXTENSION)] for x in os.listdir(self.directory)
+                      if x.endswith(_EXTENSION))
+
+    def add(self, handler_name, messages, error, attempts):
+        """Store messages a handler failed to emit.
+
+        :param error: exception of the last attempt (type=Exception)
+        :param attempts: number of times emitting was tried (type=int)
+        """
+        failed = datetime.datetime.utcnow().isoformat()
+        lines = [json.dumps({
+            'message': base64.b64encode(x.to_bytes()).decode('ascii'),
+            'error': repr(error), 'attempts': attempts, 'failed': failed})
+            for x in messages]
+        with open(self._path(handler_name), 'a') as stream:
+            stream.write(''.join(line + '\n' for line in lines))
+            stream.flush()
+            os.fsync(stream.fileno())
+
+    def entries(self, handler_name):
+        """The dead letters of a handler as dictionaries with the message,
+        the error, the number of attempts and when it failed, oldest first.
+        """
+        path = self._path(handler_name)
+        if not os.path.exists(path):
+            return []
+        entries = []
+        with open(path) as stream:
+            for line in stream:
+                entry = json.loads(line)
+                entry['message'] = Message.from_bytes(
+                    base64.b64decode(entry['message']))
+                entries.append(entry)
+        return entries
+
+    def messages(self, handler_name):
+        """The dead letters of a handler, oldest first.
+        """
+        return [x['message'] for x in self.entries(handler_name)]
+
+    def _keep(self, handler_name, entries):
+        """Replace the dead letters of a handler, atomically.
+        """
+        path = self._path(handler_name)
+        if not entries:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+
+        with open(path + '.tmp', 'w') as stream:
+            for entry in entries:
+                stream.write(json.dumps(dict(
+                    entry, message=base64.b64encode(
+                        entry['message'].to_bytes()).decode('ascii'))) + '\n')
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(path + '.tmp', path)
+
+    async def replay(self, handler, handler_name=None):
+        """Emit the dead letters of a handler, and remove the emitted ones.
+
+        Stops at the first batch that fails, which stays in the store with
+        the ones after it.
+
+        :param handler: handler to emit with (type=Handler)
+        :param handler_name: name of the handler the dead letters are of,
+            that of the handler if None (type=str)
+        :return: number of messages emitted (type=int)
+        """
+        handler_name = handler_name or handler.name
+        entries = self.entries(handler_name)
+        emitted = 0
+        try:
+            while emitted < len(entries):
+                batch = entries[emitted:emitted + handler.max_batch]
+                try:
+                    await handler.handle_batch([x['message'] for x in batch])
+                except PartialEmitError as error:
+                    emitted += error.emitted
+                    raise
+                emitted += len(batch)
+        finally:
+            self._keep(handler_name, entries[emitted:])
+            await handler.handle_flush()
+        return emitted
+
+
+def _load(path):
+    module, _, name = path.partition(':')
+    return getattr(importlib.import_module(module), name)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='List or replay the dead letters of a Semaphore.')
+    parser.add_argument('directory', help='directory of the dead letters')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='count the dead letters per handler')
+    replay = commands.add_parser('replay', help='emit the dead letters of a '
+                                                'handler')
+    replay.add_argument('handler', help='name of the handler')
+    replay.add_argument('factory', help='module:function returning the '
+                                        'handler to emit with')
+    arguments = parser.parse_args(arguments)
+
+    store = DeadLetterStore(arguments.directory)
+    if arguments.command == 'list':
+        for name in store.handlers:
+            print(f'{name}: {len(store.entries(name))}')
+        return
+
+    handler = _load(arguments.factory)()
+    try:
+        emitted = asyncio.run(store.replay(handler, arguments.handler))
+    except Exception as error:
+        left = len(store.entries(arguments.handler))
+        parser.exit(1, f'Replaying failed with {error!r}, {left} messages '
+                       f'left\n')
+    finally:
+        handler.close()
+    left = len(store.entries(arguments.handler))
+    print(f'Replayed {emitted} messages, {left} left')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Deduplication of messages before they reach the middleware.
+
+The same content often arrives more than once, e.g. as cross-posts or
+reposts. A Deduplicator fingerprints every message that passes the topic
+filter of an input process and drops the ones it has seen within a time to
+live. Fingerprints are exact hashes of the normalized text, or SimHashes to
+also catch near-duplicates. Seen fingerprints are kept in a set bounded in
+size and time, or in a rotating Bloom filter to use less memory.
+"""
+
+import collections
+import hashlib
+import math
+import re
+import time
+
+#: Fingerprint methods
+EXACT = 'exact'
+SIMHASH = 'simhash'
+
+_WORD = re.compile(r'\w+')
+
+
+def _hash(text):
+    """64-bit hash of a string.
+    """
+    return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8)
+                          .digest(), 'big')
+
+
+def _normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def exact_fingerprint(text):
+    """Fingerprint of the text, ignoring case and whitespace.
+    """
+    return _hash(_normalize(text))
+
+
+def simhash(text, bits=64):
+    """SimHash of the words in the text.
+
+    Texts that differ in a few words have fingerprints that differ in a few
+    bits.
+    """
+    weights = [0] * bits
+    for word, count in collections.Counter(
+            _WORD.findall(text.casefold())).items():
+        word_hash = _hash(word)
+        for bit in range(bits):
+            weights[bit] += count if word_hash >> bit & 1 else -count
+    return sum(1 << bit for bit, weight in enumerate(weights) if weight > 0)
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+class FingerprintSet:
+    """Set of fingerprints that forgets them after a time to live.
+
+    The oldest fingerprints are also forgotten when the set is full.
+    """
+    def __init__(self, ttl=3600, max_size=100000):
+        """
+        :param ttl: seconds a fingerprint is remembered (type=float)
+        :param max_size: maximum number of fingerprints (type=int)
+        """
+        self._ttl = ttl
+        self._max_size = max_size
+        #: Expiry time of every fingerprint, oldest first
+        self._expiry = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._expiry)
+
+    def _discard(self, fingerprint):
+        del self._expiry[fingerprint]
+
+    def _expire(self, now):
+        while self._expiry:
+            fingerprint, expiry = next(iter(self._expiry.items()))
+            if expiry > now and len(self._expiry) <= self._max_size:
+                break
+            self._discard(fingerprint)
+
+    def _find(self, fingerprint):
+        return fingerprint if fingerprint in self._expiry else None
+
+    def _add(self, fingerprint, now):
+        self._expiry[fingerprint] = now + self._ttl
+        self._expiry.move_to_end(fingerprint)
+
+    def check_and_add(self, fingerprint):
+        """Remember a fingerprint.
+
+        :return: whether the fingerprint, or a fingerprint close to it, was
+            already remembered (type=bool)
+        """
+        now = time.monotonic()
+        self._expire(now)
+        found = self._find(fingerprint)
+        self._add(fingerprint if found is None else found, now)
+        # Adding may have made the set too large.
+        self._expire(now)
+        return found is not None
+
+
+class SimHashSet(FingerprintSet):
+    """Fingerprint set that also finds SimHashes within a Hamming distance.
+
+    The fingerprints are split into distance + 1 bands. Two fingerprints
+    within the distance have at least one equal band, so only fingerprints
+    sharing a band are compared.
+    """
+    def __init__(self, ttl=3600, max_size=100000, distance=6, bits=64):
+        """
+        :param distance: maximum number of differing bits (type=int)
+        :param bits: bits of the fingerprints (type=int)
+        """
+        super().__init__(ttl, max_size)
+        self._distance = distance
+        bands = distance + 1
+        width = math.ceil(bits / bands)
+        #: Shift and mask of every band
+        self._bands = [(x * width, (1 << width) - 1) for x in range(bands)]
+        #: Fingerprints by band value, one dictionary per band
+        self._index = [collections.defaultdict(set) for _ in range(bands)]
+
+    def _keys(self, fingerprint):
+        return [fingerprint >> shift & mask for shift, mask in self._bands]
+
+    def _discard(self, fingerprint):
+        super()._discard(fingerprint)
+        for index, key in zip(self._index, self._keys(fingerprint)):
+            index[key].discard(fingerprint)
+            if not index[key]:
+                del index[key]
+
+    def _find(self, fingerprint):
+        if fingerprint in self._expiry:
+            return fingerprint
+        for index, key in zip(self._index, self._keys(fingerprint)):
+            for candidate in index.get(key, ()):
+                if hamming_distance(candidate, fingerprint) <= self._distance:
+                    return candidate
+        return None
+
+    def _add(self, fingerprint, now):
+        if fingerprint not in self._expiry:
+            for index, key in zip(self._index, self._keys(fingerprint)):
+                index[key].add(fingerprint)
+        super()._add(fingerprint, now)
+
+
+class BloomFilter:
+    """Bloom filter of fingerprints with a fixed false positive rate.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        :param capacity: number of fingerprints to hold (type=int)
+        :param error_rate: chance a new fingerprint is seen as a duplicate
+            when the filter is full (type=float)
+        """
+        self.capacity = capacity
+        #: Number of bits and of hash functions
+        self._size = max(8, int(-capacity * math.log(error_rate) /
+                                math.log(2) ** 2))
+        self._hashes = max(1, round(self._size / capacity * math.log(2)))
+        self._bits = bytearray((self._size + 7) // 8)
+        #: Number of fingerprints added
+        self.count = 0
+
+    def _positions(self, fingerprint):
+        # Double hashing on the two halves of the fingerprint.
+        first, second = fingerprint >> 32, fingerprint & 0xFFFFFFFF | 1
+        return [(first + x * second) % self._size
+                for x in range(self._hashes)]
+
+    def __contains__(self, fingerprint):
+        return all(self._bits[x >> 3] & 1 << (x & 7)
+                   for x in self._positions(fingerprint))
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter:
+    """Two generations of Bloom filters, forgetting fingerprints over time.
+
+    A new generation starts every half time to live, or when the current
+    one is full, so a fingerprint is remembered for between half and the
+    full time to live.
+    """
+    def __init__(self, ttl=3600, max_size=100000, error_rate=0.001):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._error_rate = error_rate
+        self._current = BloomFilter(max_size, error_rate)
+        self._previous = None
+        self._started = time.monotonic()
+
+    def __len__(self):
+        return self._current.count + \
+            (self._previous.count if self._previous else 0)
+
+    def check_and_add(self, fingerprint):
+        now = time.monotonic()
+        if now - self._started >= self._ttl / 2 or \
+                self._current.count >= self._max_size:
+            self._previous = self._current
+            self._current = BloomFilter(self._max_size, self._error_rate)
+            self._started = now
+
+        if fingerprint in self._current:
+            return True
+        self._current.add(fingerprint)
+        return self._previous is not None and fingerprint in self._previous
+
+
+class Deduplicator:
+    """Detects messages that were seen before within a time to live.
+
+    Every input process of a Semaphore shares the deduplicator, so
+    duplicates across sources are found as well.
+    """
+    def __init__(self, method=EXACT, fields=('body', 'url'), ttl=3600,
+                 max_size=100000, distance=6, bloom=False,
+                 error_rate=0.001):
+        """
+        :param method: EXACT to drop identical messages, SIMHASH to also
+            drop near-duplicates (type=str)
+        :param fields: fields of the message to fingerprint (type=tuple)
+        :param ttl: seconds a message is remembered (type=float)
+        :param max_size: maximum number of messages remembered (type=int)
+        :param distance: number of bits SimHashes of near-duplicates may
+            differ in (type=int)
+        :param bloom: remember exact fingerprints in a Bloom filter, which
+            uses less memory at the cost of false positives (type=bool)
+        :param error_rate: false positive rate of the Bloom filter
+            (type=float)
+        """
+        if method not in (EXACT, SIMHASH):
+            raise ValueError(f'Unknown fingerprint method {method}')
+        if bloom and method == SIMHASH:
+            raise ValueError('A Bloom filter only supports exact fingerprints')
+
+        self._fields = tuple(fields)
+        if method == SIMHASH:
+            self._fingerprint = simhash
+            self._seen = SimHashSet(ttl, max_size, distance)
+        else:
+            self._fingerprint = exact_fingerprint
+            self._seen = RotatingBloomFilter(ttl, max_size, error_rate) \
+                if bloom else FingerprintSet(ttl, max_size)
+
+        #: Number of messages checked
+        self.checked = 0
+        #: Number of duplicates found
+        self.duplicates = 0
+
+    def __repr__(self):
+        return (f'Deduplicator on {", ".join(self._fields)} with duplicate '
+                f'rate {self.duplicate_rate:.2f}')
+
+    @property
+    def duplicate_rate(self):
+        """Fraction of the checked messages that were duplicates."""
+        return self.duplicates / self.checked if self.checked else 0.0
+
+    def fingerprint(self, message):
+        return self._fingerprint('\n'.join(getattr(message, x) or ''
+                                           for x in self._fields))
+
+    def is_duplicate(self, message):
+        """Check whether a message was seen before, and remember it.
+        """
+        self.checked += 1
+        duplicate = self._seen.check_and_add(self.fingerprint(message))
+        if duplicate:
+            self.duplicates += 1
+        return duplicate
@@ -5,45 +5,199 @@ Messages are posted in communication channels using Handler subclass instances.
 They are typically called in a coroutine, meaning that locks are important on
 the emit functionality. The base Handler class is configured with a formatter
 and a lock.
+
+The output process calls Handler.handle, which awaits emit if it is a
+coroutine, runs it in a thread of the handler if the handler is blocking, and
+calls it directly otherwise. A slow handler therefore never blocks the event
+loop or the other handlers.
 """
 
+import asyncio
+import collections
+import csv
+import gzip
+import inspect
+import io
+import json
+import logging
+import operator
 import os
+import re
+import shutil
+import string
 import sys
 import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+import requests
 from slackclient import SlackClient
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from . import profiling
+from .message import pack_json
+from .ratelimit import shared_bucket
+from .transport import ACK, CHALLENGE_SIZE, encode_frame, encode_hello
+
+
+#: Fields of a message that can be used in a format
+_MESSAGE_ATTRIBUTES = ('author', 'body', 'platform', 'url', 'timestamp',
+                       'additions')
+#: Renderers compiled from formats, shared by formatters with the same format
+_renderers = dict()
+_conversions = {None: None, 's': str, 'r': repr, 'a': ascii}
+
+
+def _field_getter(field_name):
+    """Compile a field of a format to a function getting it from a message.
+
+    A field is the message itself, a field of the message, or an addition,
+    followed by attributes, e.g. {timestamp.year} or {additions.sentiment}.
+    Additions can also be used directly, e.g. {sentiment}, and are empty
+    when they are missing.
+    """
+    name, *attributes = field_name.split('.')
+    addition = name not in _MESSAGE_ATTRIBUTES and name != 'message'
+    if name == 'additions' and attributes:
+        addition = True
+        name, *attributes = attributes
+
+    if addition:
+        def getter(message):
+            return message.additions.get(name, '')
+    elif name == 'message':
+        def getter(message):
+            return message
+    else:
+        getter = operator.attrgetter(name)
+
+    if not attributes:
+        return getter
+
+    get_attributes = operator.attrgetter('.'.join(attributes))
+
+    def get(message):
+        return get_attributes(getter(message))
+    return get
+
+
+def _compile(fmt):
+    """Compile a format to a function rendering a message.
+    """
+    if fmt in _renderers:
+        return _renderers[fmt]
+
+    parts = []
+    for literal, field_name, format_spec, conversion in \
+            string.Formatter().parse(fmt):
+        if literal:
+            parts.append(literal)
+        if field_name is not None:
+            parts.append((_field_getter(field_name),
+                          _conversions[conversion], format_spec))
+
+    def render(message):
+        rendered = []
+        for part in parts:
+            if part.__class__ is str:
+                rendered.append(part)
+            else:
+                getter, convert, format_spec = part
+                value = getter(message)
+                if convert is not None:
+                    value = convert(value)
+                rendered.append(format(value, format_spec))
+        return ''.join(rendered)
+
+    _renderers[fmt] = render
+    return render
+
 
 class Formatter:
-    def __init__(self):
-        self._format = '{message}'
+    """Formats a message to text using a format string.
+
+    The format is compiled once, and every message caches what it was
+    formatted to. A message emitted by several handlers with the same
+    format is therefore formatted once. Messages should not be changed
+    after they have been formatted.
+    """
+    def __init__(self, fmt='{message}'):
+        """
+        :param fmt: format with fields of the message, e.g.
+            '{author}: {body} ({additions.sentiment})' (type=str)
+        """
+        self._format = fmt
+        self._render = _compile(fmt)
 
     def __repr__(self):
-        return 'Formatter with format \'{fmt}\''.replace(self._format)
+        return f'Formatter with format \'{self._format}\''
 
     def format(self, message):
-        return self._format.format(message.__repr__)
+        formatted = message._formatted
+        if formatted is None:
+            formatted = message._formatted = dict()
+        elif self._format in formatted:
+            return formatted[self._format]
+
+        text = formatted[self._format] = self._render(message)
+        return text
+
+
+class PartialEmitError(Exception):
+    """Raised by emit_batch when it failed after emitting some of the
+    messages, so only the others are emitted again.
+    """
+    def __init__(self, emitted, error):
+        super().__init__(f'Failed after emitting {emitted} messages: '
+                         f'{error!r}')
+        #: Number of messages emitted before the failure
+        self.emitted = emitted
+        #: Error the emit failed with
+        self.error = error
 
 
 class Handler:
     """Description.
     """
+    #: Whether emit blocks, in which case it runs in a thread of the handler
+    blocking = True
+    #: Maximum number of queued messages passed to emit_batch at once
+    max_batch = 1
+    #: Seconds between calls to flush while the handler is idle, or None
+    flush_interval = None
+    #: Times the messages of a failed batch are emitted again before they
+    #: are dead letters. A batch that fails partway through is emitted again
+    #: as a whole, so its messages are delivered at least once, unless
+    #: emit_batch raises PartialEmitError.
+    retries = 0
+    #: Seconds before the first retry, doubled for every next one
+    retry_delay = 1.0
+    #: Maximum seconds before a retry
+    max_retry_delay = 60.0
+
     def __init__(self, name):
         self._formatter = Formatter()
         self._lock = threading.RLock()
         self._name = name
+        #: Thread running a blocking emit, created on first use
+        self._executor = None
 
     @property
+    def formatter(self):
+        return self._formatter
+
+    @formatter.setter
     def formatter(self, fmt):
         if isinstance(fmt, Formatter):
             self._formatter = fmt
         else:
             raise TypeError('Passed instance is not of type formatter')
 
-    @formatter.getter
-    def formatter(self):
-        return self._formatter
-
     @property
     def name(self):
         return self._name
@@ -58,7 +212,94 @@ class Handler:
                                   'by Handler subclasses')
 
     def format(self, message):
-        return self._formatter.format(message)
+        profiler = profiling.profiler
+        if profiler is None:
+            return self._formatter.format(message)
+
+        stage = f'handler {self._name}'
+        started = profiler.start(profiling.FORMAT, stage, [message])
+        text = self._formatter.format(message)
+        profiler.stop(profiling.FORMAT, stage, [message], started)
+        return text
+
+    def emit_batch(self, messages):
+        """Emit several messages at once, which subclasses can override to
+        coalesce them. The default emits them one by one, and raises
+        PartialEmitError if it fails after emitting some of them.
+        """
+        for index, message in enumerate(messages):
+            try:
+                self.emit(message)
+            except Exception as error:
+                if not index:
+                    raise
+                raise PartialEmitError(index, error) from error
+
+    def flush(self):
+        """Flush buffered output, called every flush_interval seconds.
+        """
+
+    async def throttle(self):
+        """Wait until the handler may emit, e.g. because of a rate limit.
+
+        Messages that arrive in the meantime are passed to the same
+        emit_batch call.
+        """
+
+    async def _call(self, function, argument):
+        if inspect.iscoroutinefunction(function):
+            await function(argument)
+        elif self.blocking:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    1, thread_name_prefix=f'handler-{self._name}')
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, function, argument)
+        else:
+            function(argument)
+
+    async def handle(self, message):
+        """Emit a message without blocking the event loop.
+        """
+        await self._call(self.emit, message)
+
+    async def handle_batch(self, messages):
+        """Emit a batch of messages without blocking the event loop.
+        """
+        await self._call(self.emit_batch, messages)
+
+    async def handle_flush(self):
+        """Flush the handler without blocking the event loop.
+        """
+        await self._call(lambda _: self.flush(), None)
+
+    def close(self):
+        """Release the resources of the handler.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class AsyncHandler(Handler):
+    """Handler with a coroutine emit, e.g. using an asyncio HTTP client.
+    """
+    blocking = False
+
+    async def emit(self, message):
+        """Emit the message, to be implemented by subclasses.
+        """
+        raise NotImplementedError('emit must be implemented '
+                                  'by AsyncHandler subclasses')
+
+    async def emit_batch(self, messages):
+        for index, message in enumerate(messages):
+            try:
+                await self.emit(message)
+            except Exception as error:
+                if not index:
+                    raise
+                raise PartialEmitError(index, error) from error
 
 
 class SlackPostFailureError(Exception):
@@ -89,7 +330,7 @@ class SlackHandler(Handler):
         self._client = SlackClient(token)
 
     def __repr__(self):
-        return 'SlackHandler emitting to channel {}'.replace(self._channel)
+        return f'SlackHandler emitting to channel {self._channel}'
 
     def emit(self, message):
         """Post a message to Slack in the configured channel.
@@ -107,12 +348,109 @@ class SlackHandler(Handler):
             raise SlackPostFailureError(response)
 
 
+class RateLimitedSlackHandler(SlackHandler):
+    """Slack handler that respects the rate limit of a channel.
+
+    Posts are throttled by a token bucket shared by all handlers posting to
+    the same channel with the same token, which must use the same rate and
+    burst. Messages that queue up while waiting are coalesced into
+    a single digest post, either as lines of text or as blocks. Posts go
+    through a pooled HTTP session, and a post that is rate limited by Slack
+    is retried after the delay it asks for.
+    """
+    #: Maximum number of blocks in a Slack message
+    MAX_BLOCKS = 50
+
+    def __init__(self, name, token, channel, bot_name, icon, rate=1.0,
+                 burst=1, max_batch=20, blocks=False, max_retries=3,
+                 base_url='https://slack.com/api/', timeout=10):
+        """Initializes the Handler by creating an HTTP session.
+
+        :param name: name of the handler (type=str)
+        :param token: API token for a Slack Integration (type=str)
+        :param channel: channel ID to post messages to (type=str)
+        :param bot_name: name of the bot (type=str)
+        :param icon: icon to use as picture for the bot (type=str)
+        :param rate: posts per second to the channel (type=float)
+        :param burst: number of posts that can be made at once (type=int)
+        :param max_batch: maximum number of messages in one post (type=int)
+        :param blocks: post a digest as blocks instead of text (type=bool)
+        :param max_retries: number of retries of a rate-limited post
+            (type=int)
+        :param base_url: URL of the Slack Web API (type=str)
+        :param timeout: seconds to wait for a response (type=float)
+        """
+        super().__init__(name, token, channel, bot_name, icon)
+
+        #: Maximum number of messages in one post
+        self.max_batch = min(max_batch, self.MAX_BLOCKS) if blocks \
+            else max_batch
+        #: Whether digests are posted as blocks
+        self._blocks = blocks
+        #: Number of retries of a rate-limited post
+        self._max_retries = max_retries
+        #: URL of the chat.postMessage method
+        self._url = base_url.rstrip('/') + '/chat.postMessage'
+        #: Seconds to wait for a response
+        self._timeout = timeout
+        #: Token bucket of the channel
+        self._bucket = shared_bucket((token, channel), rate, burst)
+        #: HTTP session, keeping connections to Slack alive
+        self._session = requests.Session()
+        self._session.headers['Authorization'] = f'Bearer {token}'
+
+    def __repr__(self):
+        return f'RateLimitedSlackHandler emitting to channel {self._channel}'
+
+    def _post(self, payload):
+        for _ in range(self._max_retries + 1):
+            response = self._session.post(self._url, data=payload,
+                                          timeout=self._timeout)
+            if response.status_code != 429:
+                break
+
+            delay = float(response.headers.get('Retry-After', 1))
+            self._bucket.pause(delay)
+            time.sleep(delay)
+
+        if response.status_code != 200 or not response.json().get('ok'):
+            raise SlackPostFailureError(response.text)
+
+    def emit(self, message):
+        """Post a message to Slack in the configured channel.
+        """
+        self.emit_batch([message])
+
+    def emit_batch(self, messages):
+        """Post one or more messages to Slack as a single post.
+        """
+        with self._lock:
+            texts = [self.format(x) for x in messages]
+            payload = {'channel': self._channel, 'username': self._bot_name,
+                       'icon_emoji': self._icon, 'text': '\n'.join(texts)}
+            if self._blocks:
+                payload['blocks'] = json.dumps([
+                    {'type': 'section', 'text': {'type': 'mrkdwn', 'text': x}}
+                    for x in texts])
+            self._post(payload)
+
+    async def throttle(self):
+        await self._bucket.acquire()
+
+    def close(self):
+        self._session.close()
+        super().close()
+
+
 class StreamHandler(Handler):
     """
     A handler class which writes messages, appropriately formatted,
     to a stream. Note that this class does not close the stream, as
     sys.stdout or sys.stderr may be used.
     """
+    blocking = False
+    max_batch = 256
+
     def __init__(self, name, stream=None, terminator='\n'):
         """
         Initialize the handler.
@@ -148,14 +486,15 @@ class StreamHandler(Handler):
         has an 'encoding' attribute, it is used to determine how to do the
         output to the stream.
         """
-        try:
-            message = self.format(record)
-            stream = self.stream
-            stream.write(message)
-            stream.write(self.terminator)
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        """Emit several records with a single write and flush.
+        """
+        with self._lock:
+            self.stream.write(''.join(self.format(x) + self.terminator
+                                      for x in records))
             self.flush()
-        except Exception as error:
-            raise error
 
     def set_stream(self, stream):
         """Sets the StreamHandler's stream to the specified value,
@@ -174,7 +513,7 @@ class StreamHandler(Handler):
         return result
 
     def __repr__(self):
-        return 'StreamHandler emitting to stream {}'.replace(self.stream.__repr__)
+        return f'StreamHandler emitting to stream {self.stream!r}'
 
 
 class FileHandler(StreamHandler):
@@ -183,6 +522,8 @@ class FileHandler(StreamHandler):
         """
         super().__init__(name)
         filename = os.fspath(filename)
+        # The file is opened on the first emit.
+        self.stream = None
 
         #:
         self.filepath = os.path.abspath(filename)
@@ -203,6 +544,7 @@ class FileHandler(StreamHandler):
                     self.stream = None
                     if hasattr(stream, "close"):
                         stream.close()
+        super().close()
 
     def _open(self):
         """Open the current base file with the (original) mode and encoding.
@@ -217,9 +559,418 @@ class FileHandler(StreamHandler):
         If the stream was not opened because 'delay' was specified in the
         constructor, open it before calling the superclass's emit.
         """
-        if self.stream is None:
-            self.stream = self._open()
-        StreamHandler.emit(self, record)
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        with self._lock:
+            if self.stream is None:
+                self.stream = self._open()
+            StreamHandler.emit_batch(self, records)
 
     def __repr__(self):
-        return 'FileHandler emitting to file {}'.replace(self.filepath)
+        return f'FileHandler emitting to file {self.filepath}'
+
+
+class RotatingFileHandler(FileHandler):
+    """File handler that buffers writes and rotates the file.
+
+    Writes are buffered and flushed when the buffer is full or every
+    flush_interval seconds, instead of once per message. The file is rotated
+    when it exceeds max_bytes or is older than rotate_interval seconds.
+    Rotated segments can be compressed with gzip, and only the newest
+    backup_count segments are kept.
+    """
+    blocking = True
+
+    def __init__(self, name, filename, encoding='utf-8', buffer_size=65536,
+                 flush_interval=1.0, max_bytes=0, rotate_interval=None,
+                 backup_count=0, compress=False):
+        """
+        :param name: name of the handler (type=str)
+        :param filename: path of the file to write to (type=str)
+        :param encoding: encoding of the file (type=str)
+        :param buffer_size: bytes buffered before writing them (type=int)
+        :param flush_interval: seconds between writes of the buffered
+            messages, while the handler is busy or idle (type=float)
+        :param max_bytes: size to rotate the file at, 0 to never rotate on
+            size (type=int)
+        :param rotate_interval: seconds to rotate the file after, None to
+            never rotate on time (type=float)
+        :param backup_count: number of rotated segments to keep, 0 keeps all
+            (type=int)
+        :param compress: gzip rotated segments (type=bool)
+        """
+        super().__init__(name, filename, mode='ab', encoding=encoding)
+
+        #: Bytes buffered before writing them
+        self.buffer_size = buffer_size
+        #: Seconds between writes of the buffered messages
+        self.flush_interval = flush_interval
+        #: Size to rotate the file at
+        self.max_bytes = max_bytes
+        #: Seconds to rotate the file after
+        self.rotate_interval = rotate_interval
+        #: Number of rotated segments to keep
+        self.backup_count = backup_count
+        #: Whether rotated segments are compressed
+        self.compress = compress
+        #: Size of the current file
+        self._size = 0
+        #: Time the current file was opened
+        self._opened = None
+
+    def __repr__(self):
+        return f'RotatingFileHandler emitting to file {self.filepath}'
+
+    def _open(self):
+        stream = open(self.filepath, self.mode, buffering=self.buffer_size)
+        self._size = stream.tell()
+        self._opened = time.time()
+        return stream
+
+    def _should_rotate(self, size):
+        if self.max_bytes and self._size and \
+                self._size + size > self.max_bytes:
+            return True
+        return self.rotate_interval is not None and \
+            time.time() - self._opened >= self.rotate_interval
+
+    def _segment_paths(self):
+        """Rotated segments of the file, oldest first.
+        """
+        directory, basename = os.path.split(self.filepath)
+        # Only names rotate made, not other files sharing the prefix.
+        pattern = re.compile(re.escape(basename)
+                             + r'\.\d{8}-\d{6}(\.\d+)?(\.gz)?')
+        paths = [os.path.join(directory, x) for x in os.listdir(directory)
+                 if pattern.fullmatch(x)]
+        return sorted(paths, key=os.path.getmtime)
+
+    def rotate(self):
+        """Close the current file and move it to a timestamped segment.
+        """
+        with self._lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+            if not os.path.exists(self.filepath):
+                return
+
+            segment = '{}.{}'.format(self.filepath,
+                                     time.strftime('%Y%m%d-%H%M%S'))
+            counter = 0
+            path = segment
+            while os.path.exists(path) or os.path.exists(path + '.gz'):
+                counter += 1
+                path = f'{segment}.{counter}'
+            os.replace(self.filepath, path)
+
+            if self.compress:
+                with open(path, 'rb') as source, \
+                        gzip.open(path + '.gz', 'wb') as target:
+                    shutil.copyfileobj(source, target)
+                os.remove(path)
+
+            if self.backup_count:
+                for path in self._segment_paths()[:-self.backup_count]:
+                    os.remove(path)
+
+    def serialize(self, records):
+        """Serialize records to the bytes written to the file.
+        """
+        return ''.join(self.format(x) + self.terminator
+                       for x in records).encode(self.encoding)
+
+    def _header(self):
+        """Bytes written at the start of a new file, for subclasses with a
+        header.
+        """
+        return b''
+
+    def emit_batch(self, records):
+        """Write several records with a single buffered write.
+        """
+        data = self.serialize(records)
+        with self._lock:
+            if self.stream is not None and self._should_rotate(len(data)):
+                self.rotate()
+            if self.stream is None:
+                self.stream = self._open()
+                if self._size == 0:
+                    header = self._header()
+                    self.stream.write(header)
+                    self._size += len(header)
+
+            self.stream.write(data)
+            self._size += len(data)
+
+
+#: Fields every message has, the first columns of structured output
+MESSAGE_FIELDS = ('author', 'body', 'platform', 'url', 'timestamp')
+
+
+def _to_json(value):
+    """Encode values the JSON encoder does not know, like datetimes.
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+class CSVHandler(RotatingFileHandler):
+    """Handler writing messages as CSV rows, one column per field.
+
+    The columns are the fields of a message followed by the given additions.
+    If no columns are given, the header of an existing file is used, or else
+    the additions of the first message. Missing additions are left empty. A
+    header is written to every new file.
+    """
+    def __init__(self, name, filename, columns=None, additions=None,
+                 **kwargs):
+        """
+        :param name: name of the handler (type=str)
+        :param filename: path of the file to write to (type=str)
+        :param columns: all columns to write, overrides the default of the
+            message fields followed by the additions (type=list)
+        :param additions: additions to write after the message fields
+            (type=list)
+        :param kwargs: arguments for the RotatingFileHandler
+        """
+        super().__init__(name, filename, **kwargs)
+
+        if columns is None and additions is not None:
+            columns = MESSAGE_FIELDS + tuple(additions)
+        # Rows appended to an existing file follow its header.
+        header = self._read_header()
+        if header is not None:
+            if columns is not None and tuple(columns) != header:
+                raise ValueError(f'The columns do not match the header of '
+                                 f'{self.filepath}')
+            columns = header
+        #: Columns to write, set from the first message if None
+        self.columns = columns
+
+    def __repr__(self):
+        return f'CSVHandler emitting to file {self.filepath}'
+
+    def _read_header(self):
+        """The columns in the header of the file, None if it is empty or
+        does not exist.
+        """
+        try:
+            with open(self.filepath, newline='',
+                      encoding=self.encoding) as stream:
+                header = next(csv.reader(stream), None)
+        except FileNotFoundError:
+            return None
+        return tuple(header) if header else None
+
+    def _header(self):
+        return self._rows([self.columns])
+
+    def _rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode(self.encoding)
+
+    def _row(self, message):
+        row = []
+        for column in self.columns:
+            if column in MESSAGE_FIELDS:
+                value = getattr(message, column)
+            else:
+                value = message.additions.get(column, '')
+            row.append(value.isoformat() if hasattr(value, 'isoformat')
+                       else value)
+        return row
+
+    def serialize(self, records):
+        return self._rows([self._row(x) for x in records])
+
+    def emit_batch(self, records):
+        if self.columns is None:
+            with self._lock:
+                if self.columns is None:
+                    self.columns = MESSAGE_FIELDS + \
+                        tuple(sorted(records[0].additions))
+        super().emit_batch(records)
+
+
+class JSONLinesHandler(RotatingFileHandler):
+    """Handler writing every message as a JSON object on its own line.
+
+    The object holds the fields and additions of the message. Uses orjson to
+    encode if it is installed.
+    """
+    def __repr__(self):
+        return f'JSONLinesHandler emitting to file {self.filepath}'
+
+    def serialize(self, records):
+        if orjson is not None:
+            return b''.join(orjson.dumps(x.to_dict(), default=_to_json,
+                                         option=orjson.OPT_APPEND_NEWLINE)
+                            for x in records)
+
+        return ''.join(json.dumps(x.to_dict(), default=_to_json,
+                                  ensure_ascii=False) + '\n'
+                       for x in records).encode(self.encoding)
+
+
+class TCPHandler(AsyncHandler):
+    """Handler streaming messages to a TCPInputProcess of another Semaphore.
+
+    Messages are sent in batches, see semaphore.transport. Batches are kept
+    until the receiver acknowledges them, and sent again after a lost
+    connection is restored. When max_buffer messages are waiting for an
+    acknowledgement, emit waits, which holds up the queue of the handler.
+    """
+    max_batch = 256
+
+    def __init__(self, name, host, port, compression=1, max_buffer=100000,
+                 wait_for_ack=False, reconnect_delay=0.1,
+                 max_reconnect_delay=30.0, secret=None, ssl=None):
+        """
+        :param name: name of the handler (type=str)
+        :param host: host of the receiving Semaphore (type=str)
+        :param port: port of the receiving TCPInputProcess (type=int)
+        :param compression: zlib compression level, 0 to not compress
+            (type=int)
+        :param max_buffer: maximum number of messages waiting for an
+            acknowledgement (type=int)
+        :param wait_for_ack: only return from emit once the receiver
+            acknowledged the messages, so a durable output queue replays
+            the messages that were not received (type=bool)
+        :param reconnect_delay: seconds before reconnecting, doubled while
+            connecting fails (type=float)
+        :param max_reconnect_delay: maximum seconds before reconnecting
+            (type=float)
+        :param secret: secret shared with the receiver (type=str)
+        :param ssl: client context to connect with TLS, or True for the
+            default one (type=ssl.SSLContext)
+        """
+        super().__init__(name)
+        self._host = host
+        self._port = port
+        self._compression = compression
+        self._max_buffer = max_buffer
+        self._wait_for_ack = wait_for_ack
+        self._reconnect_delay = reconnect_delay
+        self._max_reconnect_delay = max_reconnect_delay
+        self._secret = secret
+        self._ssl = ssl
+
+        #: Id of this sender, so the receiver skips batches sent twice
+        self._sender = uuid.uuid4().hex
+        #: Sequence number of the last batch
+        self._sequence = 0
+        #: Frames and their number of messages waiting for an
+        #: acknowledgement, by sequence number
+        self._unacknowledged = collections.OrderedDict()
+        #: Number of messages waiting for an acknowledgement
+        self._buffered = 0
+        #: Set when batches are acknowledged
+        self._acknowledged = None
+        #: Writer of the connection, None while disconnected
+        self._writer = None
+        #: Task keeping the connection open
+        self._connection = None
+
+    def __repr__(self):
+        return f'TCPHandler emitting to {self._host}:{self._port}'
+
+    @property
+    def buffered(self):
+        """Number of messages waiting for an acknowledgement."""
+        return self._buffered
+
+    async def _connect(self):
+        """Keep a connection to the receiver, sending the unacknowledged
+        batches again whenever it is restored.
+        """
+        delay = self._reconnect_delay
+        while True:
+            writer = None
+            hello = False
+            try:
+                reader, writer = await asyncio.open_connection(
+                    self._host, self._port, ssl=self._ssl)
+                challenge = await reader.readexactly(CHALLENGE_SIZE)
+                writer.write(encode_hello(self._sender, challenge,
+                                          self._secret))
+                hello = True
+                await reader.readexactly(ACK.size)
+            except (OSError, asyncio.IncompleteReadError):
+                if hello:
+                    logging.getLogger().error(
+                        f'{self._name} was rejected by {self._host}:'
+                        f'{self._port}, check the secret')
+                if writer is not None:
+                    writer.close()
+                await asyncio.sleep(delay)
+                delay = min(2 * delay, self._max_reconnect_delay)
+                continue
+
+            # Only an accepted hello resets the delay, so a sender with the
+            # wrong secret does not keep reconnecting at once.
+            delay = self._reconnect_delay
+            for frame, _ in self._unacknowledged.values():
+                writer.write(frame)
+            self._writer = writer
+            try:
+                await self._read_acknowledgements(reader)
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                self._writer = None
+                writer.close()
+
+    async def _read_acknowledgements(self, reader):
+        while True:
+            sequence, = ACK.unpack(await reader.readexactly(ACK.size))
+            while self._unacknowledged and \
+                    next(iter(self._unacknowledged)) <= sequence:
+                _, (_, count) = self._unacknowledged.popitem(last=False)
+                self._buffered -= count
+            self._acknowledged.set()
+
+    async def _wait_for_acknowledgement(self):
+        self._acknowledged.clear()
+        await self._acknowledged.wait()
+
+    async def emit(self, message):
+        await self.emit_batch([message])
+
+    async def emit_batch(self, messages):
+        """Send a batch of messages, or buffer it while disconnected.
+        """
+        if self._connection is None:
+            self._acknowledged = asyncio.Event()
+            self._connection = asyncio.ensure_future(self._connect())
+        while self._buffered >= self._max_buffer:
+            await self._wait_for_acknowledgement()
+
+        self._sequence += 1
+        sequence = self._sequence
+        frame = encode_frame(sequence, pack_json(messages),
+                             compression=self._compression)
+        self._unacknowledged[sequence] = (frame, len(messages))
+        self._buffered += len(messages)
+        if self._writer is not None:
+            self._writer.write(frame)
+            try:
+                await self._writer.drain()
+            except OSError:
+                # The batch is sent again after reconnecting.
+                pass
+
+        while self._wait_for_ack and sequence in self._unacknowledged:
+            await self._wait_for_acknowledgement()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.cancel()
+            self._connection = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        super().close()
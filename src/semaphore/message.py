@@ -0,0 +1,270 @@
+"""The Message passed through a Semaphore.
+
+Messages are small slotted objects, so a Semaphore can hold many of them in
+its queues. They serialize to a compact binary form with to_bytes, which is
+also used to pickle them when they are sent to another process.
+
+to_bytes can fall back to pickle, so from_bytes must only read data of the
+Semaphore itself. Batches from other hosts use pack_json and unpack_json,
+which only ever build messages.
+"""
+
+import datetime
+import json
+import marshal
+import pickle
+import struct
+import sys
+
+#: Start of the epoch for naive and aware timestamps
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+#: Codecs of the serialized message, the first byte of to_bytes
+_MARSHAL = b'\x00'
+_PICKLE = b'\x01'
+
+#: Kinds of timestamp in the serialized message
+_NO_TIMESTAMP, _NAIVE, _AWARE, _OTHER = range(4)
+
+#: Length prefix of a message in a batch
+_LENGTH = struct.Struct('!I')
+
+
+class Additions(dict):
+    """Dictionary of additional fields that can be accessed as attributes.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+
+def _encode_timestamp(timestamp):
+    if timestamp is None:
+        return _NO_TIMESTAMP, None
+    if isinstance(timestamp, datetime.datetime):
+        if timestamp.tzinfo is None:
+            return _NAIVE, (timestamp - _EPOCH) // _MICROSECOND
+        return _AWARE, (timestamp - _EPOCH_UTC) // _MICROSECOND
+    return _OTHER, timestamp
+
+
+def _decode_timestamp(kind, value):
+    if kind == _NAIVE:
+        return _EPOCH + value * _MICROSECOND
+    if kind == _AWARE:
+        return _EPOCH_UTC + value * _MICROSECOND
+    return value
+
+
+class Message:
+    """A message fetched by an input process.
+
+    The platform and author are interned, as they repeat across many
+    messages. Additional fields are kept in additions, which is only created
+    when it is used.
+    """
+    __slots__ = ('author', 'body', 'platform', 'url', 'timestamp',
+                 'priority', 'source', '_additions', '_formatted')
+
+    def __init__(self, author, body, platform, url, timestamp, **kwargs):
+        #: Author of the message
+        self.author = sys.intern(author) if type(author) is str else author
+        #: Body of the message
+        self.body = body
+        #: Platform the message was posted on
+        self.platform = sys.intern(platform) if type(platform) is str \
+            else platform
+        #: URL where the message was fetched from
+        self.url = url
+        #: Timestamp the message was posted
+        self.timestamp = timestamp
+        #: Priority of the message, a FairQueue takes higher ones first
+        self.priority = 0
+        #: Name of the input process that put the message
+        self.source = None
+        #: Additional fields, created on first access
+        self._additions = Additions(kwargs) if kwargs else None
+        #: Text the message was formatted to, by format
+        self._formatted = None
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        return Message.from_bytes, (self.to_bytes(),)
+
+    @property
+    def additions(self):
+        """Additional fields can be set later by another process, or are
+        supplied, and can be accessed as attributes.
+        """
+        if self._additions is None:
+            self._additions = Additions()
+        return self._additions
+
+    @additions.setter
+    def additions(self, additions):
+        self._additions = Additions(additions)
+
+    def to_dict(self):
+        """The core fields of the message followed by its additions.
+        """
+        description = {
+            'author': self.author,
+            'body': self.body,
+            'platform': self.platform,
+            'timestamp': self.timestamp,
+            'url': self.url
+        }
+        if not self._additions:
+            return description
+        return {**description, **{k: v for k, v in self._additions.items()
+                                   if k not in description}}
+
+    def to_bytes(self):
+        """Serialize the message to bytes.
+
+        The message is marshalled, which is fast and compact, unless its
+        timestamp or additions hold objects marshal does not support, in
+        which case it is pickled. An aware timestamp is converted to UTC.
+        """
+        fields = (self.author, self.body, self.platform, self.url,
+                  *_encode_timestamp(self.timestamp),
+                  dict(self._additions) if self._additions else None,
+                  self.priority, self.source)
+        try:
+            return _MARSHAL + marshal.dumps(fields)
+        except ValueError:
+            return _PICKLE + pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserialize a message serialized with to_bytes.
+        """
+        codec, payload = data[:1], data[1:]
+        if codec == _MARSHAL:
+            fields = marshal.loads(payload)
+        elif codec == _PICKLE:
+            fields = pickle.loads(payload)
+        else:
+            raise ValueError('Data is not a serialized message')
+
+        author, body, platform, url, kind, timestamp, additions, *rest = fields
+        message = cls(author, body, platform, url,
+                      _decode_timestamp(kind, timestamp))
+        # Additions can be named like an argument or have keys that are not
+        # strings, so they are not passed as keyword arguments.
+        if additions:
+            message._additions = Additions(additions)
+        # Messages serialized before they had a priority and source lack
+        # them, e.g. in the log of a persistent queue.
+        if rest:
+            message.priority, message.source = rest
+        return message
+
+
+def pack(messages):
+    """Serialize a batch of messages to length-prefixed frames.
+    """
+    frames = []
+    for message in messages:
+        data = message.to_bytes()
+        frames.append(_LENGTH.pack(len(data)))
+        frames.append(data)
+    return b''.join(frames)
+
+
+def unpack(payload):
+    """Deserialize a batch of messages serialized with pack.
+    """
+    messages = []
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+        length, = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        messages.append(Message.from_bytes(bytes(view[offset:offset + length])))
+        offset += length
+    return messages
+
+
+#: Keys of the objects JSON has no type for, in pack_json
+_JSON_DATETIME = '__datetime__'
+_JSON_DATE = '__date__'
+#: Fields of a message in pack_json
+_JSON_FIELDS = 8
+
+
+def _to_json(value):
+    if isinstance(value, datetime.datetime):
+        return {_JSON_DATETIME: value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {_JSON_DATE: value.isoformat()}
+    return str(value)
+
+
+def _from_json(value):
+    if len(value) == 1:
+        if _JSON_DATETIME in value:
+            return datetime.datetime.fromisoformat(value[_JSON_DATETIME])
+        if _JSON_DATE in value:
+            return datetime.date.fromisoformat(value[_JSON_DATE])
+    return value
+
+
+def pack_json(messages):
+    """Serialize a batch of messages to JSON, to send to another host.
+
+    Datetimes and dates are kept, other values JSON does not support are
+    converted to strings.
+    """
+    return json.dumps(
+        [[x.author, x.body, x.platform, x.url, x.timestamp,
+          dict(x._additions) if x._additions else None, x.priority,
+          x.source] for x in messages],
+        default=_to_json, separators=(',', ':')).encode()
+
+
+def unpack_json(payload):
+    """Deserialize a batch of messages serialized with pack_json.
+
+    The payload can come from anyone, so it is validated and never runs
+    code. Raises ValueError if it is not a batch of messages.
+    """
+    fields = json.loads(payload, object_hook=_from_json)
+    if not isinstance(fields, list):
+        raise ValueError('Payload is not a batch of messages')
+
+    messages = []
+    for field in fields:
+        if not isinstance(field, list) or len(field) != _JSON_FIELDS:
+            raise ValueError('Payload is not a batch of messages')
+        author, body, platform, url, timestamp, additions, priority, \
+            source = field
+        if not all(isinstance(x, (str, type(None)))
+                   for x in (author, body, platform, url, source)) or \
+                not isinstance(additions, (dict, type(None))) or \
+                type(priority) is not int:
+            raise ValueError('Payload is not a batch of messages')
+        message = Message(author, body, platform, url, timestamp)
+        if additions:
+            message.additions = additions
+        message.priority = priority
+        message.source = source
+        messages.append(message)
+    return messages
@@ -0,0 +1,247 @@
+"""Metrics of the stages of a Semaphore.
+
+Every stage counts the messages that come in, go out, are filtered, are
+dropped and fail, labelled with the name of the stage, and every handler the
+messages it retried and gave up on as dead letters. Queue depths are
+gauges read when the metrics are collected, and the emit latency of every
+handler and the latency from the timestamp of a message to its emit are
+histograms.
+
+The metrics are passed to callbacks every interval, and can be scraped by
+Prometheus from an HTTP endpoint on localhost.
+"""
+
+import asyncio
+import bisect
+import datetime
+
+#: Counters of every stage
+IN = 'in'
+OUT = 'out'
+FILTERED = 'filtered'
+DROPPED = 'dropped'
+ERRORS = 'errors'
+RETRIED = 'retried'
+DEAD_LETTERS = 'dead_letters'
+
+COUNTERS = (IN, OUT, FILTERED, DROPPED, ERRORS, RETRIED, DEAD_LETTERS)
+
+#: Histograms of every handler
+EMIT_LATENCY = 'emit_latency_seconds'
+END_TO_END_LATENCY = 'end_to_end_latency_seconds'
+
+#: Upper bounds of the buckets of the histograms, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Histogram:
+    """Counts of observations in buckets, like a Prometheus histogram.
+    """
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=BUCKETS):
+        #: Upper bounds of the buckets
+        self.buckets = buckets
+        #: Observations in every bucket, the last one is unbounded
+        self.counts = [0] * (len(buckets) + 1)
+        #: Number of observations
+        self.count = 0
+        #: Sum of the observations
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """Estimate a quantile as the upper bound of its bucket.
+        """
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+def latency(timestamp, now):
+    """Seconds from the timestamp of a message to now, or None if it has no
+    datetime. Naive timestamps are taken to be in UTC.
+    """
+    if not isinstance(timestamp, datetime.datetime):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return now - (timestamp - _EPOCH_UTC).total_seconds()
+
+
+def _labels(**labels):
+    return ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels.items())
+
+
+class Metrics:
+    """Counters, gauges and histograms of the stages of a Semaphore.
+    """
+    def __init__(self, interval=10.0, port=None, host='127.0.0.1',
+                 buckets=BUCKETS):
+        """
+        :param interval: seconds between calls of the callbacks (type=float)
+        :param port: port to serve the metrics on for Prometheus, not served
+            if None, 0 picks a free port (type=int)
+        :param host: host to serve the metrics on (type=str)
+        :param buckets: upper bounds of the buckets of the histograms, in
+            seconds (type=tuple)
+        """
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self._buckets = tuple(buckets)
+        #: Counters, by stage and counter
+        self._counters = dict()
+        #: Functions returning the value of a counter, by stage and counter
+        self._counter_functions = dict()
+        #: Functions returning the value of a gauge, by name and stage
+        self._gauges = dict()
+        #: Histograms, by name and stage
+        self._histograms = dict()
+        #: Functions called with a snapshot every interval
+        self._callbacks = []
+
+    def __repr__(self):
+        return f'Metrics of {len(self._counters)} stages'
+
+    def increment(self, stage, counter, amount=1):
+        """Add to a counter of a stage.
+        """
+        counters = self._counters.get(stage)
+        if counters is None:
+            counters = self._counters[stage] = dict.fromkeys(COUNTERS, 0)
+        counters[counter] += amount
+
+    def count(self, stage, counter, function):
+        """Read a counter of a stage from a function when collected, e.g.
+        the number of messages a queue dropped.
+        """
+        self._counter_functions[stage, counter] = function
+
+    def gauge(self, name, stage, function):
+        """Read a gauge of a stage from a function when collected.
+        """
+        self._gauges[name, stage] = function
+
+    def observe(self, name, stage, value):
+        """Add an observation to a histogram of a stage.
+        """
+        histogram = self._histograms.get((name, stage))
+        if histogram is None:
+            histogram = self._histograms[name, stage] = \
+                Histogram(self._buckets)
+        histogram.observe(value)
+
+    def add_callback(self, callback):
+        """Call a function with a snapshot of the metrics every interval.
+        """
+        self._callbacks.append(callback)
+
+    def snapshot(self):
+        """The current metrics as a dictionary.
+
+        Counters are by stage and counter, gauges and histograms by name
+        and stage. Histograms are summarized by their count, sum, median
+        and 99th percentile.
+        """
+        counters = {stage: dict(x) for stage, x in self._counters.items()}
+        for (stage, counter), function in self._counter_functions.items():
+            counters.setdefault(stage, dict.fromkeys(COUNTERS, 0))[counter] \
+                = function()
+
+        gauges = dict()
+        for (name, stage), function in self._gauges.items():
+            gauges.setdefault(name, dict())[stage] = function()
+
+        histograms = dict()
+        for (name, stage), histogram in self._histograms.items():
+            histograms.setdefault(name, dict())[stage] = {
+                'count': histogram.count, 'sum': histogram.sum,
+                'p50': histogram.quantile(0.5),
+                'p99': histogram.quantile(0.99)}
+
+        return {'counters': counters, 'gauges': gauges,
+                'histograms': histograms}
+
+    def to_prometheus(self):
+        """The current metrics in the Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for counter in COUNTERS:
+            lines.append(f'# TYPE semaphore_messages_{counter}_total counter')
+            for stage, counters in snapshot['counters'].items():
+                lines.append(f'semaphore_messages_{counter}_total'
+                             f'{{{_labels(stage=stage)}}} {counters[counter]}')
+
+        for name, stages in snapshot['gauges'].items():
+            lines.append(f'# TYPE semaphore_{name} gauge')
+            for stage, value in stages.items():
+                lines.append(f'semaphore_{name}{{{_labels(stage=stage)}}} '
+                             f'{value}')
+
+        for name in sorted({x[0] for x in self._histograms}):
+            lines.append(f'# TYPE semaphore_{name} histogram')
+            for (other, stage), histogram in self._histograms.items():
+                if other != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*histogram.buckets, '+Inf'),
+                                        histogram.counts):
+                    cumulative += count
+                    lines.append(f'semaphore_{name}_bucket'
+                                 f'{{{_labels(stage=stage, le=bound)}}} '
+                                 f'{cumulative}')
+                lines.append(f'semaphore_{name}_sum'
+                             f'{{{_labels(stage=stage)}}} {histogram.sum}')
+                lines.append(f'semaphore_{name}_count'
+                             f'{{{_labels(stage=stage)}}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    async def _serve_request(self, reader, writer):
+        """Answer any HTTP request with the metrics.
+        """
+        try:
+            while (await reader.readline()).strip():
+                pass
+            body = self.to_prometheus().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n' +
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() +
+                         body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Start serving the metrics, and set port to the port used.
+
+        :return: the server (type=asyncio.Server)
+        """
+        server = await asyncio.start_server(self._serve_request, self.host,
+                                            self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        return server
+
+    def report(self):
+        """Call the callbacks with a snapshot of the metrics.
+        """
+        if self._callbacks:
+            snapshot = self.snapshot()
+            for callback in self._callbacks:
+                callback(snapshot)
@@ -0,0 +1,265 @@
+"""Durable queue between stages, so messages survive a crash.
+
+A PersistentQueue appends every message it receives to a write-ahead log of
+segment files, and remembers up to which message everything has been
+acknowledged by the next stage. When the queue is created again after a
+restart, the messages that were not acknowledged are read back from the
+segments through mmap and queued again.
+
+Appends are committed in groups, every commit_interval seconds or every
+commit_size messages, so the cost of writing and syncing is shared by many
+messages. A crash can lose the messages of the last group.
+"""
+
+import asyncio
+import mmap
+import os
+import random
+import struct
+import zlib
+
+from .message import Message
+from .queues import BLOCK, MessageQueue
+
+#: Header of a record: payload length, CRC32 of the payload, sequence number
+_HEADER = struct.Struct('!IIQ')
+#: File holding the sequence number up to which messages are acknowledged,
+#: followed by the acknowledged sequence numbers after it
+_ACKNOWLEDGED = 'acknowledged'
+
+
+def _segment_name(index):
+    return f'{index:012d}.seg'
+
+
+class PersistentQueue(MessageQueue):
+    """MessageQueue backed by a write-ahead log on disk.
+
+    Every message taken from the queue has to be acknowledged with ack once
+    the next stage is done with it, before it is forgotten.
+    """
+    def __init__(self, directory, maxsize=0, policy=BLOCK,
+                 segment_size=64 * 1024 * 1024, commit_interval=0.05,
+                 commit_size=1000, fsync=True):
+        """
+        :param directory: directory of the log, created if needed (type=str)
+        :param maxsize: maximum number of queued messages, 0 is unbounded
+            (type=int)
+        :param policy: what to do when the queue is full (type=str)
+        :param segment_size: bytes after which a new segment is started
+            (type=int)
+        :param commit_interval: maximum seconds before appended messages
+            are written (type=float)
+        :param commit_size: number of appended messages that are written at
+            once (type=int)
+        :param fsync: sync the segments to disk on every commit (type=bool)
+        """
+        super().__init__(maxsize, policy)
+
+        #: Directory of the log
+        self.directory = os.path.abspath(directory)
+        self._segment_size = segment_size
+        self._commit_interval = commit_interval
+        self._commit_size = commit_size
+        self._fsync = fsync
+
+        #: Sequence number of the next message put on the queue
+        self._next_sequence = 0
+        #: Every message before this sequence number is acknowledged
+        self._acknowledged = 0
+        #: Acknowledged sequence numbers after the first unacknowledged one
+        self._acknowledged_later = set()
+        #: Sequence numbers of messages taken but not acknowledged, by id
+        self._in_flight = dict()
+        #: Segments as [index, last sequence number], oldest first
+        self._segments = []
+        #: Records appended since the last commit
+        self._buffer = bytearray()
+        self._buffered = 0
+        #: Timer committing the buffer, if one is scheduled
+        self._commit_handle = None
+        #: File of the last segment
+        self._file = None
+        #: Whether the acknowledged sequence changed since the last commit
+        self._acknowledged_changed = False
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+
+    def __repr__(self):
+        return (f'PersistentQueue in {self.directory} with '
+                f'{self.qsize()} messages')
+
+    def _recover(self):
+        """Queue the messages in the log that were not acknowledged.
+        """
+        path = os.path.join(self.directory, _ACKNOWLEDGED)
+        if os.path.exists(path):
+            with open(path) as stream:
+                acknowledged = [int(x) for x in stream.read().split()]
+            if acknowledged:
+                self._acknowledged = acknowledged[0]
+                self._acknowledged_later = set(acknowledged[1:])
+        self._next_sequence = self._acknowledged
+
+        indices = sorted(int(x[:-4]) for x in os.listdir(self.directory)
+                         if x.endswith('.seg'))
+        for index in indices:
+            last = self._read_segment(index)
+            if last is None:
+                os.remove(os.path.join(self.directory, _segment_name(index)))
+            else:
+                self._segments.append([index, last])
+
+        index = self._segments[-1][0] + 1 if self._segments else 0
+        self._open_segment(index)
+        # Remove fully acknowledged segments on the first commit.
+        self._acknowledged_changed = True
+
+    def _read_segment(self, index):
+        """Queue the messages of a segment, truncating a torn last record.
+
+        :return: sequence number of the last record, or None if the
+            segment is empty (type=int)
+        """
+        path = os.path.join(self.directory, _segment_name(index))
+        last = None
+        offset = 0
+        with open(path, 'r+b') as stream:
+            size = os.fstat(stream.fileno()).st_size
+            if size:
+                with mmap.mmap(stream.fileno(), 0,
+                               access=mmap.ACCESS_READ) as data:
+                    while offset + _HEADER.size <= size:
+                        length, crc, sequence = \
+                            _HEADER.unpack_from(data, offset)
+                        start = offset + _HEADER.size
+                        payload = data[start:start + length]
+                        if len(payload) < length or \
+                                zlib.crc32(payload) != crc:
+                            break
+
+                        offset = start + length
+                        last = sequence
+                        self._next_sequence = max(self._next_sequence,
+                                                  sequence + 1)
+                        if sequence >= self._acknowledged and \
+                                sequence not in self._acknowledged_later:
+                            self._queue_recovered(sequence,
+                                                  Message.from_bytes(payload))
+            if offset < size:
+                stream.truncate(offset)
+        return last
+
+    def _queue_recovered(self, sequence, message):
+        # Recovered messages are queued regardless of the maximum size.
+        MessageQueue._put(self, (sequence, message))
+        self._unfinished_tasks += 1
+        self._finished.clear()
+
+    def _open_segment(self, index):
+        if self._file is not None:
+            self._file.close()
+        self._segments.append([index, None])
+        self._file = open(os.path.join(self.directory, _segment_name(index)),
+                          'ab')
+
+    def _put(self, item):
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        self._append(sequence, item)
+        super()._put((sequence, item))
+
+    def _get(self):
+        sequence, item = super()._get()
+        self._in_flight[id(item)] = sequence
+        return item
+
+    def _drop_oldest(self):
+        item = super()._drop_oldest()
+        self.ack(item)
+        return item
+
+    def _replace_random(self, item):
+        index = random.randrange(len(self._queue))
+        sequence, replaced = self._queue[index]
+        self._acknowledge(sequence)
+
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        self._append(sequence, item)
+        self._queue[index] = (sequence, item)
+        return replaced
+
+    def _append(self, sequence, message):
+        payload = message.to_bytes()
+        self._buffer += _HEADER.pack(len(payload), zlib.crc32(payload),
+                                     sequence)
+        self._buffer += payload
+        self._buffered += 1
+        self._segments[-1][1] = sequence
+
+        if self._buffered >= self._commit_size:
+            self.commit()
+        elif self._commit_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.commit()
+            else:
+                self._commit_handle = loop.call_later(self._commit_interval,
+                                                      self.commit)
+
+    def ack(self, message):
+        """Acknowledge that the next stage is done with a message.
+        """
+        sequence = self._in_flight.pop(id(message), None)
+        if sequence is not None:
+            self._acknowledge(sequence)
+
+    def _acknowledge(self, sequence):
+        self._acknowledged_later.add(sequence)
+        while self._acknowledged in self._acknowledged_later:
+            self._acknowledged_later.remove(self._acknowledged)
+            self._acknowledged += 1
+        self._acknowledged_changed = True
+
+    def commit(self):
+        """Write the appended messages and the acknowledged sequence number.
+        """
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            self._buffer = bytearray()
+            self._buffered = 0
+            if self._file.tell() >= self._segment_size:
+                self._open_segment(self._segments[-1][0] + 1)
+
+        if self._acknowledged_changed:
+            self._acknowledged_changed = False
+            path = os.path.join(self.directory, _ACKNOWLEDGED)
+            with open(path + '.tmp', 'w') as stream:
+                stream.write(' '.join(map(str, [self._acknowledged,
+                                                *self._acknowledged_later])))
+            os.replace(path + '.tmp', path)
+
+            # Remove segments of which every message is acknowledged.
+            while len(self._segments) > 1 and \
+                    self._segments[0][1] is not None and \
+                    self._segments[0][1] < self._acknowledged:
+                index, _ = self._segments.pop(0)
+                os.remove(os.path.join(self.directory, _segment_name(index)))
+
+    def close(self):
+        """Commit and close the log.
+        """
+        self.commit()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
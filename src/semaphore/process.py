@@ -4,8 +4,26 @@ Usage paragraph.
 """
 
 import asyncio
+import datetime
+import functools
+import inspect
+import os
+import random
 import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import profiling
+from .handler import PartialEmitError
+from .message import Message, unpack_json
+from .metrics import (DEAD_LETTERS, EMIT_LATENCY, END_TO_END_LATENCY, ERRORS, FILTERED,
+                      IN, OUT, RETRIED, latency)
+from .queues import BLOCK, MessageQueue
+from .transport import (ACK, HELLO, MAX_FRAME_SIZE, MAX_HELLO_SIZE, decode_hello, new_challenge,
+                        read_frame)
 
 
 class Process:
@@ -22,6 +40,12 @@ class Process:
         self._lock = threading.RLock()
         self._logger = logger
 
+    def __setstate__(self, state):
+        """Create a new lock when unpickled in another process.
+        """
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
     async def execution_loop(self):
         """To be implemented by subclasses.
         """
@@ -43,23 +67,85 @@ class InputProcess(Process):
         self._queue = queue
         #:
         self._topic_filter = None  # TODO: check if this is right class.
+        #: Deduplicator shared with the other input processes, or None
+        self._deduplicator = None
+        #: Store of the checkpoint of this input process, or None
+        self._checkpoint_store = None
+        #: Token bucket every request of this process draws from, or None
+        self.request_budget = None
+        #: Metrics of the Semaphore, or None
+        self.metrics = None
+        #: Priority of the messages that the topic filter did not give one
+        self.priority = 0
 
-    def _put_message(self, message):
+    def __getstate__(self):
+        """Leave out the queue, lock and metrics when sent to a worker
+        process, which gives the process a queue of its own.
         """
+        state = self.__dict__.copy()
+        for key in ('_queue', '_lock', 'metrics'):
+            state[key] = None
+        return state
+
+    async def _put_message(self, message):
+        """Put a message on the queue if it passes the topic filter and is
+        not a duplicate.
+
+        The message gets the name of this process as its source, and the
+        topic filter can set its priority.
+
+        This is a coroutine, so that a subclass awaits the hand-off to
+        the next stage instead of blocking the event loop.
         """
         if self._topic_filter is None:
             raise ValueError('Topic filter has not been supplied')
+        if message.source is None:
+            message.source = self._name
+
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.increment(self._name, IN)
+
+        profiler = profiling.profiler
+        if profiler is None:
+            passed = self._topic_filter(message)
+        else:
+            profiler.begin(message)
+            started = profiler.start(profiling.FILTER, self._name, [message])
+            passed = self._topic_filter(message)
+            profiler.stop(profiling.FILTER, self._name, [message], started)
+
+        if passed and self._deduplicator is not None and \
+                self._deduplicator.is_duplicate(message):
+            self._logger.debug(f'Dropping duplicate {message.body}')
+            passed = False
+        if not passed:
+            if metrics is not None:
+                metrics.increment(self._name, FILTERED)
+            if profiler is not None:
+                profiler.replace(message, None)
+            return
+
+        if self.priority and not message.priority:
+            message.priority = self.priority
 
-        if self._topic_filter(message):
-            self._logger.debug(f'Putting message {message.body}')
-            with self._lock:
-                self._queue.put(message)
-                # TODO: Catch full exception.
+        self._logger.debug(f'Putting message {message.body}')
+        await self._queue.put(message)
+        if metrics is not None:
+            metrics.increment(self._name, OUT)
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def queue(self):
+        return self._queue
+
+    @queue.setter
+    def queue(self, queue):
+        self._queue = queue
+
     @property
     def topic_filter(self):
         return self._topic_filter
@@ -69,6 +155,65 @@ class InputProcess(Process):
         # TODO: test if it is valid, if not remove this boilerplate.
         self._topic_filter = topic_filter
 
+    @property
+    def deduplicator(self):
+        return self._deduplicator
+
+    @deduplicator.setter
+    def deduplicator(self, deduplicator):
+        self._deduplicator = deduplicator
+
+    @property
+    def checkpoint_store(self):
+        return self._checkpoint_store
+
+    @checkpoint_store.setter
+    def checkpoint_store(self, checkpoint_store):
+        self._checkpoint_store = checkpoint_store
+
+    @property
+    def checkpoint(self):
+        """Values saved by this process before, e.g. the id of the last
+        message fetched, so only newer messages have to be fetched.
+        """
+        if self._checkpoint_store is None:
+            return dict()
+        return self._checkpoint_store.get(self._name)
+
+    def save_checkpoint(self, **values):
+        """Save values to resume from after a restart.
+        """
+        if self._checkpoint_store is not None:
+            self._checkpoint_store.update(self._name, **values)
+
+    @property
+    def polling(self):
+        """Whether the process implements poll, and is polled by the
+        scheduler of the Semaphore instead of running its execution loop.
+        """
+        return type(self).poll is not InputProcess.poll
+
+    async def _acquire_request(self):
+        """Wait until the request budget allows another request.
+
+        Implementations of poll call this before every request they make.
+        """
+        if self.request_budget is not None:
+            await self.request_budget.acquire()
+
+    async def poll(self):
+        """Put the messages that are new since the last poll on the queue,
+        to be implemented by a subclass that polls its source.
+
+        :return: number of new messages (type=int)
+        """
+        raise NotImplementedError('To be implemented by subclasses')
+
+    def close(self):
+        """Release the resources of the process, once it stopped polling or
+        its execution loop ended.
+        """
+
     async def execution_loop(self):
         """The main execution loop for an input process, to be 
         implemented by a subclass.
@@ -82,118 +227,892 @@ class InputProcess(Process):
 # TODO: twitter input process.
 
 
-# TODO: reddit process.
+class RedditInputProcess(InputProcess):
+    """Polls the newest posts of many subreddits.
+
+    Subreddits are fetched in groups through combined listings, e.g.
+    /r/python+golang/new.json, over a single pooled HTTP session. Every group
+    keeps the newest post it has seen as before cursor and the ETag of the
+    last response, so Reddit only returns new posts, or nothing at all. A
+    group that has no new posts is polled less often, up to max_interval,
+    and is polled every interval again once it has. The cursors are saved in
+    the checkpoint of the process.
+
+    Run by the poll scheduler of a Semaphore, a poll fetches the groups that
+    are due, and fails if every one of them failed.
+    """
+    def __init__(self, name, queue, logger, subreddits, user_agent,
+                 base_url='https://www.reddit.com', group_size=25, limit=100,
+                 interval=10.0, max_interval=300.0, timeout=10):
+        """
+        :param name: name of the input process (type=str)
+        :param queue: queue to put the messages on (type=MessageQueue)
+        :param logger: logger of the Semaphore (type=logging.Logger)
+        :param subreddits: names of the subreddits to poll (type=list)
+        :param user_agent: descriptive user agent, required by Reddit
+            (type=str)
+        :param base_url: URL of Reddit (type=str)
+        :param group_size: number of subreddits fetched in one request
+            (type=int)
+        :param limit: maximum number of posts per request (type=int)
+        :param interval: seconds between polls of an active group
+            (type=float)
+        :param max_interval: maximum seconds between polls of a quiet group
+            (type=float)
+        :param timeout: seconds to wait for a response (type=float)
+        """
+        super().__init__(name, queue, logger)
+
+        if not subreddits:
+            raise ValueError('A Reddit input process needs a subreddit')
+        self._base_url = base_url.rstrip('/')
+        self._limit = limit
+        self._interval = interval
+        self._max_interval = max_interval
+        self._timeout = timeout
+
+        #: Polling state of every group of subreddits, by listing path
+        self._groups = dict()
+        subreddits = sorted(set(subreddits))
+        for start in range(0, len(subreddits), group_size):
+            path = '/r/{}/new.json'.format(
+                '+'.join(subreddits[start:start + group_size]))
+            self._groups[path] = {'before': None, 'etag': None,
+                                  'interval': interval, 'due': 0.0}
+        #: Whether the cursors were restored from the checkpoint
+        self._restored = False
+
+        #: HTTP session, keeping connections to Reddit alive
+        self._session = requests.Session()
+        self._session.headers['User-Agent'] = user_agent
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def __repr__(self):
+        return (f'RedditInputProcess {self._name} polling '
+                f'{len(self._groups)} groups of subreddits')
+
+    def _get(self, path, group):
+        """Fetch the listing of a group, conditional on its cursors.
+        """
+        params = {'limit': self._limit, 'raw_json': 1}
+        if group['before'] is not None:
+            params['before'] = group['before']
+        headers = {}
+        if group['etag'] is not None:
+            headers['If-None-Match'] = group['etag']
+        return self._session.get(self._base_url + path, params=params,
+                                 headers=headers, timeout=self._timeout)
+
+    def _to_message(self, post):
+        return Message(post.get('author'),
+                       post.get('selftext') or post.get('title'), 'reddit',
+                       self._base_url + post.get('permalink', ''),
+                       datetime.datetime.utcfromtimestamp(
+                           post.get('created_utc', 0)),
+                       id=post.get('name'), title=post.get('title'),
+                       subreddit=post.get('subreddit'))
+
+    def _back_off(self, group, delay=None):
+        group['interval'] = min(group['interval'] * 2, self._max_interval)
+        if delay is not None:
+            group['interval'] = max(group['interval'], delay)
+
+    async def _poll_group(self, path, group):
+        """Poll a group of subreddits and put its new posts on the queue.
+
+        :return: number of new posts (type=int)
+        """
+        await self._acquire_request()
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(None, self._get, path, group)
+
+        if response.status_code == 304:
+            self._back_off(group)
+            return 0
+        if response.status_code != 200:
+            retry_after = response.headers.get('Retry-After')
+            self._back_off(group, float(retry_after) if retry_after else None)
+            response.raise_for_status()
+
+        group['etag'] = response.headers.get('ETag')
+        posts = [x['data'] for x in response.json()['data']['children']]
+        if not posts:
+            self._back_off(group)
+            return 0
+
+        # Listings are newest first, the queue gets the oldest first.
+        group['before'] = posts[0]['name']
+        group['interval'] = self._interval
+        for post in reversed(posts):
+            await self._put_message(self._to_message(post))
+        # Only once the posts are on the queue, or a crash while it is full
+        # would skip them after a restart.
+        self.save_checkpoint(**{path: {'before': group['before'],
+                                       'etag': group['etag']}})
+        return len(posts)
+
+    async def poll(self):
+        """Poll the groups that are due.
+
+        :return: number of new posts (type=int)
+        """
+        if not self._restored:
+            checkpoint = self.checkpoint
+            for path, group in self._groups.items():
+                group.update(checkpoint.get(path, {}))
+            self._restored = True
+
+        posts = 0
+        polled = 0
+        errors = []
+        now = time.monotonic()
+        for path, group in self._groups.items():
+            if group['due'] > now:
+                continue
+            polled += 1
+            try:
+                posts += await self._poll_group(path, group)
+            except (requests.RequestException, ValueError) as error:
+                self._logger.warning(f'Polling {path} failed: {error}')
+                self._back_off(group)
+                errors.append(error)
+            # Jitter, so groups backing off alike spread out.
+            group['due'] = time.monotonic() + group['interval'] * \
+                random.uniform(0.9, 1.1)
+
+        if polled and len(errors) == polled:
+            raise errors[-1]
+        return posts
+
+    async def execution_loop(self):
+        """Poll every group when it is due, until interrupted.
+        """
+        try:
+            while True:
+                try:
+                    await self.poll()
+                except (requests.RequestException, ValueError):
+                    # Failed groups were logged and back off by themselves.
+                    pass
+                due = min(x['due'] for x in self._groups.values())
+                await asyncio.sleep(max(0.0, due - time.monotonic()))
+        finally:
+            self.close()
+
+    def close(self):
+        self._session.close()
+
+
+class TCPInputProcess(InputProcess):
+    """Receives the messages of TCPHandlers of other Semaphores.
+
+    Every batch is acknowledged once its messages are on the queue, and a
+    batch that was received before is acknowledged without putting it
+    again, see semaphore.transport. Listen on other hosts than localhost
+    only with a secret, and with TLS on networks that are not trusted.
+    """
+    def __init__(self, name, queue, logger, host='127.0.0.1', port=0,
+                 secret=None, ssl=None, max_frame_size=MAX_FRAME_SIZE):
+        """
+        :param name: name of the input process (type=str)
+        :param queue: queue to put the messages on (type=MessageQueue)
+        :param logger: logger of the Semaphore (type=logging.Logger)
+        :param host: host to listen on (type=str)
+        :param port: port to listen on, 0 picks a free port (type=int)
+        :param secret: secret the senders share, any sender is accepted if
+            None (type=str)
+        :param ssl: server context to accept TLS connections with
+            (type=ssl.SSLContext)
+        :param max_frame_size: maximum bytes of a batch, before and after
+            decompressing (type=int)
+        """
+        super().__init__(name, queue, logger)
+        self._host = host
+        self._secret = secret
+        self._ssl = ssl
+        self._max_frame_size = max_frame_size
+        #: Port listening on, the picked one once listening
+        self.port = port
+        #: Sequence number of the last batch put, by sender
+        self._sequences = dict()
+
+    def __repr__(self):
+        return f'TCPInputProcess {self._name} on {self._host}:{self.port}'
+
+    async def _receive(self, reader, writer):
+        """Put the batches of a sender on the queue.
+        """
+        try:
+            challenge = new_challenge()
+            writer.write(challenge)
+            _, flags, payload = await read_frame(reader, MAX_HELLO_SIZE)
+            if not flags & HELLO:
+                self._logger.warning(f'{self._name} got a batch from an '
+                                     f'unknown sender')
+                return
+            sender = decode_hello(payload, challenge, self._secret)
+            writer.write(ACK.pack(0))
+
+            while True:
+                sequence, _, payload = await read_frame(
+                    reader, self._max_frame_size)
+                if sequence > self._sequences.get(sender, 0):
+                    # Decode the whole batch first, so an invalid one puts
+                    # nothing.
+                    for message in unpack_json(payload):
+                        await self._put_message(message)
+                    self._sequences[sender] = sequence
+                writer.write(ACK.pack(sequence))
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError):
+            # The sender sends the unacknowledged batches again.
+            pass
+        except (ValueError, RecursionError) as error:
+            peer = writer.get_extra_info('peername')
+            self._logger.warning(f'{self._name} closed the connection of '
+                                 f'{peer}: {error}')
+        finally:
+            writer.close()
+
+    async def execution_loop(self):
+        """Listen for senders until interrupted.
+        """
+        server = await asyncio.start_server(self._receive, self._host,
+                                            self.port, ssl=self._ssl)
+        self.port = server.sockets[0].getsockname()[1]
+        self._logger.info(f'{self._name} listening on {self._host}:'
+                          f'{self.port}')
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+
+
+#: Middleware instance of a worker process in a process pool
+_worker_middleware = None
+
+
+def _init_worker(middleware):
+    """Keep the middleware in the worker process, so it is pickled once.
+    """
+    global _worker_middleware
+    _worker_middleware = middleware
+
+
+def _process_in_worker(messages):
+    """Process a batch of messages in a worker process.
+    """
+    return _worker_middleware.process_batch(messages)
 
 
 # TODO: blank middle-process.
 class MiddlewareProcess(Process):
-    """
+    """Stage between the inputs and the output that processes messages.
+
+    Semaphore runs an ordered chain of middleware stages. Each stage can
+    run several workers concurrently, which helps when process_message
+    awaits slow I/O. All workers share one event loop, so CPU-bound work
+    should set processes to run process_message in a process pool, or run
+    the Semaphore with a ShardedRuntime, see semaphore.runtime.
 
-    We only support one middleware layer as we do not do multi-core
-    concurrency, meaning that splitting up a process without blocking
-    API calls will not result any significant speedup.
+    Subclasses implement process_message, or process_batch to process
+    several messages at once, e.g. for vectorized scoring.
     """
-    def __init__(self, input_queue, output_queue, logger):
+    def __init__(self, input_queue, output_queue, logger, workers=1,
+                 ordered=True, processes=None, batch_size=None,
+                 batch_timeout=0):
         """
+        :param input_queue: queue to get messages from (type=MessageQueue)
+        :param output_queue: queue to put messages on (type=MessageQueue)
+        :param logger: logger of the Semaphore (type=logging.Logger)
+        :param workers: number of messages processed concurrently (type=int)
+        :param ordered: keep the order of the input queue, otherwise messages
+            are passed on as soon as they are processed (type=bool)
+        :param processes: number of worker processes to run process_message
+            in, 0 for one per core, None to run it on the event loop
+            (type=int)
+        :param batch_size: maximum number of messages processed at once,
+            defaults to 64 with process_batch or a process pool and to 1
+            otherwise (type=int)
+        :param batch_timeout: seconds to wait for a batch to fill up, a
+            batch is processed when it is full or the time is up
+            (type=float)
         """
         super().__init__(logger)
+        if workers < 1:
+            raise ValueError('A middleware process needs at least one worker')
+        if processes is not None and \
+                (inspect.iscoroutinefunction(self.process_message) or
+                 inspect.iscoroutinefunction(self.process_batch)):
+            raise TypeError('A coroutine cannot run in a process pool')
+
         self._input_queue = input_queue
         self._output_queue = output_queue
+        #: Number of concurrent workers
+        self._workers = workers
+        #: Whether the order of messages is preserved
+        self._ordered = ordered
+        #: Number of worker processes, None if running on the event loop
+        self._processes = processes
+        #: Whether a subclass processes batches itself
+        self._batched = (type(self).process_batch is not
+                         MiddlewareProcess.process_batch)
+        if batch_size is None:
+            batch_size = 64 if self._batched or processes is not None else 1
+        #: Maximum number of messages per batch
+        self._batch_size = batch_size
+        #: Seconds to wait for a batch to fill up
+        self._batch_timeout = batch_timeout
+        #: Process pool, created when the execution loop starts
+        self._pool = None
+        #: Sequence number of the next batch taken from the input queue
+        self._sequence_in = 0
+        #: Sequence number of the next batch to put on the output queue
+        self._sequence_out = 0
+        #: Processed batches waiting for their turn, by sequence number
+        self._reorder_buffer = dict()
+        #: Serializes filling batches, so batches hold consecutive messages
+        #: and take their sequence numbers in order
+        self._get_lock = None
+        #: Serializes putting messages in order
+        self._put_lock = None
+        #: Name of the stage in the metrics
+        self.name = type(self).__name__
+        #: Metrics of the Semaphore, or None
+        self.metrics = None
 
-    def _get_message(self):
+    def __getstate__(self):
+        """Leave out the queues, locks and pool when sent to a worker.
         """
+        state = self.__dict__.copy()
+        for key in ('_input_queue', '_output_queue', '_lock', '_pool',
+                    '_get_lock', '_put_lock', '_reorder_buffer', 'metrics'):
+            state[key] = None
+        return state
+
+    @property
+    def workers(self):
+        return self._workers
+
+    @property
+    def output_queue(self):
+        return self._output_queue
+
+    @property
+    def ordered(self):
+        return self._ordered
+
+    async def _get_message(self):
+        """Wait for the next message on the input queue.
+        """
+        message = await self._input_queue.get()
+        self._logger.debug(f'Got message {message.body}')
+        return message
+
+    async def _get_batch(self):
+        """Wait for a message, then collect messages until the batch is full
+        or the batch timeout has passed.
         """
-        with self._lock:
+        batch = [await self._get_message()]
+        deadline = asyncio.get_running_loop().time() + self._batch_timeout
+        while len(batch) < self._batch_size:
+            if not self._input_queue.empty():
+                batch.append(self._input_queue.get_nowait())
+                continue
+
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
             try:
-                message = self._input_queue.get(False)
-                self._logger.debug(f'Got message {message.body}')
-                return message
-            except self._input_queue.Empty:
-                raise self._input_queue.Empty
+                batch.append(await asyncio.wait_for(self._get_message(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
 
-    def _put_message(self, message):
+    async def _put_message(self, message):
         """
         """
-        with self._lock:
-            self._logger.debug(f'Putting message {message.body}')
-            self._output_queue.put(message)
-            # TODO: Catch full exception.
+        self._logger.debug(f'Putting message {message.body}')
+        await self._output_queue.put(message)
 
-    def process_message(self, message):
+    async def _put_batch(self, messages):
+        """Put processed messages, skipping the ones that were dropped.
         """
+        for message in messages:
+            if message is not None:
+                await self._put_message(message)
+
+    async def _put_in_order(self, sequence, batch, messages):
+        """Put a processed batch once all earlier batches have been put.
         """
-        return message
+        self._reorder_buffer[sequence] = (batch, messages)
+        async with self._put_lock:
+            while self._sequence_out in self._reorder_buffer:
+                batch, messages = self._reorder_buffer.pop(self._sequence_out)
+                self._sequence_out += 1
+                await self._put_batch(messages)
+                self._done(batch)
 
-    async def execution_loop(self):
+    def _done(self, batch):
+        """Acknowledge a batch taken from the input queue once the processed
+        messages have been put on the output queue.
         """
+        for message in batch:
+            self._input_queue.ack(message)
+            self._input_queue.task_done()
+
+    def process_message(self, message):
+        """Process a single message, to be overridden by subclasses.
+
+        This can also be a coroutine. Return None to drop the message.
+        """
+        return message
+
+    def process_batch(self, messages):
+        """Process a list of messages, to be overridden by subclasses.
+
+        This can also be a coroutine. Return a list of processed messages,
+        dropped messages can be left out or set to None. The default calls
+        process_message for every message.
         """
+        return [self.process_message(x) for x in messages]
+
+    async def _process(self, message):
+        message = self.process_message(message)
+        if inspect.isawaitable(message):
+            message = await message
+        return message
+
+    async def _process_batch(self, messages):
+        if self._pool is not None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, _process_in_worker,
+                                              messages)
+
+        if self._batched:
+            messages = self.process_batch(messages)
+            if inspect.isawaitable(messages):
+                messages = await messages
+            return messages
+        return [await self._process(x) for x in messages]
+
+    async def _worker_loop(self):
         while True:
+            async with self._get_lock:
+                batch = await self._get_batch()
+                sequence = self._sequence_in
+                self._sequence_in += 1
+
+            metrics = self.metrics
+            profiler = profiling.profiler
+            if metrics is not None:
+                metrics.increment(self.name, IN, len(batch))
+            if profiler is not None:
+                started = profiler.start(profiling.PROCESS, self.name, batch)
+
             try:
-                message = self._get_message()
-                message = self.process_message(message)
-                self._put_message(message)
-            except self._input_queue.Empty:
-                await time.sleep(1)
+                messages = await self._process_batch(batch)
+            except Exception:
+                if metrics is not None:
+                    metrics.increment(self.name, ERRORS, len(batch))
+                raise
 
+            if profiler is not None:
+                profiler.stop(profiling.PROCESS, self.name, batch, started)
+                if len(messages) == len(batch):
+                    for message, processed in zip(batch, messages):
+                        profiler.replace(message, processed)
+            if metrics is not None:
+                processed = sum(1 for x in messages if x is not None)
+                metrics.increment(self.name, OUT, processed)
+                metrics.increment(self.name, FILTERED,
+                                  max(0, len(batch) - processed))
 
-# TODO: sentiment middle-process.
+            if self._ordered:
+                await self._put_in_order(sequence, batch, messages)
+            else:
+                await self._put_batch(messages)
+                self._done(batch)
+
+            # A queue that is never empty does not suspend on get, so we
+            # yield explicitly to keep the other stages running.
+            await asyncio.sleep(0)
+
+    async def execution_loop(self):
+        """Run the workers of this stage until interrupted.
+        """
+        self._get_lock = asyncio.Lock()
+        self._put_lock = asyncio.Lock()
+        workers = self._workers
+
+        if self._processes is not None:
+            processes = self._processes or os.cpu_count()
+            self._pool = ProcessPoolExecutor(processes,
+                                             initializer=_init_worker,
+                                             initargs=(self,))
+            # Keep two batches in flight per process, so a process never
+            # waits for the event loop to hand it the next batch.
+            workers = max(workers, 2 * processes)
 
+        try:
+            await asyncio.gather(*[self._worker_loop()
+                                   for _ in range(workers)])
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
 
-def output_message(handler):
-    """Coroutine to emit messages using handlers without creating threads.
+
+def build_chain(stages, input_queue, output_queue, logger, make_queue):
+    """Instantiate a chain of middleware stages.
+
+    :param stages: stages as (subclass of MiddlewareProcess, keyword
+        arguments), in order (type=list)
+    :param input_queue: queue of the first stage (type=MessageQueue)
+    :param output_queue: queue the last stage puts on (type=MessageQueue)
+    :param logger: logger of the Semaphore (type=logging.Logger)
+    :param make_queue: function returning the queue between two stages,
+        called with the name of the first (type=callable)
+    :return: the middleware processes (type=list)
     """
-    while True:
-        message = (yield)
-        handler.emit(message)
+    chain = []
+    for index, (middleware_process, kwargs) in enumerate(stages):
+        name = f'middleware-{index}'
+        if index == len(stages) - 1:
+            stage_output_queue = output_queue
+        else:
+            stage_output_queue = make_queue(name)
+        middleware = middleware_process(input_queue, stage_output_queue,
+                                        logger, **kwargs)
+        middleware.name = name
+        chain.append(middleware)
+        input_queue = stage_output_queue
+    return chain
+
+
+# TODO: sentiment middle-process.
 
 
 class OutputProcess(Process):
-    """
+    """Fan out messages from the output queue to the handlers.
+
+    Every handler has its own queue and task, so a slow or hanging handler
+    only holds up its own messages. A batch a handler failed to emit is put
+    back on its queue after a delay that grows with every attempt, up to the
+    retries of the handler, after which its messages are dead letters.
     """
     def __init__(self, queue, logger):
         """
         """
         super().__init__(logger)
         self._queue = queue
-        self._output_handlers = set()  # TODO: name : instance dict?
+        #: Queue of every handler, by handler
+        self._output_handlers = dict()
+        #: Messages being emitted as [message, handlers left, succeeded],
+        #: by id, so they can be acknowledged once every handler is done
+        self._emitting = dict()
+        #: Metrics of the Semaphore, or None
+        self.metrics = None
+        #: Store of the messages that failed every retry, or None
+        self.dead_letters = None
+        #: Times every message failed to emit, by handler and message id
+        self._attempts = dict()
+        #: Tasks putting failed batches back on the queue of their handler
+        self._retries = set()
 
-    def _get_message(self):
-        """
+    async def _get_message(self):
+        """Wait for the next message on the output queue.
         """
-        with self._lock:
-            try:
-                return self._queue.get(False)
-            except self._queue.Empty:
-                raise  self._queue.Empty
+        return await self._queue.get()
 
     @property
     def handlers(self):
         return list(self._output_handlers)
 
-    def add_handler(self, handler):
-        if handler in self._output_handlers:
-            pass
-        else:
-            self._output_handlers.add(handler)
+    @property
+    def queues(self):
+        """Queue of every handler, by handler."""
+        return dict(self._output_handlers)
+
+    @property
+    def dropped(self):
+        """Number of messages dropped by each handler queue."""
+        return {x.name: queue.dropped
+                for x, queue in self._output_handlers.items()}
+
+    def add_handler(self, handler, queue_size=0, queue_policy=BLOCK):
+        """Add a handler with its own queue.
+
+        :param handler: handler to emit messages with (type=Handler)
+        :param queue_size: maximum number of messages waiting for the
+            handler, 0 is unbounded (type=int)
+        :param queue_policy: policy when the queue is full, a blocking queue
+            holds up all handlers (type=str)
+        """
+        if handler not in self._output_handlers:
+            queue = MessageQueue(queue_size, queue_policy)
+            queue.on_drop = functools.partial(self._dropped, handler)
+            self._output_handlers[handler] = queue
 
     def delete_handler(self, handler):
-        self._output_handlers.remove(handler)
+        del self._output_handlers[handler]
 
-    async def execution_loop(self):
+    async def _handler_loop(self, handler, queue):
+        """Emit the messages in the queue of a handler.
+
+        Messages that queue up while the handler is throttled are emitted
+        as one batch. The handler is flushed every flush_interval, whether
+        it is idle or busy.
+        """
+        flushed = time.monotonic()
+        while True:
+            timeout = None
+            if handler.flush_interval is not None:
+                timeout = max(0.0, flushed + handler.flush_interval
+                              - time.monotonic())
+            try:
+                message = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await handler.handle_flush()
+                flushed = time.monotonic()
+                continue
+
+            messages = [message]
+            await handler.throttle()
+            while len(messages) < handler.max_batch and not queue.empty():
+                messages.append(queue.get_nowait())
+
+            started = time.monotonic()
+            profiler = profiling.profiler
+            if profiler is not None:
+                stage = f'handler {handler.name}'
+                profiled = profiler.start(profiling.EMIT, stage, messages)
+            error = None
+            emitted = len(messages)
+            try:
+                await handler.handle_batch(messages)
+            except Exception as exception:
+                error = exception
+                emitted = 0
+                if isinstance(exception, PartialEmitError):
+                    # Only the messages that were not emitted are retried.
+                    error = exception.error
+                    emitted = exception.emitted
+                self._logger.exception(f'Handler {handler.name} failed to '
+                                       f'emit {len(messages) - emitted} '
+                                       f'messages')
+            if profiler is not None:
+                profiler.stop(profiling.EMIT, stage, messages, profiled)
+            if self.metrics is not None:
+                self._measure(handler, messages, emitted,
+                              time.monotonic() - started)
+            for _ in messages:
+                queue.task_done()
+            for message in messages[:emitted]:
+                self._attempts.pop((handler, id(message)), None)
+                self._emitted(message)
+            if error is not None:
+                await self._failed(handler, queue, messages[emitted:], error)
+
+            # A steady trickle of messages never times out the get above.
+            if handler.flush_interval is not None and \
+                    time.monotonic() - flushed >= handler.flush_interval:
+                await handler.handle_flush()
+                flushed = time.monotonic()
+
+            await asyncio.sleep(0)
+
+    def _measure(self, handler, messages, emitted, duration):
+        stage = f'handler {handler.name}'
+        self.metrics.increment(stage, IN, len(messages))
+        self.metrics.observe(EMIT_LATENCY, stage, duration)
+        if emitted < len(messages):
+            self.metrics.increment(stage, ERRORS, len(messages) - emitted)
+        if not emitted:
+            return
+
+        self.metrics.increment(stage, OUT, emitted)
+        now = time.time()
+        for message in messages[:emitted]:
+            seconds = latency(message.timestamp, now)
+            if seconds is not None:
+                self.metrics.observe(END_TO_END_LATENCY, stage, seconds)
+
+    async def _failed(self, handler, queue, messages, error):
+        """Retry the messages of a failed batch, or store them as dead
+        letters once they failed every retry.
         """
+        retry = []
+        dead = []
+        attempts = 0
+        for message in messages:
+            key = (handler, id(message))
+            self._attempts[key] = self._attempts.get(key, 0) + 1
+            if self._attempts[key] <= handler.retries:
+                retry.append(message)
+                attempts = max(attempts, self._attempts[key])
+            else:
+                dead.append(message)
+                del self._attempts[key]
+
+        stage = f'handler {handler.name}'
+        if retry:
+            delay = min(handler.max_retry_delay,
+                        handler.retry_delay * 2 ** (attempts - 1))
+            # Jitter spreads the retries of handlers that failed together.
+            delay = random.uniform(delay / 2, delay)
+            self._logger.info(f'Retrying {len(retry)} messages of handler '
+                              f'{handler.name} in {delay:.1f} seconds')
+            task = asyncio.ensure_future(self._retry(queue, retry, delay))
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+            if self.metrics is not None:
+                self.metrics.increment(stage, RETRIED, len(retry))
+
+        if dead:
+            stored = False
+            if self.dead_letters is not None:
+                loop = asyncio.get_running_loop()
+                try:
+                    await loop.run_in_executor(
+                        None, self.dead_letters.add, handler.name, dead,
+                        error, handler.retries + 1)
+                    stored = True
+                except OSError:
+                    self._logger.exception(f'Failed to store {len(dead)} '
+                                           f'dead letters of handler '
+                                           f'{handler.name}')
+            if stored and self.metrics is not None:
+                self.metrics.increment(stage, DEAD_LETTERS, len(dead))
+            for message in dead:
+                # A stored dead letter is safe, so it is acknowledged.
+                self._emitted(message, stored)
+
+    async def _retry(self, queue, messages, delay):
+        """Put failed messages back on the queue of their handler.
+        """
+        await asyncio.sleep(delay)
+        for message in messages:
+            await queue.put(message)
+
+    def _dropped(self, handler, message):
+        """Give up on a message dropped by the queue of a handler.
+        """
+        self._attempts.pop((handler, id(message)), None)
+        self._emitted(message)
+
+    def _emitted(self, message, succeeded=True):
+        """Acknowledge a message once every handler emitted it.
+
+        A message a handler failed to emit is not acknowledged, so a durable
+        output queue replays it after a restart.
         """
-        # Set up coroutines for all handlers.
-        handler_coroutines = [output_message(x) for x in self._output_handlers]
+        emitting = self._emitting[id(message)]
+        emitting[1] -= 1
+        emitting[2] = emitting[2] and succeeded
+        if emitting[1] == 0:
+            del self._emitting[id(message)]
+            if profiling.profiler is not None:
+                profiling.profiler.end(message)
+            if emitting[2]:
+                self._queue.ack(message)
 
-        # Get messages from the queue.
+    async def _fan_out(self):
         while True:
-            try:
-                message = self._get_message()
-                self._logger.debug(f'Posting {message.body}')
-                for coroutine in handler_coroutines:
-                    coroutine.send(message)
-            except self._queue.Empty:
-                await time.sleep(1)
+            message = await self._get_message()
+            self._logger.debug(f'Posting {message.body}')
+            self._emitting[id(message)] = [message,
+                                           len(self._output_handlers), True]
+            for queue in self._output_handlers.values():
+                await queue.put(message)
+            self._queue.task_done()
+
+            await asyncio.sleep(0)
+
+    async def execution_loop(self):
+        """
+        """
+        handler_loops = [self._handler_loop(x, queue)
+                         for x, queue in self._output_handlers.items()]
+        try:
+            await asyncio.gather(self._fan_out(), *handler_loops)
+        finally:
+            # Messages waiting for a retry are not acknowledged, so a
+            # durable output queue replays them after a restart.
+            for task in list(self._retries):
+                task.cancel()
+            # Flush and close the handlers when the Semaphore stops.
+            for handler in self._output_handlers:
+                handler.close()
+
+
+class CheckpointProcess(Process):
+    """Periodically writes the checkpoints of the input processes.
+    """
+    def __init__(self, checkpoint_store, logger):
+        """
+        """
+        super().__init__(logger)
+        self._checkpoint_store = checkpoint_store
+
+    async def execution_loop(self):
+        """
+        """
+        try:
+            while True:
+                await asyncio.sleep(self._checkpoint_store.flush_interval)
+                self._checkpoint_store.flush()
+        finally:
+            self._checkpoint_store.flush()
+
+
+class MetricsProcess(Process):
+    """Serves the metrics, and passes them to the callbacks every interval.
+    """
+    def __init__(self, metrics, logger):
+        """
+        """
+        super().__init__(logger)
+        self._metrics = metrics
+
+    async def execution_loop(self):
+        """
+        """
+        server = None
+        if self._metrics.port is not None:
+            server = await self._metrics.serve()
+            self._logger.info(f'Serving metrics on '
+                              f'{self._metrics.host}:{self._metrics.port}')
+        try:
+            while True:
+                await asyncio.sleep(self._metrics.interval)
+                self._metrics.report()
+        finally:
+            if server is not None:
+                server.close()
+
+
+class SchedulerProcess(Process):
+    """Polls the input processes that implement poll with a PollScheduler.
+    """
+    def __init__(self, scheduler, input_processes, logger):
+        """
+        """
+        super().__init__(logger)
+        self._scheduler = scheduler
+        self._input_processes = input_processes
+
+    async def execution_loop(self):
+        """Poll until interrupted, then close the input processes.
+        """
+        try:
+            await self._scheduler.run(self._input_processes, self._logger)
+        finally:
+            for input_process in self._input_processes:
+                input_process.close()
 
 
 class SemaphoreTimeLimitInterrupt(Exception):
@@ -214,13 +1133,7 @@ class TimeLimitProcess(Process):
     async def execution_loop(self):
         """
         """
-        start_time = time.time()
-        while True:
-            time_left = self._time_limit - (time.time() - start_time)
-            if time_left >= 0:
-                raise SemaphoreTimeLimitInterrupt('Finished after {}s'.format(
-                    self._time_limit))
-            else:
-                self._logger.debug(f'Still {time_left}s left')
-
-            await time.sleep(1)
+        self._logger.debug(f'Stopping after {self._time_limit}s')
+        await asyncio.sleep(self._time_limit)
+        raise SemaphoreTimeLimitInterrupt('Finished after {}s'.format(
+            self._time_limit))
@@ -0,0 +1,242 @@
+"""Profiling of the hot path of a Semaphore.
+
+A Profiler times every call of the topic filters, the middleware, the
+formatters and the handlers, labelled with the stage, and calls hooks before
+and after each of them. Messages that take longer than a threshold from the
+topic filter to their last emit are traced, with the time every step took.
+A SamplingProfiler samples the stacks of all threads, and can be toggled on
+demand while the Semaphore runs.
+
+Call sites check the module-level profiler, which is None while profiling is
+disabled, so it costs a single lookup per call.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+#: Steps of the hot path
+FILTER = 'filter'
+PROCESS = 'process'
+FORMAT = 'format'
+EMIT = 'emit'
+
+STEPS = (FILTER, PROCESS, FORMAT, EMIT)
+
+#: The enabled profiler, or None
+profiler = None
+
+
+def enable(new_profiler):
+    """Profile the hot path with a profiler.
+    """
+    global profiler
+    profiler = new_profiler
+
+
+def disable():
+    global profiler
+    profiler = None
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads from a background thread.
+
+    Stacks are counted in the collapsed format of flame graph tools, from
+    the outermost to the innermost function.
+    """
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between samples (type=float)
+        """
+        self.interval = interval
+        #: Number of samples of every stack
+        self.stacks = collections.Counter()
+        #: Number of samples taken
+        self.samples = 0
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __repr__(self):
+        return f'SamplingProfiler with {self.samples} samples'
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{os.path.basename(code.co_filename)}:'
+                                 f'{code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True,
+                                            name='sampling-profiler')
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self):
+        """The samples in the collapsed format, one stack per line.
+        """
+        return '\n'.join(f'{stack} {count}'
+                         for stack, count in self.stacks.most_common())
+
+    def top(self, count=10):
+        """The functions that were sampled most often, innermost first.
+
+        :return: (function, fraction of samples) pairs (type=list)
+        """
+        functions = collections.Counter()
+        for stack, samples in self.stacks.items():
+            functions[stack.rsplit(';', 1)[-1]] += samples
+        total = sum(functions.values()) or 1
+        return [(x, y / total) for x, y in functions.most_common(count)]
+
+
+class Profiler:
+    """Times the steps of the hot path and traces slow messages.
+    """
+    def __init__(self, slow_threshold=None, max_traces=100,
+                 sampling_interval=0.005):
+        """
+        :param slow_threshold: seconds from the topic filter to the last
+            emit above which a message is traced, no tracing if None
+            (type=float)
+        :param max_traces: number of slow messages kept (type=int)
+        :param sampling_interval: seconds between samples of the sampling
+            profiler (type=float)
+        """
+        self._slow_threshold = slow_threshold
+        #: Hooks called before and after every step, by step
+        self._before = {x: [] for x in STEPS}
+        self._after = {x: [] for x in STEPS}
+        #: Timings as [calls, total seconds, maximum seconds], by step and
+        #: stage
+        self._timings = dict()
+        #: Traces of messages on their way, by id
+        self._open_traces = collections.OrderedDict()
+        self._max_open_traces = 10000
+        #: Traces of slow messages, the latest last
+        self.traces = collections.deque(maxlen=max_traces)
+        #: Sampling profiler, running while toggled on
+        self.sampling = SamplingProfiler(sampling_interval)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'Profiler with {len(self.traces)} slow messages'
+
+    def add_hook(self, step, before=None, after=None):
+        """Call functions before and after a step.
+
+        Before hooks are called with the step, the stage and the messages,
+        after hooks also with the seconds the step took.
+        """
+        if step not in STEPS:
+            raise ValueError(f'Unknown step {step}')
+        if before is not None:
+            self._before[step].append(before)
+        if after is not None:
+            self._after[step].append(after)
+
+    def toggle_sampling(self):
+        """Start the sampling profiler, or stop it if it is running.
+        """
+        if self.sampling.running:
+            self.sampling.stop()
+        else:
+            self.sampling.start()
+
+    @property
+    def timings(self):
+        """Calls, total and maximum seconds of every step, by step and
+        stage."""
+        with self._lock:
+            return {key: {'calls': calls, 'total': total, 'max': maximum}
+                    for key, (calls, total, maximum)
+                    in self._timings.items()}
+
+    def begin(self, message):
+        """Start the trace of a message entering the Semaphore.
+        """
+        if self._slow_threshold is None:
+            return
+        with self._lock:
+            self._open_traces[id(message)] = (time.perf_counter(), [])
+            if len(self._open_traces) > self._max_open_traces:
+                # Messages dropped by a queue are never finished.
+                self._open_traces.popitem(last=False)
+
+    def start(self, step, stage, messages):
+        """Call the before hooks of a step and start timing it.
+
+        :return: the start time, to pass to stop (type=float)
+        """
+        for hook in self._before[step]:
+            hook(step, stage, messages)
+        return time.perf_counter()
+
+    def stop(self, step, stage, messages, started):
+        """Record the time a step took and call its after hooks.
+        """
+        seconds = time.perf_counter() - started
+        with self._lock:
+            timing = self._timings.get((step, stage))
+            if timing is None:
+                timing = self._timings[step, stage] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            if self._open_traces:
+                for message in messages:
+                    trace = self._open_traces.get(id(message))
+                    if trace is not None:
+                        trace[1].append((step, stage, seconds))
+        for hook in self._after[step]:
+            hook(step, stage, messages, seconds)
+
+    def replace(self, message, replacement):
+        """Carry on the trace of a message with the message that replaced
+        it, or end it if the message was dropped.
+        """
+        if not self._open_traces or message is replacement:
+            return
+        with self._lock:
+            trace = self._open_traces.pop(id(message), None)
+            if trace is not None and replacement is not None:
+                self._open_traces[id(replacement)] = trace
+
+    def end(self, message):
+        """End the trace of a message, keeping it if the message was slow.
+        """
+        if not self._open_traces:
+            return
+        with self._lock:
+            trace = self._open_traces.pop(id(message), None)
+        if trace is None:
+            return
+
+        started, steps = trace
+        total = time.perf_counter() - started
+        if total >= self._slow_threshold:
+            self.traces.append({'message': message.to_dict(),
+                                'total': total,
+                                'steps': steps})
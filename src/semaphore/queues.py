@@ -0,0 +1,284 @@
+"""Queues connecting the stages of a Semaphore.
+
+A MessageQueue is an asyncio queue with an optional maximum size and a policy
+that decides what happens when a message is put on a full queue. The policy
+is picked per stage, so a slow output can either slow down the inputs or shed
+load, while the memory use of the queue stays bounded.
+
+A FairQueue also orders the messages by their priority, and serves the
+sources of the messages in turns, so a busy input cannot bury the messages
+of a quiet one.
+"""
+
+import asyncio
+import collections
+import random
+
+#: Wait for a free slot, slowing down the producer
+BLOCK = 'block'
+#: Drop the message that is being put
+DROP_NEWEST = 'drop_newest'
+#: Drop the oldest message in the queue to make room
+DROP_OLDEST = 'drop_oldest'
+#: Keep a uniform random sample of the messages offered while full
+SAMPLE = 'sample'
+
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST, SAMPLE)
+
+
+class MessageQueue(asyncio.Queue):
+    """Bounded asyncio queue with a configurable load-shedding policy.
+    """
+    def __init__(self, maxsize=0, policy=BLOCK):
+        """Initialize the queue.
+
+        :param maxsize: maximum number of queued messages, 0 is unbounded
+            (type=int)
+        :param policy: what to do when the queue is full, one of POLICIES
+            (type=str)
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown queue policy {policy}')
+        super().__init__(maxsize)
+
+        #: Policy applied when the queue is full
+        self._policy = policy
+        #: Number of messages dropped because the queue was full
+        self.dropped = 0
+        #: Messages offered since the queue became full, used for sampling
+        self._overflow = 0
+        #: Function called with every dropped message, or None
+        self.on_drop = None
+
+    def __repr__(self):
+        return (f'MessageQueue with {self.qsize()}/{self.maxsize} messages '
+                f'and policy \'{self._policy}\'')
+
+    @property
+    def policy(self):
+        return self._policy
+
+    async def put(self, item):
+        """Put a message on the queue, applying the policy if it is full.
+
+        Only the blocking policy ever waits for a free slot.
+        """
+        if self._policy == BLOCK:
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item):
+        """Put a message on the queue without waiting.
+
+        With the blocking policy this raises asyncio.QueueFull when the queue
+        is full, the other policies drop a message instead.
+        """
+        if self._policy == BLOCK or not self.full():
+            self._overflow = 0
+            super().put_nowait(item)
+            return
+
+        self.dropped += 1
+        if self._policy == DROP_OLDEST:
+            dropped = self._drop_oldest()
+            super().put_nowait(item)
+        elif self._policy == SAMPLE:
+            # Reservoir sampling over the burst: the n-th message offered
+            # since the queue filled up is kept with probability maxsize / n.
+            self._overflow += 1
+            if random.random() * (self.maxsize + self._overflow) < self.maxsize:
+                dropped = self._replace_random(item)
+            else:
+                dropped = item
+        else:
+            dropped = self._drop_newest(item)
+
+        if self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def ack(self, message):
+        """Acknowledge that the next stage is done with a message taken from
+        the queue. Only durable queues keep track of this.
+        """
+
+    def close(self):
+        """Release the resources of the queue.
+        """
+
+    def _drop_newest(self, item):
+        """Drop the message that is being put and return it.
+        """
+        return item
+
+    def _drop_oldest(self):
+        """Remove the oldest message and return it.
+        """
+        item = self._get()
+        self.task_done()
+        return item
+
+    def _replace_random(self, item):
+        """Replace a random message and return it.
+        """
+        index = random.randrange(len(self._queue))
+        replaced = self._queue[index]
+        self._queue[index] = item
+        return replaced
+
+
+class _Level:
+    """Messages of one priority, queued per source and served by deficit
+    round robin.
+    """
+    __slots__ = ('queues', 'active', 'credits', 'size')
+
+    def __init__(self):
+        #: Messages of every source with messages, oldest first
+        self.queues = dict()
+        #: Sources with messages, in the order they are served
+        self.active = collections.deque()
+        #: Messages every active source may still take in its turn
+        self.credits = dict()
+        #: Number of messages of all sources
+        self.size = 0
+
+
+class _FairBuffer:
+    """Buffer of a FairQueue, in place of the deque of an asyncio.Queue.
+    """
+    def __init__(self, weights):
+        self._weights = weights
+        #: Levels with messages, by priority
+        self._levels = dict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for priority in sorted(self._levels, reverse=True):
+            for messages in self._levels[priority].queues.values():
+                yield from messages
+
+    def append(self, message):
+        priority = message.priority
+        level = self._levels.get(priority)
+        if level is None:
+            level = self._levels[priority] = _Level()
+        source = message.source
+        messages = level.queues.get(source)
+        if messages is None:
+            messages = level.queues[source] = collections.deque()
+            level.active.append(source)
+            level.credits[source] = 0
+        messages.append(message)
+        level.size += 1
+        self._size += 1
+
+    def popleft(self):
+        """Take the next message of the highest priority level.
+        """
+        priority = max(self._levels)
+        level = self._levels[priority]
+        source = level.active[0]
+        if level.credits[source] <= 0:
+            level.credits[source] += self._weights.get(source, 1)
+        messages = level.queues[source]
+        message = messages.popleft()
+        level.credits[source] -= 1
+        if not messages:
+            # An idle source does not save up credit for later.
+            level.active.popleft()
+            del level.queues[source], level.credits[source]
+        elif level.credits[source] <= 0:
+            level.active.rotate(-1)
+        self._remove(priority, level)
+        return message
+
+    def _longest(self):
+        """The lowest priority level and its source with the most messages.
+        """
+        priority = min(self._levels)
+        level = self._levels[priority]
+        source = max(level.queues, key=lambda x: len(level.queues[x]))
+        return priority, level, source
+
+    def _remove(self, priority, level):
+        level.size -= 1
+        self._size -= 1
+        if not level.size:
+            del self._levels[priority]
+
+    def pop_longest(self, index=0):
+        """Remove a message of the longest backlog at the lowest priority.
+        """
+        priority, level, source = self._longest()
+        messages = level.queues[source]
+        message = messages[index]
+        del messages[index]
+        if not messages:
+            level.active.remove(source)
+            del level.queues[source], level.credits[source]
+        self._remove(priority, level)
+        return message
+
+    def drops_first(self, message):
+        """Whether a message would be in the longest backlog of the lowest
+        priority.
+        """
+        priority, level, source = self._longest()
+        if message.priority != priority:
+            return message.priority < priority
+        messages = level.queues.get(message.source, ())
+        return len(messages) + 1 >= len(level.queues[source])
+
+    def longest_size(self):
+        priority, level, source = self._longest()
+        return len(level.queues[source])
+
+
+class FairQueue(MessageQueue):
+    """MessageQueue serving messages by priority, and fairly across sources.
+
+    Messages with a higher priority are always taken first. Within a
+    priority, the sources take turns by deficit round robin: a source takes
+    as many messages per turn as its weight, so a busy source cannot hold up
+    a quiet one. When the queue is full, the drop policies drop from the
+    longest backlog of the lowest priority, so DROP_NEWEST only drops the
+    message that is being put if it belongs to that backlog.
+    """
+    def __init__(self, maxsize=0, policy=BLOCK, weights=None):
+        """Initialize the queue.
+
+        :param weights: messages a source takes per turn, by source, 1 for
+            sources that are not in it (type=dict)
+        """
+        #: Weight of every source
+        self.weights = dict(weights or {})
+        super().__init__(maxsize, policy)
+
+    def __repr__(self):
+        return (f'FairQueue with {self.qsize()}/{self.maxsize} messages '
+                f'and policy \'{self._policy}\'')
+
+    def _init(self, maxsize):
+        self._queue = _FairBuffer(self.weights)
+
+    def _drop_newest(self, item):
+        if self._queue.drops_first(item):
+            return item
+        dropped = self._queue.pop_longest(-1)
+        self._queue.append(item)
+        return dropped
+
+    def _drop_oldest(self):
+        item = self._queue.pop_longest()
+        self.task_done()
+        return item
+
+    def _replace_random(self, item):
+        index = random.randrange(self._queue.longest_size())
+        replaced = self._queue.pop_longest(index)
+        self._queue.append(item)
+        return replaced
@@ -0,0 +1,91 @@
+"""Rate limiting for calls to external APIs.
+
+A TokenBucket allows a sustained rate of calls with short bursts. Buckets can
+be shared by key, so every handler posting to the same Slack channel with the
+same token draws from the same bucket.
+"""
+
+import asyncio
+import time
+import weakref
+
+
+class TokenBucket:
+    """Token bucket that refills at a fixed rate up to its capacity.
+    """
+    def __init__(self, rate, capacity=1):
+        """
+        :param rate: tokens added per second (type=float)
+        :param capacity: maximum number of tokens, the size of a burst
+            (type=float)
+        """
+        if rate <= 0:
+            raise ValueError('The rate of a token bucket must be positive')
+
+        #: Tokens added per second
+        self.rate = rate
+        #: Maximum number of tokens
+        self.capacity = capacity
+        #: Tokens available at the last update
+        self._tokens = capacity
+        #: Time of the last update
+        self._updated = time.monotonic()
+
+    def __repr__(self):
+        return (f'TokenBucket with rate {self.rate}/s '
+                f'and capacity {self.capacity}')
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, tokens=1):
+        """Seconds until the tokens are available.
+        """
+        self._refill()
+        return max(0, (tokens - self._tokens) / self.rate)
+
+    def try_acquire(self, tokens=1):
+        """Take the tokens if they are available.
+
+        :return: whether the tokens were taken (type=bool)
+        """
+        self._refill()
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        """Wait until the tokens are available and take them.
+        """
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    def pause(self, seconds):
+        """Empty the bucket so no tokens are available for a while, e.g.
+        after the API asked us to back off.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+#: Buckets shared by key, as long as something uses them
+_buckets = weakref.WeakValueDictionary()
+
+
+def shared_bucket(key, rate, capacity=1):
+    """Get the bucket for a key, creating it if it does not exist yet.
+
+    Raises ValueError if the bucket exists with another rate or capacity.
+    """
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _buckets[key] = TokenBucket(rate, capacity)
+    elif (bucket.rate, bucket.capacity) != (rate, capacity):
+        raise ValueError(f'The bucket of {key} has rate {bucket.rate} and '
+                         f'capacity {bucket.capacity}, not {rate} and '
+                         f'{capacity}')
+    return bucket
@@ -0,0 +1,315 @@
+"""Runtime spreading a Semaphore over several OS processes.
+
+By default a Semaphore runs every stage on one event loop, so it uses a
+single core. With a ShardedRuntime the input processes run in input worker
+processes, and the middleware chain runs in several shard processes, while
+the output handlers stay in the main process:
+
+    inputs (worker 0..n) --> middleware chain (shard 0..m) --> output (main)
+
+Messages are sent between the processes in batches of to_bytes frames over
+multiprocessing queues. Every message goes to the shard picked by a hash of
+its URL, so the shards divide the work. A supervisor in the main process
+restarts the workers when one of them crashed, after a delay that grows
+while they keep crashing. Messages the workers held when they were
+restarted are lost, unless an input replays them itself, e.g. by resuming
+from its checkpoint.
+
+Every input worker has its own deduplicator, request budget and checkpoint
+file, and metrics and profiling only cover the main process.
+"""
+
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from .checkpoint import CheckpointStore
+from .message import pack, unpack
+from .process import (CheckpointProcess, MiddlewareProcess, Process, SchedulerProcess,
+                      build_chain)
+from .queues import MessageQueue
+
+#: Seconds a blocking get on a multiprocessing queue waits, so the thread
+#: doing it notices the runtime stopping
+_GET_TIMEOUT = 0.1
+
+
+def _shard(message, shards):
+    return zlib.crc32((message.url or '').encode()) % shards
+
+
+async def _send(queue, outboxes, batch_size, executor):
+    """Send the messages on a local queue to the outboxes, in batches.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < batch_size and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        by_shard = dict()
+        for message in batch:
+            by_shard.setdefault(_shard(message, len(outboxes)), []) \
+                .append(message)
+        for shard, messages in by_shard.items():
+            # A full outbox blocks the thread, and so holds up the queue.
+            await loop.run_in_executor(executor, outboxes[shard].put,
+                                       pack(messages))
+
+        for message in batch:
+            queue.ack(message)
+            queue.task_done()
+
+
+def _get(inbox):
+    try:
+        return inbox.get(timeout=_GET_TIMEOUT)
+    except queue_module.Empty:
+        return None
+
+
+async def _receive(inbox, queue, executor):
+    """Put the messages arriving in an inbox on a local queue.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await loop.run_in_executor(executor, _get, inbox)
+        if payload is None:
+            continue
+        for message in unpack(payload):
+            await queue.put(message)
+
+
+async def _watch_parent():
+    """Stop a worker process when the main process is gone.
+    """
+    parent = multiprocessing.parent_process()
+    while parent is None or parent.is_alive():
+        await asyncio.sleep(1)
+    raise SystemExit(1)
+
+
+def _run_worker(coroutines):
+    async def main():
+        await asyncio.gather(_watch_parent(), *coroutines())
+
+    asyncio.run(main())
+
+
+def run_input_worker(input_processes, outboxes, config):
+    """Run input processes, sending their messages to the shards.
+    """
+    logger = logging.getLogger()
+    executor = ThreadPoolExecutor(1, thread_name_prefix='send')
+
+    def coroutines():
+        queue = MessageQueue(config['queue_size'])
+        polling = []
+        processes = []
+        for input_process in input_processes:
+            input_process.queue = queue
+            if config['checkpoint_path'] is not None:
+                input_process.checkpoint_store = config['checkpoint_store']
+            if input_process.polling:
+                polling.append(input_process)
+            else:
+                processes.append(input_process)
+        if polling:
+            processes.append(SchedulerProcess(config['poll_scheduler'],
+                                              polling, logger))
+        if config['checkpoint_path'] is not None:
+            processes.append(CheckpointProcess(config['checkpoint_store'],
+                                               logger))
+        return [_send(queue, outboxes, config['batch_size'], executor),
+                *[x.execution_loop() for x in processes]]
+
+    if config['checkpoint_path'] is not None:
+        config['checkpoint_store'] = CheckpointStore(
+            config['checkpoint_path'], config['checkpoint_interval'])
+    _run_worker(coroutines)
+
+
+def run_shard(stages, inbox, outbox, config):
+    """Run the middleware chain on the messages arriving in the inbox.
+    """
+    logger = logging.getLogger()
+    executor = ThreadPoolExecutor(2, thread_name_prefix='shard')
+
+    def coroutines():
+        input_queue = MessageQueue(config['queue_size'])
+        output_queue = MessageQueue(config['queue_size'])
+        chain = build_chain(stages, input_queue, output_queue, logger,
+                            lambda name: MessageQueue(config['queue_size']))
+        return [_receive(inbox, input_queue, executor),
+                _send(output_queue, [outbox], config['batch_size'], executor),
+                *[x.execution_loop() for x in chain]]
+
+    _run_worker(coroutines)
+
+
+class ShardedRuntime:
+    """Runs the inputs and middleware of a Semaphore in worker processes.
+    """
+    def __init__(self, shards=None, input_workers=1, queue_size=10000,
+                 batch_size=256, restart_delay=1.0, max_restart_delay=60.0,
+                 start_method='spawn'):
+        """
+        :param shards: number of processes running the middleware chain,
+            one per core if None (type=int)
+        :param input_workers: number of processes the input processes are
+            divided over (type=int)
+        :param queue_size: maximum number of batches waiting for a process,
+            and of messages in the queues within one (type=int)
+        :param batch_size: maximum number of messages sent at once (type=int)
+        :param restart_delay: seconds before the workers are restarted after
+            a crash, doubled while they keep crashing (type=float)
+        :param max_restart_delay: maximum seconds before a restart
+            (type=float)
+        :param start_method: how processes are started, see multiprocessing
+            (type=str)
+        """
+        self.shards = shards or os.cpu_count()
+        self.input_workers = input_workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self._context = multiprocessing.get_context(start_method)
+
+    def __repr__(self):
+        return (f'ShardedRuntime with {self.input_workers} input workers and '
+                f'{self.shards} shards')
+
+    def supervisor(self, input_processes, stages, output_queue, logger,
+                   poll_scheduler, checkpoint_store):
+        """The process supervising the workers, to run in the main process.
+        """
+        return SupervisorProcess(self, input_processes, stages, output_queue,
+                                 logger, poll_scheduler, checkpoint_store)
+
+
+class SupervisorProcess(Process):
+    """Starts the worker processes, restarts them when one crashes, and puts
+    the processed messages on the output queue.
+
+    A process that dies can hold the lock of a multiprocessing queue it
+    shares with the others, so a crash restarts every worker with new
+    queues.
+    """
+    def __init__(self, runtime, input_processes, stages, output_queue,
+                 logger, poll_scheduler, checkpoint_store):
+        """
+        """
+        super().__init__(logger)
+        self._runtime = runtime
+        self._input_processes = list(input_processes)
+        self._stages = stages or [(MiddlewareProcess, dict())]
+        self._output_queue = output_queue
+        self._poll_scheduler = poll_scheduler
+        self._checkpoint_store = checkpoint_store
+
+        #: Worker processes, by name
+        self._workers = dict()
+        #: Inbox of every shard, and the outbox of the shards
+        self._inboxes = []
+        self._outbox = None
+        #: Number of times the workers were restarted
+        self.restarts = 0
+        #: Number of times every worker crashed, by name
+        self.crashes = collections.Counter()
+
+    def _start(self):
+        runtime = self._runtime
+        context = runtime._context
+        self._inboxes = [context.Queue(runtime.queue_size)
+                         for _ in range(runtime.shards)]
+        self._outbox = context.Queue(runtime.queue_size)
+
+        config = {'queue_size': runtime.queue_size,
+                  'batch_size': runtime.batch_size}
+        targets = {f'shard {index}': (run_shard, (self._stages, inbox,
+                                                  self._outbox, config))
+                   for index, inbox in enumerate(self._inboxes)}
+        workers = min(runtime.input_workers, len(self._input_processes))
+        for index in range(workers):
+            worker_config = dict(config, poll_scheduler=self._poll_scheduler,
+                                 checkpoint_path=None,
+                                 checkpoint_interval=None)
+            if self._checkpoint_store is not None:
+                # Processes writing one file would overwrite each other.
+                worker_config.update(
+                    checkpoint_path=f'{self._checkpoint_store.path}.{index}',
+                    checkpoint_interval=self._checkpoint_store.flush_interval)
+            targets[f'input worker {index}'] = (
+                run_input_worker,
+                (self._input_processes[index::workers], self._inboxes,
+                 worker_config))
+
+        for name, (target, args) in targets.items():
+            self._workers[name] = context.Process(target=target, args=args,
+                                                  name=name, daemon=True)
+            self._workers[name].start()
+
+    def _stop(self):
+        for process in self._workers.values():
+            process.terminate()
+        for process in self._workers.values():
+            process.join()
+        for queue in (*self._inboxes, self._outbox):
+            queue.cancel_join_thread()
+            queue.close()
+
+    async def execution_loop(self):
+        """
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(1, thread_name_prefix='supervisor')
+        delay = 0.0
+        receive = None
+        self._start()
+        started = time.monotonic()
+        try:
+            while True:
+                receive = asyncio.ensure_future(
+                    _receive(self._outbox, self._output_queue, executor))
+                while True:
+                    await asyncio.sleep(0.1)
+                    if receive.done():
+                        receive.result()
+                    crashed = [name for name, x in self._workers.items()
+                               if not x.is_alive()]
+                    if crashed:
+                        break
+
+                for name in crashed:
+                    self.crashes[name] += 1
+                    self._logger.error(
+                        f'{name} exited with code '
+                        f'{self._workers[name].exitcode}, restarting the '
+                        f'workers in {delay:.1f} seconds')
+                receive.cancel()
+                # Wait for the get on the outbox, which cannot be cancelled.
+                await loop.run_in_executor(executor, lambda: None)
+                self._stop()
+
+                await asyncio.sleep(delay)
+                if time.monotonic() - started > \
+                        self._runtime.max_restart_delay:
+                    # It ran fine for a while, so it is not crash looping.
+                    delay = 0.0
+                delay = min(self._runtime.max_restart_delay,
+                            max(self._runtime.restart_delay, 2 * delay))
+                self.restarts += 1
+                self._start()
+                started = time.monotonic()
+        finally:
+            if receive is not None:
+                receive.cancel()
+            self._stop()
+            executor.shutdown(wait=True)
@@ -0,0 +1,140 @@
+"""Central scheduling of the polls of input processes.
+
+Input processes that implement poll are polled by a PollScheduler instead of
+running their own loop. The scheduler adapts the interval of every input to
+what it observes: an input that returns many messages is polled more often,
+so new messages are found sooner, and an input that returns nothing or
+fails is polled less often, so fewer requests are wasted. Intervals are
+jittered so inputs do not poll in lockstep, and all inputs draw their
+requests from one token bucket, the global request budget.
+"""
+
+import asyncio
+import random
+import time
+
+from .ratelimit import TokenBucket
+
+
+class _PollState:
+    """Observed rates and current interval of a polled input process.
+    """
+    __slots__ = ('interval', 'message_rate', 'errors', 'polls', 'polled')
+
+    def __init__(self, interval):
+        #: Seconds until the next poll
+        self.interval = interval
+        #: Smoothed number of messages per second
+        self.message_rate = 0.0
+        #: Number of consecutive failed polls
+        self.errors = 0
+        #: Number of polls
+        self.polls = 0
+        #: Time of the last poll
+        self.polled = None
+
+
+class PollScheduler:
+    """Polls input processes at intervals adapted to their message and error
+    rates.
+    """
+    def __init__(self, min_interval=1.0, max_interval=300.0,
+                 messages_per_poll=10, jitter=0.1, smoothing=0.3,
+                 request_rate=None, request_burst=1):
+        """
+        :param min_interval: minimum seconds between polls of an input
+            (type=float)
+        :param max_interval: maximum seconds between polls of an input
+            (type=float)
+        :param messages_per_poll: number of messages a poll aims to return,
+            the interval is this over the message rate (type=float)
+        :param jitter: fraction the intervals are randomly varied by
+            (type=float)
+        :param smoothing: weight of the latest poll in the message rate,
+            between 0 and 1 (type=float)
+        :param request_rate: requests per second all inputs together may
+            make, unlimited if None (type=float)
+        :param request_burst: number of requests that can be made at once
+            (type=int)
+        """
+        if not 0 < min_interval <= max_interval:
+            raise ValueError('Intervals must be positive, the minimum '
+                             'at most the maximum')
+
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._messages_per_poll = messages_per_poll
+        self._jitter = jitter
+        self._smoothing = smoothing
+        #: Global request budget, or None
+        self.budget = TokenBucket(request_rate, request_burst) \
+            if request_rate is not None else None
+        #: Polling state of every input process, by name
+        self._states = dict()
+
+    def __repr__(self):
+        return f'PollScheduler polling {len(self._states)} input processes'
+
+    @property
+    def intervals(self):
+        """Current seconds between polls of every input process, by name."""
+        return {name: x.interval for name, x in self._states.items()}
+
+    def _update(self, state, messages, now):
+        """Set the interval after a poll that returned a number of messages,
+        or None if it failed.
+        """
+        if messages is None:
+            # Back off exponentially while the input keeps failing.
+            state.errors += 1
+            state.interval = min(self._max_interval,
+                                 self._min_interval * 2 ** state.errors)
+            return
+
+        state.errors = 0
+        if state.polled is not None:
+            rate = messages / max(now - state.polled, 1e-3)
+            state.message_rate += self._smoothing * \
+                (rate - state.message_rate)
+        state.polled = now
+
+        if state.message_rate > 0:
+            interval = self._messages_per_poll / state.message_rate
+        else:
+            # Nothing was ever returned, so back off.
+            interval = state.interval * 2
+        state.interval = min(self._max_interval,
+                             max(self._min_interval, interval))
+
+    async def _poll_loop(self, input_process, logger):
+        state = self._states[input_process.name]
+        # Spread the first polls, so the inputs do not start in lockstep.
+        await asyncio.sleep(random.uniform(0, self._jitter) *
+                            self._min_interval)
+        while True:
+            try:
+                messages = await input_process.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning(f'Polling {input_process.name} failed: '
+                               f'{error!r}')
+                messages = None
+            state.polls += 1
+            self._update(state, messages, time.monotonic())
+
+            await asyncio.sleep(state.interval * random.uniform(
+                1 - self._jitter, 1 + self._jitter))
+
+    async def run(self, input_processes, logger):
+        """Poll the input processes until interrupted.
+
+        :param input_processes: input processes implementing poll
+            (type=list)
+        :param logger: logger of the Semaphore (type=logging.Logger)
+        """
+        for input_process in input_processes:
+            self._states[input_process.name] = _PollState(self._min_interval)
+            input_process.request_budget = self.budget
+        await asyncio.gather(*[self._poll_loop(x, logger)
+                               for x in input_processes])
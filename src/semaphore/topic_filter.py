@@ -1,12 +1,307 @@
-"""Something functor.
+"""Topic filters decide which messages an input process puts on the queue.
 
-Description.
+A TopicFilter is a functor, called with a message and returning whether the
+message is on topic. Subclasses implement filter, or use the built-in
+KeywordFilter and RegexFilter. Filters are composed with &, | and ~, and the
+composed filters evaluate their cheapest and most decisive clauses first,
+based on the cost of each clause and how often it passed so far.
 """
 
+import re
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 
 class TopicFilter:
+    #: Relative cost of calling the filter, used to order clauses
+    cost = 1.0
+
     def __call__(self, message):
         return self.filter(message)
 
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
     def filter(self, message):
         raise NotImplementedError('Implement filter method in a subclass')
+
+
+class _TextFilter(TopicFilter):
+    """Filter on the text of one or more fields of a message.
+    """
+    def __init__(self, fields=('body',), case_sensitive=False):
+        """
+        :param fields: fields of the message to search (type=tuple)
+        :param case_sensitive: whether matching is case sensitive (type=bool)
+        """
+        #: Fields of the message to search
+        self._fields = tuple(fields)
+        #: Whether matching is case sensitive
+        self._case_sensitive = case_sensitive
+
+    def _text(self, message):
+        if len(self._fields) == 1:
+            text = getattr(message, self._fields[0]) or ''
+        else:
+            text = '\n'.join(getattr(message, x) or '' for x in self._fields)
+        return text if self._case_sensitive else text.casefold()
+
+    def filter(self, message):
+        return self.search(self._text(message))
+
+    def search(self, text):
+        raise NotImplementedError('Implement search method in a subclass')
+
+
+class _Automaton:
+    """Aho-Corasick automaton, finding any of many keywords in one pass.
+
+    Only used when the pyahocorasick package is not installed.
+    """
+    def __init__(self, keywords):
+        #: Transitions of every state, by character
+        self._goto = [dict()]
+        #: Fallback state of every state
+        self._fail = [0]
+        #: Keywords ending at every state
+        self._output = [()]
+
+        for keyword in keywords:
+            state = 0
+            for character in keyword:
+                if character not in self._goto[state]:
+                    self._goto.append(dict())
+                    self._fail.append(0)
+                    self._output.append(())
+                    self._goto[state][character] = len(self._goto) - 1
+                state = self._goto[state][character]
+            self._output[state] = (keyword,)
+
+        # Breadth-first, so the fallback of a state is set before its
+        # children are visited.
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for character, child in self._goto[state].items():
+                queue.append(child)
+                fail = self._fail[state]
+                while fail and character not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(character, 0)
+                self._output[child] += self._output[self._fail[child]]
+
+    def iter(self, text):
+        """Yield the end index and keyword of every match in the text.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for index, character in enumerate(text):
+            while state and character not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(character, 0)
+            for keyword in output[state]:
+                yield index, keyword
+
+
+class KeywordFilter(_TextFilter):
+    """Passes messages that contain any of the keywords.
+
+    All keywords are found in a single pass over the text with an
+    Aho-Corasick automaton, using pyahocorasick if it is installed. Matches
+    are case folded by default, and can be restricted to whole words.
+    """
+    cost = 2.0
+
+    def __init__(self, keywords, fields=('body',), case_sensitive=False,
+                 whole_words=False):
+        """
+        :param keywords: keywords to search for (type=list)
+        :param fields: fields of the message to search (type=tuple)
+        :param case_sensitive: whether matching is case sensitive (type=bool)
+        :param whole_words: only match keywords that are whole words
+            (type=bool)
+        """
+        super().__init__(fields, case_sensitive)
+        keywords = [x if case_sensitive else x.casefold() for x in keywords]
+        if not keywords:
+            raise ValueError('A keyword filter needs at least one keyword')
+
+        #: Only match keywords that are whole words
+        self._whole_words = whole_words
+        if ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                self._automaton.add_word(keyword, keyword)
+            self._automaton.make_automaton()
+        else:
+            self._automaton = _Automaton(keywords)
+
+    def __repr__(self):
+        return f'KeywordFilter on {", ".join(self._fields)}'
+
+    def _is_word(self, text, end, keyword):
+        start = end - len(keyword) + 1
+        return (start == 0 or not _is_word_character(text[start - 1])) and \
+            (end == len(text) - 1 or not _is_word_character(text[end + 1]))
+
+    def search(self, text):
+        for end, keyword in self._automaton.iter(text):
+            if not self._whole_words or self._is_word(text, end, keyword):
+                return True
+        return False
+
+
+def _is_word_character(character):
+    return character.isalnum() or character == '_'
+
+
+class RegexFilter(_TextFilter):
+    """Passes messages that match any of the regular expressions.
+
+    The expressions are combined into a single compiled expression, so the
+    text is scanned once.
+    """
+    cost = 3.0
+
+    def __init__(self, patterns, fields=('body',), case_sensitive=False,
+                 whole_words=False):
+        """
+        :param patterns: regular expressions to search for (type=list)
+        :param fields: fields of the message to search (type=tuple)
+        :param case_sensitive: whether matching is case sensitive (type=bool)
+        :param whole_words: only match at word boundaries (type=bool)
+        """
+        super().__init__(fields, case_sensitive)
+        patterns = list(patterns)
+        if not patterns:
+            # An empty expression would match every message.
+            raise ValueError('A regex filter needs at least one pattern')
+        pattern = '|'.join(f'(?:{x})' for x in patterns)
+        if whole_words:
+            pattern = rf'\b(?:{pattern})\b'
+
+        #: Combined regular expression
+        self._regex = re.compile(pattern,
+                                 0 if case_sensitive else re.IGNORECASE)
+
+    def __repr__(self):
+        return f'RegexFilter with pattern \'{self._regex.pattern}\''
+
+    def _text(self, message):
+        # The regular expression ignores case itself.
+        if len(self._fields) == 1:
+            return getattr(message, self._fields[0]) or ''
+        return '\n'.join(getattr(message, x) or '' for x in self._fields)
+
+    def search(self, text):
+        return self._regex.search(text) is not None
+
+
+class _Composition(TopicFilter):
+    """Filter composed of clauses, evaluated until the outcome is known.
+
+    Every clause keeps how often it was evaluated and passed, and the
+    clauses are reordered every reorder_interval calls so the ones most
+    likely to decide the outcome cheaply are evaluated first.
+    """
+    #: Number of calls between reordering the clauses
+    reorder_interval = 1000
+
+    def __init__(self, *filters):
+        clauses = []
+        for topic_filter in filters:
+            if type(topic_filter) is type(self):
+                clauses.extend(x[0] for x in topic_filter._clauses)
+            else:
+                clauses.append(topic_filter)
+
+        #: Clauses as [filter, times evaluated, times passed]
+        self._clauses = [[x, 0, 0] for x in
+                         sorted(clauses, key=lambda x: x.cost)]
+        #: Calls since the clauses were last reordered
+        self._calls = 0
+
+    def __repr__(self):
+        operator = f' {type(self).__name__} '
+        return '({})'.format(operator.join(repr(x[0]) for x in self._clauses))
+
+    @property
+    def cost(self):
+        return sum(x[0].cost for x in self._clauses)
+
+    @property
+    def filters(self):
+        return [x[0] for x in self._clauses]
+
+    def _rank(self, cost, pass_rate):
+        raise NotImplementedError('Implement _rank in a subclass')
+
+    def _reorder(self):
+        self._calls = 0
+        self._clauses.sort(key=lambda x: self._rank(
+            x[0].cost, (x[2] + 1) / (x[1] + 2)))
+
+
+class And(_Composition):
+    """Passes messages that pass all filters.
+    """
+    def _rank(self, cost, pass_rate):
+        # The clause most likely to fail for its cost goes first.
+        return cost / (1 - pass_rate)
+
+    def filter(self, message):
+        self._calls += 1
+        if self._calls >= self.reorder_interval:
+            self._reorder()
+
+        for clause in self._clauses:
+            clause[1] += 1
+            if not clause[0](message):
+                return False
+            clause[2] += 1
+        return True
+
+
+class Or(_Composition):
+    """Passes messages that pass any of the filters.
+    """
+    def _rank(self, cost, pass_rate):
+        # The clause most likely to pass for its cost goes first.
+        return cost / pass_rate
+
+    def filter(self, message):
+        self._calls += 1
+        if self._calls >= self.reorder_interval:
+            self._reorder()
+
+        for clause in self._clauses:
+            clause[1] += 1
+            if clause[0](message):
+                clause[2] += 1
+                return True
+        return False
+
+
+class Not(TopicFilter):
+    """Passes messages that do not pass the filter.
+    """
+    def __init__(self, topic_filter):
+        self._filter = topic_filter
+
+    def __repr__(self):
+        return f'Not {self._filter!r}'
+
+    @property
+    def cost(self):
+        return self._filter.cost
+
+    def filter(self, message):
+        return not self._filter(message)
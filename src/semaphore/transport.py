@@ -0,0 +1,129 @@
+"""Framing of batches of messages sent between Semaphores over TCP.
+
+A TCPHandler on a collector streams its messages to a TCPInputProcess on a
+relay. The receiver first sends a random challenge, the sender answers with
+a hello frame with its id, which the receiver acknowledges with sequence
+number 0, then sends a frame per batch of messages:
+
+    length (4 bytes) | sequence number (8 bytes) | flags (1 byte) | payload
+
+The payload is the batch packed with semaphore.message.pack_json, which
+never runs code, compressed with zlib when that makes it smaller. The
+receiver acknowledges every batch it put on its queue by sending its sequence
+number back as 8 bytes. The sender keeps every batch until it is
+acknowledged and sends it again after reconnecting, and the receiver skips
+batches it already put, by sender id and sequence number.
+
+With a shared secret, the hello frame holds an HMAC of the challenge and the
+sender id, and the receiver closes connections without a valid one. Frames
+larger than the maximum frame size, compressed or not, close the connection
+too. The secret does not encrypt the messages, use TLS for that.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import struct
+import zlib
+
+#: Header of a frame: payload length, sequence number, flags
+HEADER = struct.Struct('!IQB')
+#: Acknowledgement of all frames up to a sequence number
+ACK = struct.Struct('!Q')
+
+#: Flags of a frame
+COMPRESSED = 1
+HELLO = 2
+
+#: Payloads smaller than this are not worth compressing
+_COMPRESS_MIN_SIZE = 512
+#: Bytes of the challenge the receiver sends
+CHALLENGE_SIZE = 16
+#: Default maximum bytes of a frame, before and after decompressing
+MAX_FRAME_SIZE = 32 * 1024 * 1024
+#: Maximum bytes of a hello frame, read before the sender is known
+MAX_HELLO_SIZE = 1024
+
+
+class FrameError(ValueError):
+    """Raised when a frame is too large or cannot be decompressed."""
+
+
+def new_challenge():
+    return os.urandom(CHALLENGE_SIZE)
+
+
+def _signature(secret, challenge, sender):
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hmac.new(secret, challenge + sender.encode(),
+                    hashlib.sha256).hexdigest()
+
+
+def encode_hello(sender, challenge, secret=None):
+    """Encode the hello frame answering a challenge.
+    """
+    signature = None if secret is None else \
+        _signature(secret, challenge, sender)
+    payload = json.dumps({'sender': sender, 'signature': signature})
+    return encode_frame(0, payload.encode(), HELLO, 0)
+
+
+def decode_hello(payload, challenge, secret=None):
+    """The id of the sender of a hello frame.
+
+    Raises FrameError if the hello frame is invalid, or its signature does
+    not match the secret.
+    """
+    try:
+        hello = json.loads(payload)
+        sender = hello['sender']
+        signature = hello['signature']
+    except (ValueError, KeyError, TypeError):
+        raise FrameError('Invalid hello frame') from None
+    if not isinstance(sender, str):
+        raise FrameError('Invalid hello frame')
+    if secret is not None and not (
+            isinstance(signature, str) and hmac.compare_digest(
+                signature, _signature(secret, challenge, sender))):
+        raise FrameError(f'Invalid signature of sender {sender}')
+    return sender
+
+
+def encode_frame(sequence, payload, flags=0, compression=1):
+    """Encode a frame, compressing the payload if that makes it smaller.
+
+    :param compression: zlib compression level, 0 to never compress
+        (type=int)
+    """
+    if compression and len(payload) >= _COMPRESS_MIN_SIZE:
+        compressed = zlib.compress(payload, compression)
+        if len(compressed) < len(payload):
+            payload = compressed
+            flags |= COMPRESSED
+    return HEADER.pack(len(payload), sequence, flags) + payload
+
+
+async def read_frame(reader, max_size=MAX_FRAME_SIZE):
+    """Read a frame from a stream.
+
+    :param max_size: maximum bytes of the payload, before and after
+        decompressing, larger frames raise FrameError (type=int)
+    :return: sequence number, flags and the decompressed payload
+        (type=tuple)
+    """
+    length, sequence, flags = HEADER.unpack(
+        await reader.readexactly(HEADER.size))
+    if length > max_size:
+        raise FrameError(f'Frame of {length} bytes is too large')
+    payload = await reader.readexactly(length)
+    if flags & COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, max_size)
+        except zlib.error as error:
+            raise FrameError(f'Invalid compressed frame: {error}') from None
+        if decompressor.unconsumed_tail:
+            raise FrameError('Decompressed frame is too large')
+    return sequence, flags, payload
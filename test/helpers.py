@@ -0,0 +1,60 @@
+"""Test doubles shared by the tests."""
+
+import asyncio
+import datetime
+import time
+
+from semaphore import InputProcess, Message
+from semaphore.handler import Handler
+from semaphore.topic_filter import TopicFilter
+
+
+def make_message(body=0, url='https://www.foo.com', **additions):
+    """A message with a body, or with the body 'test {body}' for a number.
+    """
+    if isinstance(body, int):
+        body = f'test {body}'
+    return Message('me', body, 'dummy', url, datetime.datetime.utcnow(),
+                   **additions)
+
+
+class PassTopicFilter(TopicFilter):
+    def filter(self, message):
+        return True
+
+
+class ListHandler(Handler):
+    """Handler that emits to a list, so tests can inspect the output."""
+    def __init__(self, name):
+        super().__init__(name)
+        self.messages = []
+
+    def emit(self, message):
+        self.messages.append((message, time.monotonic()))
+
+
+class TimedInputProcess(InputProcess):
+    """Puts a message every 0.05 seconds."""
+    def __init__(self, name, queue, logger, count=5):
+        super().__init__(name, queue, logger)
+        self.sent = []
+        self._count = count
+
+    async def execution_loop(self):
+        for counter in range(self._count):
+            self.sent.append(time.monotonic())
+            await self._put_message(make_message(counter))
+            await asyncio.sleep(0.05)
+        await asyncio.Event().wait()
+
+
+class BurstInputProcess(InputProcess):
+    """Puts a list of messages at once."""
+    def __init__(self, name, queue, logger, messages):
+        super().__init__(name, queue, logger)
+        self._messages = messages
+
+    async def execution_loop(self):
+        for message in self._messages:
+            await self._put_message(message)
+        await asyncio.Event().wait()
@@ -0,0 +1,104 @@
+import pytest
+
+from semaphore import AggregationProcess, Semaphore
+from semaphore.aggregation import OTHER, TopItems
+from semaphore.process import SemaphoreTimeLimitInterrupt
+
+from helpers import BurstInputProcess, ListHandler, PassTopicFilter, make_message
+
+
+def test_top_items():
+    items = TopItems(capacity=3)
+    for item in 'aaaaabbbcd':
+        items.add(item)
+    assert len(items) == 3
+    assert items.top(2) == [('a', 5), ('b', 3)]
+
+
+def test_tumbling_window():
+    aggregation = AggregationProcess(None, None, None, key='topic', window=10,
+                                     representatives=2, max_keys=2)
+    for body in ('x', 'x', 'y'):
+        aggregation.add(make_message(body, topic='a'), 1.0)
+    aggregation.add(make_message(topic='b'), 2.0)
+    aggregation.add(make_message(topic='c'), 3.0)
+    aggregation.add(make_message(topic='d'), 4.0)
+    aggregation.add(make_message(topic='a'), 12.0)
+
+    digests = {x.additions.get('key') or x.additions.get('topic'): x
+               for x in aggregation.digests(10.0)}
+    assert digests.keys() == {'a', 'b', OTHER}
+    digest = digests['a']
+    assert digest.platform == 'digest'
+    assert digest.additions.count == 3
+    assert digest.additions.top[0] == ('x', 2)
+    assert len(digest.additions.representatives) == 2
+    # A key with a single message emits it as it is.
+    assert digests['b'].platform == 'dummy'
+    assert digests[OTHER].additions.count == 2
+
+    messages = aggregation.digests(20.0)
+    assert [x.additions.topic for x in messages] == ['a']
+
+
+def test_sliding_window():
+    aggregation = AggregationProcess(None, None, None, key='topic', window=3,
+                                     slide=1, min_count=1)
+    aggregation.add(make_message(topic='a'), 0.5)
+    aggregation.add(make_message(topic='a'), 1.5)
+    assert aggregation.digests(2.0)[0].additions.count == 2
+    assert aggregation.digests(3.0)[0].additions.count == 2
+    assert aggregation.digests(4.0)[0].additions.count == 1
+    assert aggregation.digests(5.0) == []
+
+
+def test_sliding_window_passes_messages_once():
+    aggregation = AggregationProcess(None, None, None, key='topic', window=60,
+                                     slide=10, min_count=2)
+    message = make_message(topic='a')
+    aggregation.add(message, 5.0)
+    emitted = [x for end in range(10, 80, 10) for x in aggregation.digests(float(end))]
+    assert emitted == [message]
+
+    # A window reaching the count emits a digest, not the messages.
+    aggregation.add(make_message(topic='b'), 75.0)
+    assert [x.platform for x in aggregation.digests(80.0)] == ['dummy']
+    aggregation.add(make_message(topic='b'), 85.0)
+    messages = aggregation.digests(90.0)
+    assert [x.platform for x in messages] == ['digest']
+
+
+def test_invalid_window():
+    with pytest.raises(ValueError):
+        AggregationProcess(None, None, None, window=1, slide=2)
+    with pytest.raises(ValueError):
+        AggregationProcess(None, None, None, processes=2)
+
+
+def test_aggregation_pipeline():
+    semaphore = Semaphore(time_limit=1)
+    messages = [make_message(x % 3, topic='ab'[x % 2]) for x in range(20)]
+    messages.append(make_message(topic='c'))
+    input_process = BurstInputProcess('burst', semaphore._input_queue,
+                                      semaphore._logger, messages)
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(AggregationProcess, key='topic',
+                                     window=0.2)
+    handler = ListHandler('list')
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    counts = dict()
+    for message, _ in handler.messages:
+        if message.platform == 'digest':
+            key = message.additions.key
+            counts[key] = counts.get(key, 0) + message.additions.count
+        else:
+            counts[message.additions.topic] = \
+                counts.get(message.additions.topic, 0) + 1
+    # A burst can straddle the end of a window.
+    assert counts == {'a': 10, 'b': 10, 'c': 1}
+    assert len(handler.messages) < 21
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+
+import pytest
+
+from semaphore import DeadLetterStore, PartialEmitError, Semaphore
+from semaphore.deadletter import main
+from semaphore.handler import Handler
+from semaphore.process import OutputProcess, SemaphoreTimeLimitInterrupt
+from semaphore.queues import MessageQueue
+
+from helpers import BurstInputProcess, PassTopicFilter, make_message
+
+
+def _messages(count):
+    return [make_message(x, score=x) for x in range(count)]
+
+
+class FlakyHandler(Handler):
+    """Handler failing a number of times before it emits, or once on a
+    message with a body."""
+    blocking = False
+    max_batch = 2
+
+    def __init__(self, name, failures=0, fail_on=None):
+        super().__init__(name)
+        self.failures = failures
+        self.fail_on = fail_on
+        self.messages = []
+
+    def emit(self, message):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Emitting failed')
+        if message.body == self.fail_on:
+            self.fail_on = None
+            raise RuntimeError('Emitting failed')
+        self.messages.append(message)
+
+
+def make_handler():
+    return FlakyHandler('replay')
+
+
+def test_replay(tmp_path):
+    store = DeadLetterStore(tmp_path)
+    messages = _messages(5)
+    store.add('foo', messages, RuntimeError('down'), 3)
+    entries = store.entries('foo')
+    assert entries[0]['attempts'] == 3
+    assert entries[0]['error'] == "RuntimeError('down')"
+    assert [x.to_dict() for x in store.messages('foo')] == [x.to_dict() for x in messages]
+    assert store.handlers == ['foo']
+
+    # The second batch fails, so it stays in the store with the rest.
+    handler = FlakyHandler('foo')
+    original = handler.emit_batch
+
+    def emit_batch(messages):
+        if messages[0].body == 'test 2':
+            raise RuntimeError('Emitting failed')
+        original(messages)
+
+    handler.emit_batch = emit_batch
+    with pytest.raises(RuntimeError):
+        asyncio.run(store.replay(handler))
+    assert [x.body for x in handler.messages] == ['test 0', 'test 1']
+    assert [x.body for x in store.messages('foo')] == ['test 2', 'test 3', 'test 4']
+
+    assert asyncio.run(store.replay(FlakyHandler('foo'))) == 3
+    assert store.handlers == []
+
+
+def test_command_line(tmp_path, capsys):
+    store = DeadLetterStore(tmp_path)
+    store.add('slack', _messages(3), RuntimeError('down'), 1)
+
+    main([str(tmp_path), 'list'])
+    assert capsys.readouterr().out == 'slack: 3\n'
+
+    main([str(tmp_path), 'replay', 'slack', 'test_deadletter:make_handler'])
+    assert capsys.readouterr().out == 'Replayed 3 messages, 0 left\n'
+    assert store.handlers == []
+
+
+def test_retries(tmp_path):
+    store = DeadLetterStore(tmp_path)
+    semaphore = Semaphore(time_limit=0.5, dead_letter_store=store)
+    input_process = BurstInputProcess('list', semaphore._input_queue, semaphore._logger, _messages(4))
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+
+    flaky = FlakyHandler('flaky', failures=2)
+    flaky.retries = 2
+    flaky.retry_delay = 0.01
+    failing = FlakyHandler('failing', failures=100)
+    failing.retries = 1
+    failing.retry_delay = 0.01
+    healthy = FlakyHandler('healthy')
+    for handler in (flaky, failing, healthy):
+        semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    bodies = [f'test {x}' for x in range(4)]
+    assert sorted(x.body for x in flaky.messages) == bodies
+    assert [x.body for x in healthy.messages] == bodies
+    assert failing.messages == []
+    assert sorted(x.body for x in store.messages('failing')) == bodies
+    assert store.handlers == ['failing']
+    assert all(x['attempts'] == 2 for x in store.entries('failing'))
+
+
+def test_retry_messages_not_emitted():
+    handler = FlakyHandler('partial', fail_on='test 2')
+    handler.max_batch = 4
+    handler.retries = 1
+    handler.retry_delay = 0.01
+
+    async def throttle():
+        # The messages queue up meanwhile, so they are emitted as one batch.
+        await asyncio.sleep(0.05)
+
+    handler.throttle = throttle
+
+    async def run():
+        queue = MessageQueue()
+        process = OutputProcess(queue, logging.getLogger())
+        process.add_handler(handler)
+        for message in _messages(4):
+            queue.put_nowait(message)
+        task = asyncio.ensure_future(process.execution_loop())
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(run())
+    assert [x.body for x in handler.messages] == [f'test {x}' for x in range(4)]
+
+
+def test_replay_after_partial_failure(tmp_path):
+    store = DeadLetterStore(tmp_path)
+    store.add('foo', _messages(4), RuntimeError('down'), 1)
+
+    handler = FlakyHandler('foo', fail_on='test 3')
+    with pytest.raises(PartialEmitError):
+        asyncio.run(store.replay(handler))
+    assert [x.body for x in store.messages('foo')] == ['test 3']
+    assert asyncio.run(store.replay(handler)) == 1
+    assert [x.body for x in handler.messages] == [f'test {x}' for x in range(4)]
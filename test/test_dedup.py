@@ -0,0 +1,53 @@
+import time
+
+from semaphore import Deduplicator
+from semaphore.dedup import FingerprintSet, RotatingBloomFilter, hamming_distance, simhash
+
+from helpers import make_message
+
+BODY = ('The president announced new tariffs on steel and aluminium imports '
+        'today, saying the measures would protect domestic industry and jobs')
+
+
+def test_exact():
+    deduplicator = Deduplicator()
+    assert not deduplicator.is_duplicate(make_message(BODY))
+    assert deduplicator.is_duplicate(make_message(BODY.upper()))
+    assert not deduplicator.is_duplicate(make_message(BODY, 'https://www.bar.com'))
+    assert deduplicator.duplicate_rate == 1 / 3
+
+
+def test_simhash():
+    edited = BODY.replace('today', 'yesterday')
+    assert hamming_distance(simhash(BODY), simhash(edited)) <= 6
+
+    deduplicator = Deduplicator('simhash', fields=('body',))
+    assert not deduplicator.is_duplicate(make_message(BODY))
+    assert deduplicator.is_duplicate(make_message(edited))
+    assert not deduplicator.is_duplicate(make_message('something else entirely'))
+
+
+def test_bloom():
+    deduplicator = Deduplicator(bloom=True, max_size=1000)
+    for counter in range(1000):
+        assert not deduplicator.is_duplicate(make_message(f'test {counter}'))
+    assert deduplicator.is_duplicate(make_message('test 1'))
+
+
+def test_ttl_and_size():
+    fingerprints = FingerprintSet(ttl=0.05, max_size=2)
+    assert not fingerprints.check_and_add(1)
+    assert fingerprints.check_and_add(1)
+    fingerprints.check_and_add(2)
+    fingerprints.check_and_add(3)
+    assert len(fingerprints) == 2
+    assert not fingerprints.check_and_add(1)
+    time.sleep(0.06)
+    assert not fingerprints.check_and_add(3)
+
+    bloom = RotatingBloomFilter(ttl=0.1)
+    bloom.check_and_add(1)
+    time.sleep(0.06)
+    assert bloom.check_and_add(1) is True
+    time.sleep(0.11)
+    assert not bloom.check_and_add(2)
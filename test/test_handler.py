@@ -0,0 +1,262 @@
+import asyncio
+import csv
+import gc
+import gzip
+import json
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from semaphore import CSVHandler, JSONLinesHandler, RateLimitedSlackHandler, RotatingFileHandler
+from semaphore.handler import Formatter
+from semaphore.process import OutputProcess
+from semaphore.queues import MessageQueue
+
+from helpers import make_message
+
+
+class FakeSlack(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        payload = urllib.parse.parse_qs(self.rfile.read(length).decode())
+        if self.server.throttle:
+            self.server.throttle -= 1
+            body, status = b'{"ok": false, "error": "ratelimited"}', 429
+        else:
+            self.server.posts.append({k: v[0] for k, v in payload.items()})
+            body, status = b'{"ok": true}', 200
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status == 429:
+            self.send_header('Retry-After', '0.1')
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.connections.add(self.client_address)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_slack():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSlack)
+    server.posts = []
+    server.connections = set()
+    server.throttle = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def run_output(handler, messages, duration):
+    async def run():
+        queue = MessageQueue()
+        process = OutputProcess(queue, logging.getLogger())
+        process.add_handler(handler)
+        for message in messages:
+            queue.put_nowait(message)
+        task = asyncio.ensure_future(process.execution_loop())
+        await asyncio.sleep(duration)
+        task.cancel()
+
+    asyncio.run(run())
+    handler.close()
+
+
+@pytest.mark.parametrize('blocks', [False, True])
+def test_slack_coalescing(fake_slack, blocks):
+    handler = RateLimitedSlackHandler(
+        'slack', 'token', f'C{blocks}', 'bot', ':robot:', rate=10,
+        max_batch=4, blocks=blocks,
+        base_url=f'http://127.0.0.1:{fake_slack.server_port}/api/')
+
+    run_output(handler, [make_message(x) for x in range(10)], 0.5)
+
+    assert len(fake_slack.posts) <= 4
+    texts = '\n'.join(x['text'] for x in fake_slack.posts)
+    assert all(f'test {x}' in texts for x in range(10))
+    if blocks:
+        assert max(len(json.loads(x['blocks'])) for x in fake_slack.posts) == 4
+    assert len(fake_slack.connections) == 1
+
+
+def test_slack_retries_when_rate_limited(fake_slack):
+    fake_slack.throttle = 2
+    handler = RateLimitedSlackHandler(
+        'slack', 'token', 'C429', 'bot', ':robot:', rate=100,
+        base_url=f'http://127.0.0.1:{fake_slack.server_port}/api/')
+
+    run_output(handler, [make_message(0)], 0.5)
+
+    assert len(fake_slack.posts) == 1
+    assert 'test 0' in fake_slack.posts[0]['text']
+
+
+def test_slack_buckets_by_token_and_channel():
+    def handler(token, rate=1.0):
+        return RateLimitedSlackHandler('slack', token, 'CBUCKET', 'bot', ':robot:', rate=rate)
+
+    first, second, other = handler('token'), handler('token'), handler('other', rate=2.0)
+    assert first._bucket is second._bucket
+    assert first._bucket is not other._bucket
+    with pytest.raises(ValueError):
+        handler('token', rate=2.0)
+
+    # A bucket no handler uses is forgotten.
+    del first, second
+    gc.collect()
+    assert handler('token', rate=2.0)._bucket.rate == 2.0
+
+
+def test_rotating_file_handler(tmp_path):
+    filename = tmp_path / 'out.txt'
+    handler = RotatingFileHandler('file', filename, max_bytes=1000,
+                                  backup_count=2, compress=True)
+
+    for counter in range(0, 100, 10):
+        handler.emit_batch([make_message(x) for x in range(counter, counter + 10)])
+    handler.close()
+
+    segments = sorted(x.name for x in tmp_path.iterdir() if x.name != 'out.txt')
+    assert len(segments) == 2
+    assert all(x.endswith('.gz') for x in segments)
+    with gzip.open(tmp_path / segments[-1], 'rt') as segment:
+        assert 'test 80' in segment.read()
+    assert 'test 99' in filename.read_text()
+
+
+def test_rotating_file_handler_flushes_when_idle(tmp_path):
+    filename = tmp_path / 'out.txt'
+    handler = RotatingFileHandler('file', filename, flush_interval=0.1)
+
+    async def run():
+        queue = MessageQueue()
+        process = OutputProcess(queue, logging.getLogger())
+        process.add_handler(handler)
+        queue.put_nowait(make_message(0))
+        task = asyncio.ensure_future(process.execution_loop())
+        await asyncio.sleep(0.3)
+        assert 'test 0' in filename.read_text()
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_rotating_file_handler_flushes_when_busy(tmp_path):
+    filename = tmp_path / 'out.txt'
+    handler = RotatingFileHandler('file', filename, flush_interval=0.2)
+
+    async def run():
+        queue = MessageQueue()
+        process = OutputProcess(queue, logging.getLogger())
+        process.add_handler(handler)
+        task = asyncio.ensure_future(process.execution_loop())
+        # A message every 0.05 seconds, so the handler is never idle for
+        # flush_interval.
+        for counter in range(10):
+            await queue.put(make_message(counter))
+            await asyncio.sleep(0.05)
+        assert 'test 0' in filename.read_text()
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_rotating_file_handler_keeps_other_files(tmp_path):
+    filename = tmp_path / 'data'
+    other = tmp_path / 'data.json'
+    other.write_text('{}')
+    handler = RotatingFileHandler('file', filename, max_bytes=100,
+                                  backup_count=1)
+
+    for counter in range(0, 50, 10):
+        handler.emit_batch([make_message(x) for x in range(counter, counter + 10)])
+    handler.close()
+
+    assert other.read_text() == '{}'
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_csv_handler(tmp_path):
+    filename = tmp_path / 'out.csv'
+    handler = CSVHandler('csv', filename)
+    messages = [make_message(x) for x in range(3)]
+    for counter, message in enumerate(messages):
+        message.additions['sentiment'] = counter / 2
+    handler.emit_batch(messages[:2])
+    handler.emit_batch(messages[2:])
+    handler.close()
+
+    with open(filename, newline='') as stream:
+        rows = list(csv.DictReader(stream))
+    assert list(rows[0]) == ['author', 'body', 'platform', 'url', 'timestamp', 'sentiment']
+    assert [x['body'] for x in rows] == ['test 0', 'test 1', 'test 2']
+    assert rows[2]['sentiment'] == '1.0'
+    assert rows[0]['timestamp'] == messages[0].timestamp.isoformat()
+
+
+def test_csv_handler_appends_to_existing_file(tmp_path):
+    filename = tmp_path / 'out.csv'
+    handler = CSVHandler('csv', filename, additions=['sentiment'])
+    handler.emit_batch([make_message(0, sentiment=0.5)])
+    handler.stream.flush()
+    # The header counts towards the size the file is rotated at.
+    assert handler._size == filename.stat().st_size
+    handler.close()
+
+    handler = CSVHandler('csv', filename)
+    handler.emit_batch([make_message(1, label='foo')])
+    handler.close()
+
+    with open(filename, newline='') as stream:
+        rows = list(csv.reader(stream))
+    assert rows[0] == ['author', 'body', 'platform', 'url', 'timestamp', 'sentiment']
+    assert [x[1] for x in rows[1:]] == ['test 0', 'test 1']
+    assert rows[2][5] == ''
+
+    with pytest.raises(ValueError):
+        CSVHandler('csv', filename, columns=['body'])
+
+
+def test_json_lines_handler(tmp_path):
+    filename = tmp_path / 'out.jsonl'
+    handler = JSONLinesHandler('jsonl', filename)
+    message = make_message(0)
+    message.additions['sentiment'] = 0.5
+    handler.emit_batch([message, make_message(1)])
+    handler.close()
+
+    records = [json.loads(x) for x in filename.read_text().splitlines()]
+    assert records[0] == {'author': 'me', 'body': 'test 0', 'platform': 'dummy',
+                          'url': 'https://www.foo.com',
+                          'timestamp': message.timestamp.isoformat(), 'sentiment': 0.5}
+    assert records[1]['body'] == 'test 1'
+
+
+def test_formatter():
+    message = make_message(0)
+    message.additions.sentiment = 0.25
+    formatter = Formatter('{author}: {body!r} {sentiment:.1f} '
+                          '{additions.sentiment} {missing}({timestamp.year})')
+    assert formatter.format(message) == \
+        f"me: 'test 0' 0.2 0.25 ({message.timestamp.year})"
+    assert repr(formatter) == "Formatter with format '{author}: {body!r} " \
+        "{sentiment:.1f} {additions.sentiment} {missing}({timestamp.year})'"
+    assert Formatter().format(message) == repr(message)
+
+
+def test_formatter_formats_once():
+    message = make_message(0)
+    first, second = Formatter('{body}!'), Formatter('{body}!')
+    assert first.format(message) == 'test 0!'
+    message.body = 'changed'
+    assert second.format(message) == 'test 0!'
+    assert Formatter('{body}?').format(message) == 'changed?'
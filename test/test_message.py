@@ -0,0 +1,100 @@
+import datetime
+import marshal
+import pickle
+
+import pytest
+
+from semaphore import Message
+from semaphore.message import pack, pack_json, unpack, unpack_json
+
+
+def test_additions_dot_access():
+    message = Message('me', 'test', 'dummy', 'https://www.foo.com', None, score=1)
+    assert message.additions.score == 1
+    message.additions.label = 'foo'
+    assert message.additions['label'] == 'foo'
+    with pytest.raises(AttributeError):
+        message.additions.missing
+    with pytest.raises(AttributeError):
+        message.foo = 'bar'
+
+
+def test_interned_strings():
+    first = Message(''.join(['m', 'e']), 'a', ''.join(['dum', 'my']), 'url', None)
+    second = Message(''.join(['m', 'e']), 'b', ''.join(['dum', 'my']), 'url', None)
+    assert first.author is second.author
+    assert first.platform is second.platform
+
+
+@pytest.mark.parametrize('timestamp', [
+    None,
+    1234.5,
+    datetime.datetime(2019, 5, 1, 12, 30, 1, 5),
+    datetime.datetime(2019, 5, 1, 12, 30, 1, 5, tzinfo=datetime.timezone.utc),
+])
+def test_bytes_round_trip(timestamp):
+    message = Message('me', 'test ☃', 'dummy', 'https://www.foo.com', timestamp,
+                      score=0.5, tags=['a', 'b'])
+    copy = Message.from_bytes(message.to_bytes())
+    assert copy.to_dict() == message.to_dict()
+
+
+def test_bytes_round_trip_with_objects():
+    message = Message('me', 'test', 'dummy', 'https://www.foo.com', None,
+                      seen=datetime.date(2019, 5, 1))
+    assert message.to_bytes()[:1] == b'\x01'
+    assert Message.from_bytes(message.to_bytes()).additions.seen == datetime.date(2019, 5, 1)
+
+
+def test_pickle():
+    message = Message('me', 'test', 'dummy', 'https://www.foo.com',
+                      datetime.datetime(2019, 5, 1), score=1)
+    assert pickle.loads(pickle.dumps(message)).to_dict() == message.to_dict()
+    assert len(pickle.dumps(message)) < 200
+
+
+def test_round_trip_with_colliding_additions():
+    message = Message('me', 'test', 'dummy', 'https://www.foo.com', None)
+    message.additions['url'] = 'https://www.bar.com'
+    message.additions[1] = 'one'
+    for copy in (Message.from_bytes(message.to_bytes()),
+                 pickle.loads(pickle.dumps(message))):
+        assert copy.url == 'https://www.foo.com'
+        assert dict(copy.additions) == {'url': 'https://www.bar.com', 1: 'one'}
+
+
+def test_pack():
+    messages = [Message('me', f'test {x}', 'dummy', None, datetime.datetime(2020, 1, 1), score=x) for x in range(3)]
+    unpacked = unpack(pack(messages))
+    assert [x.to_dict() for x in unpacked] == [x.to_dict() for x in messages]
+    assert unpack(pack([])) == []
+
+
+def test_priority_and_source_round_trip():
+    message = Message('me', 'test', 'dummy', None, None)
+    message.priority = 2
+    message.source = 'foo'
+    copy = Message.from_bytes(message.to_bytes())
+    assert (copy.priority, copy.source) == (2, 'foo')
+
+    # Messages serialized without a priority and source still load.
+    old = b'\x00' + marshal.dumps(('me', 'test', 'dummy', None, 0, None, None))
+    copy = Message.from_bytes(old)
+    assert (copy.priority, copy.source) == (0, None)
+
+
+def test_pack_json():
+    message = Message('me', 'test', 'dummy', None, datetime.datetime(2020, 1, 1),
+                      seen=datetime.date(2019, 5, 1), tags=['a'], other={1, 2})
+    message.priority = 1
+    message.source = 'foo'
+    copy, = unpack_json(pack_json([message]))
+    assert copy.to_dict() == dict(message.to_dict(), other='{1, 2}')
+    assert (copy.priority, copy.source) == (1, 'foo')
+
+    for payload in (b'{}', b'[[1, 2]]', b'[["me", "test", "dummy", null, null, [], 0, null]]',
+                    b'[["me", ["test"], "dummy", null, null, null, 0, null]]',
+                    b'[[1, "test", "dummy", null, null, null, 0, null]]',
+                    b'[["me", "test", "dummy", {"a": 1}, null, null, 0, null]]'):
+        with pytest.raises(ValueError):
+            unpack_json(payload)
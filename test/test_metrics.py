@@ -0,0 +1,80 @@
+import asyncio
+import datetime
+
+import pytest
+
+from semaphore import Metrics, Semaphore
+from semaphore.metrics import DROPPED, EMIT_LATENCY, END_TO_END_LATENCY, FILTERED, IN, OUT, Histogram, latency
+from semaphore.process import SemaphoreTimeLimitInterrupt
+
+from helpers import ListHandler, TimedInputProcess
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1.0, 10.0))
+    for value in (0.05, 0.5, 0.5, 5.0, 50.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.quantile(0.5) == 1.0
+    assert histogram.quantile(1.0) == float('inf')
+    assert Histogram().quantile(0.5) is None
+
+
+def test_latency():
+    timestamp = datetime.datetime(2020, 1, 1)
+    now = datetime.datetime(2020, 1, 1, 0, 0, 3, tzinfo=datetime.timezone.utc).timestamp()
+    assert latency(timestamp, now) == pytest.approx(3.0)
+    assert latency(timestamp.replace(tzinfo=datetime.timezone.utc), now) == pytest.approx(3.0)
+    assert latency('yesterday', now) is None
+
+
+def test_prometheus_endpoint():
+    metrics = Metrics(port=0)
+    metrics.increment('reddit', IN, 3)
+    metrics.count('input', DROPPED, lambda: 2)
+    metrics.gauge('queue_depth', 'input', lambda: 7)
+    metrics.observe(EMIT_LATENCY, 'handler "slack"', 0.02)
+
+    async def scrape():
+        server = await metrics.serve()
+        reader, writer = await asyncio.open_connection('127.0.0.1', metrics.port)
+        writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        response = await reader.read()
+        writer.close()
+        server.close()
+        return response.decode()
+
+    response = asyncio.run(scrape())
+    assert response.startswith('HTTP/1.0 200 OK')
+    assert 'semaphore_messages_in_total{stage="reddit"} 3' in response
+    assert 'semaphore_messages_dropped_total{stage="input"} 2' in response
+    assert 'semaphore_queue_depth{stage="input"} 7' in response
+    assert 'semaphore_emit_latency_seconds_bucket{stage="handler \\"slack\\"",le="0.025"} 1' in response
+    assert 'semaphore_emit_latency_seconds_bucket{stage="handler \\"slack\\"",le="+Inf"} 1' in response
+    assert 'semaphore_emit_latency_seconds_count{stage="handler \\"slack\\""} 1' in response
+
+
+def test_pipeline_metrics():
+    snapshots = []
+    metrics = Metrics(interval=0.05)
+    metrics.add_callback(snapshots.append)
+    semaphore = Semaphore(time_limit=0.5, metrics=metrics)
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = lambda message: message.body != 'test 2'
+    semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(ListHandler('list'))
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    snapshot = snapshots[-1]
+    counters = snapshot['counters']
+    assert counters['foo'][IN] == 5
+    assert counters['foo'][FILTERED] == 1
+    assert counters['foo'][OUT] == 4
+    assert counters['middleware-0'][OUT] == 4
+    assert counters['handler list'][OUT] == 4
+    assert counters['handler list'][DROPPED] == 0
+    assert snapshot['gauges']['queue_depth'] == {'input': 0, 'output': 0, 'handler list': 0}
+    assert snapshot['histograms'][END_TO_END_LATENCY]['handler list']['count'] == 4
+    assert snapshot['histograms'][EMIT_LATENCY]['handler list']['count'] >= 1
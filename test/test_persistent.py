@@ -0,0 +1,60 @@
+import asyncio
+import os
+
+from semaphore.persistent import PersistentQueue
+
+from helpers import make_message
+
+
+def drain(queue):
+    messages = []
+    while not queue.empty():
+        messages.append(queue.get_nowait())
+    return messages
+
+
+def test_replay_unacknowledged(tmp_path):
+    async def run():
+        queue = PersistentQueue(tmp_path, commit_size=2)
+        for counter in range(5):
+            await queue.put(make_message(counter))
+        first, second = queue.get_nowait(), queue.get_nowait()
+        queue.ack(second)
+        queue.close()
+        queue.ack(first)
+
+    asyncio.run(run())
+
+    queue = PersistentQueue(tmp_path)
+    assert [x.body for x in drain(queue)] == [f'test {x}' for x in range(5) if x != 1]
+    assert queue.qsize() == 0
+
+
+def test_acknowledged_segments_are_removed(tmp_path):
+    queue = PersistentQueue(tmp_path, segment_size=1, commit_size=1)
+    for counter in range(3):
+        queue.put_nowait(make_message(counter))
+    assert len([x for x in os.listdir(tmp_path) if x.endswith('.seg')]) == 4
+
+    for message in drain(queue):
+        queue.ack(message)
+    queue.close()
+    assert len([x for x in os.listdir(tmp_path) if x.endswith('.seg')]) == 1
+    assert drain(PersistentQueue(tmp_path)) == []
+
+
+def test_torn_record_is_truncated(tmp_path):
+    queue = PersistentQueue(tmp_path)
+    queue.put_nowait(make_message(0))
+    queue.close()
+    segment = tmp_path / sorted(x for x in os.listdir(tmp_path) if x.endswith('.seg'))[0]
+    size = segment.stat().st_size
+    with open(segment, 'ab') as stream:
+        stream.write(b'\x00\x00\x01\x00garbage')
+
+    queue = PersistentQueue(tmp_path)
+    assert [x.body for x in drain(queue)] == ['test 0']
+    assert segment.stat().st_size == size
+    queue.put_nowait(make_message(1))
+    queue.close()
+    assert [x.body for x in drain(PersistentQueue(tmp_path))] == ['test 0', 'test 1']
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import pytest
+
+from semaphore import MiddlewareProcess, Profiler, Semaphore, profiling
+from semaphore.handler import Handler
+from semaphore.process import SemaphoreTimeLimitInterrupt
+from semaphore.profiling import EMIT, FILTER, FORMAT, PROCESS, SamplingProfiler
+
+from helpers import TimedInputProcess
+
+
+class FormattingHandler(Handler):
+    def __init__(self, name):
+        super().__init__(name)
+        self.texts = []
+
+    def emit(self, message):
+        self.texts.append(self.format(message))
+
+
+class StallingMiddleProcess(MiddlewareProcess):
+    async def process_message(self, message):
+        if message.body == 'test 1':
+            await asyncio.sleep(0.1)
+        return message
+
+
+def test_profiler():
+    calls = []
+    profiler = Profiler(slow_threshold=0.08)
+    profiler.add_hook(PROCESS, before=lambda step, stage, messages: calls.append((step, stage, len(messages))),
+                      after=lambda step, stage, messages, seconds: calls.append(seconds))
+    semaphore = Semaphore(time_limit=0.5, profiler=profiler)
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = lambda message: True
+    semaphore.add_input_process(input_process)
+    semaphore.replace_middleware_process(StallingMiddleProcess)
+    semaphore.add_output_handler(FormattingHandler('list'))
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+    assert profiling.profiler is None
+
+    timings = profiler.timings
+    assert timings[FILTER, 'foo']['calls'] == 5
+    assert timings[PROCESS, 'middleware-0']['calls'] == 5
+    assert timings[PROCESS, 'middleware-0']['max'] >= 0.1
+    assert timings[FORMAT, 'handler list']['calls'] == 5
+    assert timings[EMIT, 'handler list']['calls'] >= 1
+    assert calls[0] == (PROCESS, 'middleware-0', 1)
+    assert len(calls) == 10
+
+    # Only the stalled message is traced, with every step it took.
+    assert [x['message']['body'] for x in profiler.traces] == ['test 1']
+    trace = profiler.traces[0]
+    assert trace['total'] >= 0.1
+    assert [x[0] for x in trace['steps']] == [FILTER, PROCESS, FORMAT, EMIT]
+
+
+def busy(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_sampling_profiler():
+    profiler = Profiler()
+    profiler.toggle_sampling()
+    busy(0.2)
+    profiler.toggle_sampling()
+
+    sampling = profiler.sampling
+    assert not sampling.running
+    assert sampling.samples > 0
+    assert sampling.top(1)[0][0] == 'test_profiling.py:busy'
+    assert 'test_profiling.py:test_sampling_profiler;test_profiling.py:busy' in sampling.collapsed()
+    assert isinstance(SamplingProfiler().top(), list)
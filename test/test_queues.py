@@ -0,0 +1,125 @@
+import asyncio
+import pytest
+
+from semaphore.queues import BLOCK, DROP_NEWEST, DROP_OLDEST, SAMPLE, FairQueue, MessageQueue
+
+from helpers import make_message
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_drop_newest():
+    queue = MessageQueue(3, DROP_NEWEST)
+    for i in range(5):
+        queue.put_nowait(i)
+    assert drain(queue) == [0, 1, 2]
+    assert queue.dropped == 2
+
+
+def test_drop_oldest():
+    queue = MessageQueue(3, DROP_OLDEST)
+    for i in range(5):
+        queue.put_nowait(i)
+    assert drain(queue) == [2, 3, 4]
+    assert queue.dropped == 2
+
+
+def test_sample_keeps_maxsize():
+    queue = MessageQueue(10, SAMPLE)
+    for i in range(1000):
+        queue.put_nowait(i)
+    items = drain(queue)
+    assert len(items) == 10
+    assert len(set(items)) == 10
+    assert queue.dropped == 990
+
+
+def test_block_waits_for_consumer():
+    async def run():
+        queue = MessageQueue(1, BLOCK)
+        await queue.put(0)
+        producer = asyncio.ensure_future(queue.put(1))
+        await asyncio.sleep(0)
+        assert not producer.done()
+        assert await queue.get() == 0
+        await producer
+        assert await queue.get() == 1
+        assert queue.dropped == 0
+
+    asyncio.run(run())
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        MessageQueue(1, 'foo')
+
+
+def message(source, priority=0, counter=0):
+    message = make_message(f'{source} {counter}')
+    message.source = source
+    message.priority = priority
+    return message
+
+
+def test_fair_queue_takes_turns():
+    queue = FairQueue(weights={'b': 2})
+    for counter in range(6):
+        queue.put_nowait(message('a', counter=counter))
+    for counter in range(3):
+        queue.put_nowait(message('b', counter=counter))
+    queue.put_nowait(message('c'))
+    sources = [x.source for x in drain(queue)]
+    assert sources == ['a', 'b', 'b', 'c', 'a', 'b', 'a', 'a', 'a', 'a']
+
+
+def test_fair_queue_priority():
+    queue = FairQueue()
+    for counter in range(3):
+        queue.put_nowait(message('a', counter=counter))
+    queue.put_nowait(message('b', priority=1))
+    queue.put_nowait(message('a', priority=-1))
+    assert [(x.source, x.priority) for x in drain(queue)] == \
+        [('b', 1), ('a', 0), ('a', 0), ('a', 0), ('a', -1)]
+
+
+def test_fair_queue_drops_from_longest_backlog():
+    queue = FairQueue(3, DROP_OLDEST)
+    queue.put_nowait(message('a', counter=0))
+    queue.put_nowait(message('a', counter=1))
+    queue.put_nowait(message('b'))
+    queue.put_nowait(message('c'))
+    assert [x.body for x in drain(queue)] == ['a 1', 'b 0', 'c 0']
+    assert queue.dropped == 1
+
+    queue = FairQueue(3, SAMPLE)
+    for counter in range(100):
+        queue.put_nowait(message('a', counter=counter))
+    queue.put_nowait(message('b', priority=1))
+    assert len(drain(queue)) == 3
+
+
+def test_fair_queue_drop_newest_keeps_quiet_sources():
+    queue = FairQueue(3, DROP_NEWEST)
+    dropped = []
+    queue.on_drop = dropped.append
+    for counter in range(3):
+        queue.put_nowait(message('a', counter=counter))
+    queue.put_nowait(message('a', counter=3))
+    queue.put_nowait(message('b'))
+    queue.put_nowait(message('c', priority=10))
+    assert [x.body for x in drain(queue)] == ['c 0', 'a 0', 'b 0']
+    assert [x.body for x in dropped] == ['a 3', 'a 2', 'a 1']
+    assert queue.dropped == 3
+
+    # A message of a lower priority than the queued ones is dropped.
+    queue.put_nowait(message('a'))
+    queue.put_nowait(message('b'))
+    queue.put_nowait(message('c'))
+    queue.put_nowait(message('d', priority=-1))
+    assert [x.body for x in drain(queue)] == ['a 0', 'b 0', 'c 0']
+    assert queue.dropped == 4
@@ -0,0 +1,171 @@
+import asyncio
+import json
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from semaphore import CheckpointStore, RedditInputProcess, Semaphore
+from semaphore.process import SemaphoreTimeLimitInterrupt
+from semaphore.queues import MessageQueue
+
+from helpers import ListHandler
+
+
+class FakeReddit(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        subreddits = url.path.split('/')[2].split('+')
+        self.server.requests.append((subreddits, query.get('before', [None])[0]))
+        self.server.connections.add(self.client_address)
+
+        posts = [x for x in self.server.posts if x['subreddit'] in subreddits]
+        before = query.get('before', [None])[0]
+        if before is not None:
+            posts = [x for x in posts if int(x['name'][3:]) > int(before[3:])]
+        posts = sorted(posts, key=lambda x: x['name'], reverse=True)[:int(query['limit'][0])]
+        etag = f'"{hash(tuple(x["name"] for x in posts))}"'
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = json.dumps({'data': {'children': [{'data': x} for x in posts]}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_reddit():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeReddit)
+    server.posts = []
+    server.requests = []
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def add_post(server, subreddit):
+    counter = len(server.posts)
+    server.posts.append({'name': f't3_{counter:06d}', 'subreddit': subreddit, 'author': 'me',
+                         'title': f'post {counter}', 'selftext': '', 'created_utc': 1600000000 + counter,
+                         'permalink': f'/r/{subreddit}/comments/{counter}/'})
+
+
+class AllTopics:
+    def __call__(self, message):
+        return True
+
+
+def run_reddit(server, subreddits, duration, during=None, checkpoint_store=None):
+    queue = MessageQueue()
+    process = RedditInputProcess('reddit', queue, logging.getLogger(), subreddits, 'semaphore tests',
+                                 base_url=f'http://127.0.0.1:{server.server_port}', group_size=25,
+                                 interval=0.05, max_interval=0.2)
+    process.topic_filter = AllTopics()
+    process.checkpoint_store = checkpoint_store
+
+    async def run():
+        task = asyncio.create_task(process.execution_loop())
+        if during is not None:
+            await asyncio.sleep(duration / 2)
+            during()
+        await asyncio.sleep(duration / 2 if during is not None else duration)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    messages = []
+    while not queue.empty():
+        messages.append(queue.get_nowait())
+    return messages
+
+
+def test_combined_listings(fake_reddit):
+    subreddits = [f'sub{x}' for x in range(60)]
+    for subreddit in subreddits:
+        add_post(fake_reddit, subreddit)
+
+    messages = run_reddit(fake_reddit, subreddits, 0.5, during=lambda: add_post(fake_reddit, 'sub7'))
+
+    # Every post arrives once, in three combined listings.
+    assert sorted(x.additions.id for x in messages) == sorted(x['name'] for x in fake_reddit.posts)
+    assert {len(x[0]) for x in fake_reddit.requests} == {25, 10}
+    assert messages[-1].url.endswith('/r/sub7/comments/60/')
+    # Quiet groups back off, and the session reuses its connections.
+    assert len(fake_reddit.requests) < 3 * 0.5 / 0.05
+    assert len(fake_reddit.connections) <= 4
+
+
+def test_resume_from_checkpoint(fake_reddit, tmp_path):
+    add_post(fake_reddit, 'python')
+    store = CheckpointStore(tmp_path / 'checkpoints.json')
+    assert len(run_reddit(fake_reddit, ['python'], 0.2, checkpoint_store=store)) == 1
+    store.flush()
+
+    add_post(fake_reddit, 'python')
+    messages = run_reddit(fake_reddit, ['python'], 0.2, checkpoint_store=CheckpointStore(store.path))
+    assert [x.additions.title for x in messages] == ['post 1']
+
+
+def test_checkpoint_after_posts_are_queued(fake_reddit, tmp_path):
+    for _ in range(3):
+        add_post(fake_reddit, 'python')
+    store = CheckpointStore(tmp_path / 'checkpoints.json')
+    # The queue takes one post, so putting the others blocks.
+    queue = MessageQueue(1)
+    process = RedditInputProcess('reddit', queue, logging.getLogger(), ['python'], 'semaphore tests',
+                                 base_url=f'http://127.0.0.1:{fake_reddit.server_port}', interval=0.05)
+    process.topic_filter = AllTopics()
+    process.checkpoint_store = store
+
+    async def run():
+        task = asyncio.create_task(process.execution_loop())
+        await asyncio.sleep(0.2)
+        assert store.get('reddit') == {}
+
+        async def drain():
+            while queue.qsize() or not store.get('reddit'):
+                await queue.get()
+                await asyncio.sleep(0.01)
+
+        await asyncio.wait_for(drain(), 2)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert store.get('reddit')['/r/python/new.json']['before'] == 't3_000002'
+
+
+def test_scheduler_closes_session(fake_reddit):
+    add_post(fake_reddit, 'python')
+    semaphore = Semaphore(time_limit=0.3)
+    process = RedditInputProcess('reddit', semaphore._input_queue, semaphore._logger, ['python'],
+                                 'semaphore tests', base_url=f'http://127.0.0.1:{fake_reddit.server_port}')
+    process.topic_filter = AllTopics()
+    semaphore.add_input_process(process)
+    handler = ListHandler('list')
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert len(handler.messages) == 1
+    # The scheduler closed the session, so no connection is left open.
+    assert not process._session.get_adapter(process._base_url).poolmanager.pools
@@ -0,0 +1,84 @@
+import asyncio
+import datetime
+import os
+
+import pytest
+
+from semaphore import InputProcess, Message, MiddlewareProcess, Semaphore, ShardedRuntime
+from semaphore.process import SemaphoreTimeLimitInterrupt
+
+from helpers import ListHandler, PassTopicFilter
+
+
+class SpreadInputProcess(InputProcess):
+    def __init__(self, name, queue, logger, bodies, delay=0.0):
+        super().__init__(name, queue, logger)
+        self._bodies = bodies
+        self._delay = delay
+
+    async def execution_loop(self):
+        for body in self._bodies:
+            message = Message('me', body, 'dummy', f'https://www.foo.com/{self.name}/{body}',
+                              datetime.datetime.utcnow())
+            await self._put_message(message)
+            await asyncio.sleep(self._delay)
+        await asyncio.Event().wait()
+
+
+class ShardPidMiddleProcess(MiddlewareProcess):
+    def process_message(self, message):
+        message.additions['pid'] = os.getpid()
+        return message
+
+
+class CrashingMiddleProcess(MiddlewareProcess):
+    def __init__(self, *args, marker, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._marker = marker
+
+    def process_message(self, message):
+        if message.body == 'crash' and not os.path.exists(self._marker):
+            open(self._marker, 'w').close()
+            os._exit(1)
+        return message
+
+
+def test_sharded_run():
+    semaphore = Semaphore(time_limit=4, runtime=ShardedRuntime(shards=2, input_workers=2))
+    for name in ('a', 'b'):
+        input_process = SpreadInputProcess(name, semaphore._input_queue, semaphore._logger,
+                                           [f'test {x}' for x in range(20)])
+        input_process.topic_filter = PassTopicFilter()
+        semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(ShardPidMiddleProcess)
+    handler = ListHandler('list')
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert sorted(m.url for m, _ in handler.messages) == \
+        sorted(f'https://www.foo.com/{x}/test {y}' for x in 'ab' for y in range(20))
+    pids = {m.additions.pid for m, _ in handler.messages}
+    assert len(pids) == 2
+    assert os.getpid() not in pids
+
+
+def test_restart_crashed_shard(tmp_path):
+    runtime = ShardedRuntime(shards=1, restart_delay=0.1)
+    semaphore = Semaphore(time_limit=5, runtime=runtime)
+    input_process = SpreadInputProcess('a', semaphore._input_queue, semaphore._logger,
+                                       ['crash', 'test 1', 'test 2'], delay=0.5)
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(CrashingMiddleProcess, marker=str(tmp_path / 'crashed'))
+    handler = ListHandler('list')
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    # The restarted input starts over, and the shard no longer crashes.
+    assert semaphore.supervisor.restarts == 1
+    assert semaphore.supervisor.crashes == {'shard 0': 1}
+    assert [m.body for m, _ in handler.messages] == ['crash', 'test 1', 'test 2']
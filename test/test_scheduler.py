@@ -0,0 +1,69 @@
+import asyncio
+import datetime
+import logging
+
+import pytest
+
+from semaphore import InputProcess, Message, PollScheduler
+from semaphore.queues import MessageQueue
+
+
+class CountingInputProcess(InputProcess):
+    def __init__(self, name, queue, messages_per_poll=0, fail=False):
+        super().__init__(name, queue, logging.getLogger())
+        self.topic_filter = lambda message: True
+        self._messages_per_poll = messages_per_poll
+        self._fail = fail
+        self.polls = 0
+
+    async def poll(self):
+        await self._acquire_request()
+        self.polls += 1
+        if self._fail:
+            raise ConnectionError('source is down')
+        for counter in range(self._messages_per_poll):
+            await self._put_message(Message('me', f'test {counter}', 'dummy', 'https://www.foo.com',
+                                            datetime.datetime.utcnow()))
+        return self._messages_per_poll
+
+
+def run_scheduler(scheduler, inputs, duration):
+    async def run():
+        task = asyncio.create_task(scheduler.run(inputs, logging.getLogger()))
+        await asyncio.sleep(duration)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+
+
+def test_polling():
+    assert CountingInputProcess('foo', MessageQueue()).polling
+    assert not InputProcess('foo', MessageQueue(), logging.getLogger()).polling
+
+
+def test_adaptive_intervals():
+    queue = MessageQueue()
+    active = CountingInputProcess('active', queue, messages_per_poll=20)
+    quiet = CountingInputProcess('quiet', queue)
+    failing = CountingInputProcess('failing', queue, fail=True)
+    scheduler = PollScheduler(min_interval=0.01, max_interval=0.2, messages_per_poll=5)
+
+    run_scheduler(scheduler, [active, quiet, failing], 1.0)
+
+    intervals = scheduler.intervals
+    assert intervals['active'] == pytest.approx(0.01)
+    assert intervals['quiet'] == pytest.approx(0.2)
+    assert intervals['failing'] == pytest.approx(0.2)
+    assert active.polls > 3 * quiet.polls
+    assert active.polls > 3 * failing.polls
+
+
+def test_request_budget():
+    queue = MessageQueue()
+    inputs = [CountingInputProcess(f'input {x}', queue, messages_per_poll=20) for x in range(4)]
+    scheduler = PollScheduler(min_interval=0.01, request_rate=20, request_burst=2)
+
+    run_scheduler(scheduler, inputs, 0.5)
+
+    assert sum(x.polls for x in inputs) <= 0.5 * 20 + 2
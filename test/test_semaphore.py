@@ -1,23 +1,27 @@
 # TODO: test the basic functionalities with a dummy logger that emits to a variable, with two simple generators with waits as inputs.
 
+import asyncio
 import datetime
 import pytest
 import time
 import os
 
-from semaphore import Semaphore, FileHandler, InputProcess, Message, MiddlewareProcess
+from semaphore import AsyncHandler, CheckpointStore, Deduplicator, Semaphore, FileHandler, InputProcess, Message, MiddlewareProcess
+from semaphore.handler import Handler
 from semaphore.process import SemaphoreTimeLimitInterrupt
 from semaphore.topic_filter import TopicFilter
 
+from helpers import BurstInputProcess, ListHandler, PassTopicFilter, TimedInputProcess, make_message
+
 
 class DummyInputProcess(InputProcess):
-    def execution_loop(self):
+    async def execution_loop(self):
         counter = 0
         while True:
             message = Message('me', f'test {counter}', 'dummy', 'https://www.foo.com', datetime.datetime.utcnow())
-            self._put_message(message)
+            await self._put_message(message)
             counter += 1
-            time.sleep(2)
+            await asyncio.sleep(2)
 
 
 class DummyMiddleProcess(MiddlewareProcess):
@@ -50,3 +54,285 @@ def test_semaphore():
     finally:
         if os.path.isfile(filename):
             os.remove(filename)
+
+
+def test_pipeline_latency():
+    semaphore = Semaphore(time_limit=0.5)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert [m.body for m, _ in handler.messages] == [f'test {i}' for i in range(5)]
+    for sent, (_, received) in zip(input_process.sent, handler.messages):
+        assert received - sent < 0.05
+
+
+class SlowMiddleProcess(MiddlewareProcess):
+    async def process_message(self, message):
+        # Later messages finish first, which tests the ordering.
+        await asyncio.sleep(0.45 - 0.06 * int(message.body.split()[-1]))
+        message.additions['slow'] = True
+        return message
+
+
+class RoutingMiddleProcess(MiddlewareProcess):
+    def process_message(self, message):
+        if message.body.endswith('3'):
+            return None
+        return message
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_middleware_chain(ordered):
+    semaphore = Semaphore(time_limit=1)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger, count=8)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(SlowMiddleProcess, workers=8, ordered=ordered)
+    semaphore.add_middleware_process(RoutingMiddleProcess)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    bodies = [m.body for m, _ in handler.messages]
+    expected = [f'test {i}' for i in range(8) if i != 3]
+    assert all(m.additions['slow'] for m, _ in handler.messages)
+    if ordered:
+        assert bodies == expected
+    else:
+        assert bodies != expected
+        assert sorted(bodies) == expected
+
+
+def test_middleware_type_check():
+    with pytest.raises(TypeError):
+        Semaphore().add_middleware_process(object)
+
+
+class PidMiddleProcess(MiddlewareProcess):
+    def process_message(self, message):
+        message.additions['pid'] = os.getpid()
+        return message
+
+
+def test_middleware_process_pool():
+    semaphore = Semaphore(time_limit=1)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger, count=8)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(PidMiddleProcess, processes=2)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert [m.body for m, _ in handler.messages] == [f'test {i}' for i in range(8)]
+    assert all(m.additions['pid'] != os.getpid() for m, _ in handler.messages)
+
+
+class BatchMiddleProcess(MiddlewareProcess):
+    def process_batch(self, messages):
+        for message in messages:
+            message.additions['batch'] = len(messages)
+        return messages
+
+
+def test_middleware_batch():
+    semaphore = Semaphore(time_limit=1)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger, count=8)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(BatchMiddleProcess, batch_size=3, batch_timeout=0.5)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert [m.body for m, _ in handler.messages] == [f'test {i}' for i in range(8)]
+    assert [m.additions['batch'] for m, _ in handler.messages] == [3] * 6 + [2] * 2
+
+
+def test_middleware_ordered_batches():
+    semaphore = Semaphore(time_limit=1.5)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger, count=12)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_middleware_process(BatchMiddleProcess, workers=3, batch_size=4, batch_timeout=0.5)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert [m.body for m, _ in handler.messages] == [f'test {i}' for i in range(12)]
+
+
+class HangingHandler(Handler):
+    def emit(self, message):
+        time.sleep(1)
+
+
+class AsyncListHandler(AsyncHandler):
+    def __init__(self, name):
+        super().__init__(name)
+        self.messages = []
+
+    async def emit(self, message):
+        await asyncio.sleep(0)
+        self.messages.append(message)
+
+
+def test_output_isolation():
+    semaphore = Semaphore(time_limit=0.5)
+
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+    async_handler = AsyncListHandler('async')
+
+    semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(HangingHandler('hanging'), queue_size=2, queue_policy='drop_newest')
+    semaphore.add_output_handler(handler)
+    semaphore.add_output_handler(async_handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert len(handler.messages) == 5
+    assert len(async_handler.messages) == 5
+    assert semaphore.dropped['handler hanging'] == 2
+
+
+class RepeatingInputProcess(InputProcess):
+    async def execution_loop(self):
+        for counter in range(6):
+            message = Message('me', f'test {counter % 3}', 'dummy', 'https://www.foo.com', datetime.datetime.utcnow())
+            await self._put_message(message)
+        await asyncio.Event().wait()
+
+
+def test_deduplication():
+    deduplicator = Deduplicator()
+    semaphore = Semaphore(time_limit=0.2, deduplicator=deduplicator)
+    handler = ListHandler('list')
+
+    for name in ('foo', 'bar'):
+        input_process = RepeatingInputProcess(name, semaphore._input_queue, semaphore._logger)
+        input_process.topic_filter = PassTopicFilter()
+        semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    assert sorted(m.body for m, _ in handler.messages) == ['test 0', 'test 1', 'test 2']
+    assert deduplicator.duplicate_rate == 0.75
+
+
+class FailingHandler(Handler):
+    def emit(self, message):
+        raise RuntimeError('Emitting failed')
+
+
+class SilentInputProcess(InputProcess):
+    async def execution_loop(self):
+        await asyncio.Event().wait()
+
+
+def test_persistence(tmp_path):
+    semaphore = Semaphore(time_limit=0.5, persistence_directory=tmp_path)
+    input_process = TimedInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(FailingHandler('failing'))
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    # Nothing was emitted, so a restart replays all messages.
+    semaphore = Semaphore(time_limit=0.2, persistence_directory=tmp_path)
+    input_process = SilentInputProcess('foo', semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = PassTopicFilter()
+    handler = ListHandler('list')
+    semaphore.add_input_process(input_process)
+    semaphore.add_output_handler(handler)
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+    assert [m.body for m, _ in handler.messages] == [f'test {i}' for i in range(5)]
+
+    # Everything was emitted now, so nothing is replayed.
+    semaphore = Semaphore(time_limit=0.2, persistence_directory=tmp_path)
+    assert semaphore._input_queue.empty() and semaphore._output_queue.empty()
+
+
+class ResumingInputProcess(InputProcess):
+    async def execution_loop(self):
+        start = self.checkpoint.get('last', -1) + 1
+        for counter in range(start, start + 3):
+            message = Message('me', f'test {counter}', 'dummy', 'https://www.foo.com', datetime.datetime.utcnow())
+            await self._put_message(message)
+            self.save_checkpoint(last=counter)
+        await asyncio.Event().wait()
+
+
+def test_checkpoints(tmp_path):
+    path = tmp_path / 'checkpoints.json'
+    for expected in (['test 0', 'test 1', 'test 2'], ['test 3', 'test 4', 'test 5']):
+        semaphore = Semaphore(time_limit=0.2, checkpoint_store=CheckpointStore(path, flush_interval=0.05))
+        input_process = ResumingInputProcess('foo', semaphore._input_queue, semaphore._logger)
+        input_process.topic_filter = PassTopicFilter()
+        handler = ListHandler('list')
+        semaphore.add_input_process(input_process)
+        semaphore.add_output_handler(handler)
+        with pytest.raises(SemaphoreTimeLimitInterrupt):
+            semaphore.run()
+        assert [m.body for m, _ in handler.messages] == expected
+
+    assert CheckpointStore(path).get('foo') == {'last': 5}
+
+
+class SleepingMiddleProcess(MiddlewareProcess):
+    async def process_message(self, message):
+        await asyncio.sleep(0.001)
+        return message
+
+
+def test_fair_queuing():
+    semaphore = Semaphore(time_limit=1, fair_queuing=True)
+    handler = ListHandler('list')
+    for name, count in (('noisy', 200), ('quiet', 1), ('urgent', 1)):
+        messages = [make_message(f'{name} {x}') for x in range(count)]
+        input_process = BurstInputProcess(name, semaphore._input_queue, semaphore._logger, messages)
+        input_process.topic_filter = PassTopicFilter()
+        semaphore.add_input_process(input_process)
+    input_process.priority = 1
+    semaphore.replace_middleware_process(SleepingMiddleProcess)
+    semaphore.add_output_handler(handler)
+
+    with pytest.raises(SemaphoreTimeLimitInterrupt):
+        semaphore.run()
+
+    bodies = [m.body for m, _ in handler.messages]
+    assert bodies.index('urgent 0') < 3
+    assert bodies.index('quiet 0') < 5
+
+    with pytest.raises(ValueError):
+        Semaphore(fair_queuing=True, persistence_directory='foo')
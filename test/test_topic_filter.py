@@ -0,0 +1,84 @@
+import random
+
+import pytest
+
+from semaphore.topic_filter import And, KeywordFilter, Not, Or, RegexFilter, TopicFilter, _Automaton
+
+from helpers import make_message
+
+
+class CountingFilter(TopicFilter):
+    def __init__(self, result):
+        self.result = result
+        self.calls = 0
+
+    def filter(self, message):
+        self.calls += 1
+        return self.result
+
+
+def test_automaton_matches_like_substring_search():
+    random.seed(0)
+    keywords = [''.join(random.choices('abc', k=random.randint(1, 4))) for _ in range(20)]
+    automaton = _Automaton(keywords)
+    for _ in range(200):
+        text = ''.join(random.choices('abcd', k=30))
+        found = {keyword for _, keyword in automaton.iter(text)}
+        assert found == {x for x in keywords if x in text}
+
+
+def test_keyword_filter():
+    topic_filter = KeywordFilter(['Trump', 'white house'])
+    assert topic_filter(make_message('the WHITE HOUSE said'))
+    assert topic_filter(make_message('trumpet'))
+    assert not topic_filter(make_message('nothing here'))
+
+    whole_words = KeywordFilter(['trump'], whole_words=True)
+    assert whole_words(make_message('Trump said'))
+    assert not whole_words(make_message('trumpet'))
+
+    url_filter = KeywordFilter(['foo.com'], fields=('body', 'url'))
+    assert url_filter(make_message('nothing here'))
+
+
+def test_regex_filter():
+    topic_filter = RegexFilter([r'tax(es)?', r'tariffs?'], whole_words=True)
+    assert topic_filter(make_message('New Tariffs announced'))
+    assert not topic_filter(make_message('taxonomy'))
+
+
+def test_empty_filters():
+    with pytest.raises(ValueError):
+        KeywordFilter([])
+    with pytest.raises(ValueError):
+        RegexFilter([])
+
+
+def test_composition():
+    trump = KeywordFilter(['trump'])
+    tax = KeywordFilter(['tax'])
+    topic_filter = (trump & ~tax) | RegexFilter(['^breaking'])
+    assert topic_filter(make_message('trump speaks'))
+    assert not topic_filter(make_message('trump tax plan'))
+    assert topic_filter(make_message('Breaking: tax plan'))
+    assert isinstance(topic_filter, Or)
+    assert len((trump & tax & trump).filters) == 3
+
+
+def test_composition_orders_selective_clauses_first():
+    passing, failing = CountingFilter(True), CountingFilter(False)
+    topic_filter = And(passing, failing)
+    topic_filter.reorder_interval = 10
+    for _ in range(100):
+        assert not topic_filter(make_message('foo'))
+    assert topic_filter.filters[0] is failing
+    assert passing.calls < 20
+
+    passing, failing = CountingFilter(True), CountingFilter(False)
+    topic_filter = Or(failing, passing)
+    topic_filter.reorder_interval = 10
+    for _ in range(100):
+        assert topic_filter(make_message('foo'))
+    assert topic_filter.filters[0] is passing
+    assert failing.calls < 20
+    assert not Not(passing)(make_message('foo'))
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from semaphore import Semaphore, TCPHandler, TCPInputProcess
+from semaphore.message import pack, pack_json, unpack
+from semaphore.process import SemaphoreTimeLimitInterrupt
+from semaphore.queues import MessageQueue
+from semaphore.transport import (ACK, CHALLENGE_SIZE, COMPRESSED, HEADER, FrameError, encode_frame,
+                                 encode_hello, read_frame)
+
+from helpers import ListHandler, PassTopicFilter, TimedInputProcess, make_message
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_in_thread(semaphore):
+    def run():
+        try:
+            semaphore.run()
+        except SemaphoreTimeLimitInterrupt:
+            pass
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def relay(port, time_limit, secret=None):
+    semaphore = Semaphore(time_limit=time_limit)
+    input_process = TCPInputProcess('tcp', semaphore._input_queue, semaphore._logger, port=port,
+                                    secret=secret)
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+    handler = ListHandler('list')
+    semaphore.add_output_handler(handler)
+    return semaphore, handler
+
+
+def collector(name, port, time_limit, secret=None):
+    semaphore = Semaphore(time_limit=time_limit)
+    input_process = TimedInputProcess(name, semaphore._input_queue, semaphore._logger)
+    input_process.topic_filter = PassTopicFilter()
+    semaphore.add_input_process(input_process)
+    handler = TCPHandler('tcp', '127.0.0.1', port, secret=secret)
+    semaphore.add_output_handler(handler)
+    return semaphore, handler
+
+
+def test_frames():
+    payload = pack([make_message(x) for x in range(100)])
+    frame = encode_frame(7, payload)
+    assert HEADER.unpack_from(frame)[1:] == (7, COMPRESSED)
+    assert len(frame) < len(payload)
+    assert HEADER.unpack_from(encode_frame(7, payload, compression=0))[2] == 0
+
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(frame)
+        return await read_frame(reader)
+
+    sequence, flags, decoded = asyncio.run(read())
+    assert (sequence, decoded) == (7, payload)
+    assert [x.body for x in unpack(decoded)] == [f'test {x}' for x in range(100)]
+
+
+def test_fan_in():
+    port = free_port()
+    relay_semaphore, received = relay(port, 2.5, secret='secret')
+    threads = [run_in_thread(relay_semaphore)]
+    for name in ('a', 'b'):
+        threads.append(run_in_thread(collector(name, port, 1.5, secret='secret')[0]))
+    for thread in threads:
+        thread.join()
+
+    assert sorted(m.body for m, _ in received.messages) == sorted([f'test {x}' for x in range(5)] * 2)
+
+
+def test_reconnect_with_buffering():
+    port = free_port()
+    collector_semaphore, handler = collector('a', port, 2.0)
+    threads = [run_in_thread(collector_semaphore)]
+    # The relay only comes up after every message was emitted.
+    time.sleep(0.8)
+    assert handler.buffered == 5
+    relay_semaphore, received = relay(port, 1.5)
+    threads.append(run_in_thread(relay_semaphore))
+    for thread in threads:
+        thread.join()
+
+    assert [m.body for m, _ in received.messages] == [f'test {x}' for x in range(5)]
+    assert handler.buffered == 0
+
+
+def send(frames, secret=None, sender_secret=None):
+    """Send frames to a TCPInputProcess, and return its acknowledgements and
+    the messages it put.
+    """
+    queue = MessageQueue()
+    input_process = TCPInputProcess('tcp', queue, logging.getLogger(), secret=secret,
+                                    max_frame_size=100000)
+    input_process.topic_filter = PassTopicFilter()
+
+    async def run():
+        server = asyncio.ensure_future(input_process.execution_loop())
+        while not input_process.port:
+            await asyncio.sleep(0.01)
+        acknowledgements = []
+        for connection in frames:
+            reader, writer = await asyncio.open_connection('127.0.0.1', input_process.port)
+            challenge = await reader.readexactly(CHALLENGE_SIZE)
+            writer.write(encode_hello('sender', challenge, sender_secret))
+            for frame in connection:
+                writer.write(frame)
+            # The receiver closes the connection once it read every frame.
+            writer.write_eof()
+            try:
+                while True:
+                    sequence, = ACK.unpack(await reader.readexactly(ACK.size))
+                    # Sequence number 0 acknowledges the hello.
+                    if sequence:
+                        acknowledgements.append(sequence)
+            except (asyncio.IncompleteReadError, ConnectionResetError):
+                pass
+            writer.close()
+        server.cancel()
+        return acknowledgements
+
+    acknowledgements = asyncio.run(run())
+    messages = []
+    while not queue.empty():
+        messages.append(queue.get_nowait())
+    return acknowledgements, messages
+
+
+def test_skip_batches_sent_twice():
+    batch = encode_frame(1, pack_json([make_message(1), make_message(2)]))
+    acknowledgements, messages = send([[batch], [batch]])
+    assert acknowledgements == [1, 1]
+    assert len(messages) == 2
+
+
+class Exploit:
+    executed = False
+
+    def __reduce__(self):
+        return setattr, (Exploit, 'executed', True)
+
+
+def test_reject_pickle():
+    message = make_message(1)
+    message.additions['exploit'] = Exploit()
+    payload = pack([message])
+    assert payload[4:5] == b'\x01'
+
+    acknowledgements, messages = send([[encode_frame(1, payload)]])
+    assert (acknowledgements, messages) == ([], [])
+    assert not Exploit.executed
+
+
+def test_reject_invalid_secret():
+    batch = encode_frame(1, pack_json([make_message(1)]))
+    assert send([[batch]], secret='secret', sender_secret='wrong') == ([], [])
+    assert send([[batch]], secret='secret') == ([], [])
+    assert len(send([[batch]], secret='secret', sender_secret='secret')[1]) == 1
+
+
+def test_reject_large_frames():
+    # Too large to read, and too large once decompressed.
+    large = pack_json([make_message(x) for x in range(10000)])
+    assert send([[encode_frame(1, large, compression=0)]]) == ([], [])
+    assert len(encode_frame(1, large)) < 100000
+    assert send([[encode_frame(1, large)]]) == ([], [])
+
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_frame(1, large))
+        return await read_frame(reader, 1000)
+
+    with pytest.raises(FrameError):
+        asyncio.run(read())
+
+
+def test_back_off_when_rejected(caplog):
+    port = free_port()
+    queue = MessageQueue()
+    input_process = TCPInputProcess('tcp', queue, logging.getLogger(), port=port, secret='secret')
+    input_process.topic_filter = PassTopicFilter()
+    handler = TCPHandler('tcp', '127.0.0.1', port, reconnect_delay=0.05, secret='wrong')
+
+    async def run():
+        server = asyncio.ensure_future(input_process.execution_loop())
+        await asyncio.sleep(0.05)
+        await handler.emit(make_message(1))
+        await asyncio.sleep(0.5)
+        handler.close()
+        server.cancel()
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(run())
+
+    rejections = [x for x in caplog.records if 'was rejected' in x.getMessage()]
+    # Delays of 0.05, 0.1 and 0.2 seconds fit in half a second, not ten.
+    assert 2 <= len(rejections) <= 4
+    assert queue.empty()